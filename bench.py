@@ -0,0 +1,228 @@
+# bench.py
+"""Offline load test: synthetic updates go straight into bot.dp with a fake Telegram transport
+and the local fake YooKassa server.
+
+    python bench.py --users 200 --concurrency 50 --tg-latency 0.03 --yk-latency 0.08
+    python bench.py --json > baseline.json
+    python bench.py --compare baseline.json --tolerance 0.25   # exit 1 on p99 regression
+
+Each virtual user runs: /start, pages through the catalog, opens one grid page, buy:, paid:, uploads a screenshot,
+and the manager confirms the order. Runs are repeatable for a given --seed.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from fake_telegram import MANAGER_ID, FakeTelegram, UpdateFactory
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="giftsbot dispatcher benchmark")
+    p.add_argument("--users", type=int, default=100, help="virtual buyers")
+    p.add_argument("--concurrency", type=int, default=20, help="buyers active at once")
+    p.add_argument("--pages", type=int, default=5, help="catalog page flips per buyer")
+    p.add_argument("--gifts", type=int, default=50, help="catalog size")
+    p.add_argument("--tg-latency", type=float, default=0.02, help="fake Telegram API latency, s")
+    p.add_argument("--yk-latency", type=float, default=0.05, help="fake YooKassa latency, s")
+    p.add_argument("--yk-fail-rate", type=float, default=0.0, help="share of fake YooKassa requests answered with 503")
+    p.add_argument("--yk-port", type=int, default=18088)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", action="store_true", help="print the report as JSON")
+    p.add_argument("--compare", help="baseline JSON report to compare p99 latencies against")
+    p.add_argument("--tolerance", type=float, default=0.2, help="allowed p99 regression vs baseline (0.2 = +20%%)")
+    return p.parse_args(argv)
+
+
+def setup_env(args):
+    # bot.py reads its config at import time
+    os.environ["API_TOKEN"] = "123456:BENCHBENCHBENCHBENCHBENCHBENCHBENCH"
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="giftsbench"), "bench.db")
+    os.environ["TEST_MODE"] = "false"
+    os.environ["YOOKASSA_SHOP_ID"] = "bench"
+    os.environ["YOOKASSA_SECRET_KEY"] = "bench"
+    os.environ["YOOKASSA_API_BASE"] = f"http://127.0.0.1:{args.yk_port}/v3"
+    os.environ["ADMINS"] = str(MANAGER_ID)
+    os.environ["MANAGER_CHAT_ID"] = str(MANAGER_ID)
+    os.environ.setdefault("METRICS_PORT", "0")
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, scenario, seconds):
+        self.samples.setdefault(scenario, []).append(seconds)
+
+    @staticmethod
+    def pct(values, q):
+        if not values:
+            return 0.0
+        values = sorted(values)
+        return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def loop_lag_monitor(samples, interval=0.01):
+    """Event-loop stall detector: how late does a 10 ms sleep wake up?"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+async def run(args):
+    import aiogram.bot.api as api
+    from aiogram import Bot, Dispatcher
+    fake_tg = FakeTelegram(args.tg_latency)
+    api.make_request = fake_tg.make_request
+
+    import bot
+    from fake_yookassa import start_fake_yookassa
+
+    random.seed(args.seed)
+    fake_yk, yk_runner = await start_fake_yookassa(port=args.yk_port, latency=args.yk_latency,
+                                                  fail_rate=args.yk_fail_rate)
+    Bot.set_current(bot.bot)
+    Dispatcher.set_current(bot.dp)
+    await bot.on_startup(bot.dp)
+    have = len(await bot.catalog.get())
+    if args.gifts > have:
+        await bot.db.executemany("INSERT INTO gifts (name, price, description, image_file_id, created_at) VALUES (?, ?, ?, ?, ?)",
+                                 [(f"Gift {i}", 100 + i, f"Bench gift {i}", "F" if i % 2 else None, "2026-01-01T00:00:00")
+                                  for i in range(have, args.gifts)])
+        bot.catalog.invalidate()
+    gift_ids = (await bot.catalog.get()).ids
+
+    rec = Recorder()
+    lag = []
+    updates = UpdateFactory()
+    lag_task = asyncio.create_task(loop_lag_monitor(lag))
+
+    waiting = {}  # update_id -> future resolved by the update scheduler
+
+    def update_finished(update, outcome):
+        fut = waiting.pop(update.update_id, None)
+        if fut is not None and not fut.done():
+            fut.set_result(outcome)
+
+    bot.update_scheduler.observer = update_finished
+    outcomes = {}
+
+    async def feed(scenario, update):
+        # through ScheduledDispatcher like polled updates: latency includes the per-chat queue wait
+        started = time.perf_counter()
+        fut = waiting[update.update_id] = asyncio.get_running_loop().create_future()
+        await bot.dp.process_updates([update])
+        outcome = await fut
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        rec.add(scenario, time.perf_counter() - started)
+
+    async def buyer(uid, rnd):
+        await feed("start", updates.message(uid, "/start"))
+        await feed("catalog", updates.message(uid, "🛒 Купить подарок"))
+        gid = gift_ids[0]
+        for _ in range(args.pages):
+            gid = gift_ids[min(len(gift_ids) - 1, gift_ids.index(gid) + 1)]
+            await feed("page", updates.callback(uid, bot.callbacks.encode(bot.CB_GIFT, gid)))
+        await feed("grid", updates.callback(uid, bot.callbacks.encode(bot.CB_GRID, rnd.choice(gift_ids))))
+        await feed("buy", updates.callback(uid, bot.callbacks.encode(bot.CB_BUY, rnd.choice(gift_ids))))
+        row = await bot.db.fetchone("SELECT id FROM orders WHERE chat_id = ? ORDER BY id DESC LIMIT 1", (uid,))
+        if not row:
+            return
+        await feed("paid", updates.callback(uid, bot.callbacks.encode(bot.CB_PAID, row[0])))
+        await feed("screenshot", updates.message(uid, photo=True))
+        await feed("admin_confirm", updates.callback(MANAGER_ID, bot.callbacks.encode(bot.CB_CONFIRM, row[0])))
+
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def limited(uid):
+        async with sem:
+            await buyer(uid, random.Random(args.seed * 100003 + uid))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(100000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+    lag_task.cancel()
+
+    total = sum(len(v) for v in rec.samples.values())
+    report = {
+        "params": {k: v for k, v in vars(args).items() if k not in ("json", "compare", "tolerance")},
+        "elapsed_s": round(elapsed, 3),
+        "updates": total,
+        "throughput_ups": round(total / elapsed, 1) if elapsed else 0.0,
+        "buyers_per_s": round(args.users / elapsed, 2) if elapsed else 0.0,
+        "scenarios": {
+            name: {"n": len(v), "p50_ms": round(rec.pct(v, 0.5) * 1000, 2), "p99_ms": round(rec.pct(v, 0.99) * 1000, 2)}
+            for name, v in sorted(rec.samples.items())
+        },
+        "loop_lag_ms": {"p50": round(rec.pct(lag, 0.5) * 1000, 2), "p99": round(rec.pct(lag, 0.99) * 1000, 2),
+                        "max": round(max(lag, default=0) * 1000, 2)},
+        "db": {
+            " ".join(labels): {"n": bot.DB_SECONDS.count(*labels),
+                               "p99_ms": round(bot.DB_SECONDS.quantile(0.99, *labels) * 1000, 2),
+                               "total_ms": round(bot.DB_SECONDS.total(*labels) * 1000, 1)}
+            for labels in sorted(bot.DB_SECONDS.series, key=lambda l: -bot.DB_SECONDS.total(*l))[:10]
+        },
+        "update_outcomes": outcomes,
+        "telegram_calls": fake_tg.calls,
+        "yookassa_requests": fake_yk.requests,
+    }
+
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel()
+    await bot.on_shutdown(bot.dp)
+    await (await bot.bot.get_session()).close()
+    await yk_runner.cleanup()
+    return report
+
+
+def print_report(report):
+    print(f"{report['updates']} updates in {report['elapsed_s']}s: {report['throughput_ups']} updates/s, "
+          f"{report['buyers_per_s']} buyers/s")
+    print(f"{'scenario':<15}{'n':>7}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, s in report["scenarios"].items():
+        print(f"{name:<15}{s['n']:>7}{s['p50_ms']:>10}{s['p99_ms']:>10}")
+    lag = report["loop_lag_ms"]
+    print(f"event loop lag: p50 {lag['p50']} ms, p99 {lag['p99']} ms, max {lag['max']} ms")
+    print("DB (by total time, executor queueing included):")
+    for stmt, s in report["db"].items():
+        print(f"  {stmt:<40} n={s['n']:<6} p99={s['p99_ms']} ms total={s['total_ms']} ms")
+    print("update outcomes: " + ", ".join(f"{k}={v}" for k, v in sorted(report["update_outcomes"].items())))
+    print(f"Telegram calls: {report['telegram_calls']}, YooKassa requests: {report['yookassa_requests']}")
+
+
+def compare(report, baseline, tolerance) -> list:
+    regressions = []
+    for name, s in report["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if base and base["p99_ms"] > 0 and s["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {base['p99_ms']} -> {s['p99_ms']} ms")
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_env(args)
+    import logging
+    logging.disable(logging.WARNING)
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print("REGRESSION", line, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,41 @@
 # bot.py
 import os
-import sqlite3
 import time
 import uuid
 import logging
 import asyncio
-import requests
-from datetime import datetime
+import bisect
+import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import ipaddress
+import json
+import re
+import shutil
+import socket
+import sqlite3
+import tempfile
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+from aiohttp import ClientError, web
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
 from aiogram.utils import executor
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.utils.exceptions import ChatNotFound, MessageNotModified, RetryAfter, TelegramAPIError, Unauthorized
+from callback_router import CallbackRouter
+from db import Database, split_sql
+from fsm_storage import SQLiteStorage
+from lease import Lease
+from metrics import Registry
+from update_scheduler import ScheduledDispatcher, SchedulerFull, UpdateScheduler
+from yookassa import YooKassaClient, YooKassaError, DEFAULT_API_BASE
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -26,23 +50,318 @@ MANAGER_CHAT_ID = os.getenv("MANAGER_CHAT_ID", "")  # numeric chat id менед
 MANAGER_USERNAME = os.getenv("MANAGER_USERNAME", "giftsmanage")  # default @giftsmanage
 TEST_MODE = os.getenv("TEST_MODE", "true").lower() in ("1", "true", "yes")
 DB_PATH = os.getenv("DB_PATH", "giftsfelix.db")
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+YOOKASSA_API_BASE = os.getenv("YOOKASSA_API_BASE", DEFAULT_API_BASE)  # для локального fake_yookassa.py
+YOOKASSA_TIMEOUT = float(os.getenv("YOOKASSA_TIMEOUT", "10"))
+# HTTP-уведомления ЮKassa (payment.succeeded / payment.waiting_for_capture); порт 0 = выключено
+YOOKASSA_NOTIFY_HOST = os.getenv("YOOKASSA_NOTIFY_HOST", "0.0.0.0")
+YOOKASSA_NOTIFY_PORT = int(os.getenv("YOOKASSA_NOTIFY_PORT", "0"))
+YOOKASSA_NOTIFY_PATH = os.getenv("YOOKASSA_NOTIFY_PATH", "/yookassa/notify")
+YOOKASSA_NOTIFY_TRUST_PROXY = os.getenv("YOOKASSA_NOTIFY_TRUST_PROXY", "false").lower() in ("1", "true", "yes")
+# сколько своих прокси стоит перед ботом: адрес отправителя — тот, что дописал в X-Forwarded-For самый внешний из них
+YOOKASSA_NOTIFY_PROXY_HOPS = int(os.getenv("YOOKASSA_NOTIFY_PROXY_HOPS", "1" if YOOKASSA_NOTIFY_TRUST_PROXY else "0"))
+# https://yookassa.ru/developers/using-api/webhooks#ip
+YOOKASSA_NOTIFY_IPS = os.getenv("YOOKASSA_NOTIFY_IPS", "185.71.76.0/27,185.71.77.0/27,77.75.153.0/25,77.75.156.11,77.75.156.35,77.75.154.128/25,2a02:5180::/32")
+PAYMENT_POLL_INTERVAL = float(os.getenv("PAYMENT_POLL_INTERVAL", "6"))  # первая проверка нового заказа
+PAYMENT_RECONCILE_INTERVAL = float(os.getenv("PAYMENT_RECONCILE_INTERVAL", "300"))  # опрос-сверка, когда уведомления включены
+PAYMENT_POLL_MAX_INTERVAL = float(os.getenv("PAYMENT_POLL_MAX_INTERVAL", "600"))  # потолок экспоненциального backoff
+PAYMENT_ORDER_TTL = float(os.getenv("PAYMENT_ORDER_TTL", "86400"))  # неоплаченный заказ -> expired
+PAYMENT_CHECK_CONCURRENCY = int(os.getenv("PAYMENT_CHECK_CONCURRENCY", "10"))
+# "list" — сверка страницами GET /payments (число запросов ~ числу оплат), "per_order" — GET /payments/{id} на каждый заказ
+PAYMENT_RECONCILE_MODE = os.getenv("PAYMENT_RECONCILE_MODE", "list")
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # сообщений/с, лимит Telegram ~30
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "100"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "10"))
+ADMIN_DIGEST_WINDOW = float(os.getenv("ADMIN_DIGEST_WINDOW", "60"))  # окно сводки уведомлений, с
+ADMIN_DIGEST_THRESHOLD = int(os.getenv("ADMIN_DIGEST_THRESHOLD", "5"))  # событий за окно до перехода на сводку
+ADMIN_NOTIFY_RATE = float(os.getenv("ADMIN_NOTIFY_RATE", "1"))  # сообщений/с на одного админа
+FSM_TTL = float(os.getenv("FSM_TTL", "86400"))  # брошенные диалоги (скрин, /addgift) забываются через сутки
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1"))
+FSM_MAX_CACHED = int(os.getenv("FSM_MAX_CACHED", "10000"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "100000"))
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "2"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Prometheus /metrics; 0 = выключено
+BUY_RATE = float(os.getenv("BUY_RATE", "0.2"))  # нажатий «Купить» в секунду на пользователя
+BUY_BURST = float(os.getenv("BUY_BURST", "3"))
+BUY_DEDUP_WINDOW = float(os.getenv("BUY_DEDUP_WINDOW", "900"))  # повторный «Купить» того же подарка -> тот же заказ
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "50"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+ORDER_ARCHIVE_AFTER_DAYS = float(os.getenv("ORDER_ARCHIVE_AFTER_DAYS", "30"))  # завершённые заказы старше -> orders_archive
+ORDER_ARCHIVE_BATCH = int(os.getenv("ORDER_ARCHIVE_BATCH", "200"))
+ORDER_ARCHIVE_INTERVAL = float(os.getenv("ORDER_ARCHIVE_INTERVAL", "3600"))
+CATALOG_VIEW = os.getenv("CATALOG_VIEW", "single")  # "single" — по одному подарку, "grid" — страница альбомом
+CATALOG_GRID_SIZE = max(2, min(10, int(os.getenv("CATALOG_GRID_SIZE", "6"))))  # в альбоме Telegram не больше 10 фото
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "60"))  # кэш результатов поиска/inline-запросов, с
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "30"))  # cache_time для Telegram в answerInlineQuery
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "32"))  # апдейты разных чатов параллельно, одного чата — по очереди
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "2000"))  # дальше — сброс листаний и пауза getUpdates
+# "polling" — один процесс с getUpdates, "webhook" — aiohttp-сервер; несколько экземпляров на одной БД
+RUN_MODE = os.getenv("RUN_MODE", "polling")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес балансировщика, напр. https://bot.example.com; пусто — setWebhook не вызываем
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # X-Telegram-Bot-Api-Secret-Token
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "")  # для локального fake_telegram.py
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+JOBS_LEASE_TTL = float(os.getenv("JOBS_LEASE_TTL", "15"))  # фоновые задачи переезжают на другой экземпляр за это время
+FSM_SHARED = os.getenv("FSM_SHARED", "true" if RUN_MODE == "webhook" else "false").lower() in ("1", "true", "yes")
+CATALOG_SYNC_INTERVAL = float(os.getenv("CATALOG_SYNC_INTERVAL", "5"))  # как часто замечать подарки, добавленные другим экземпляром
+OUTBOX_INTERVAL = float(os.getenv("OUTBOX_INTERVAL", "2"))  # опрос outbox: события с других экземпляров доставляются не позже
+PAYMENT_RELOAD_INTERVAL = float(os.getenv("PAYMENT_RELOAD_INTERVAL", "30"))  # подхват заказов, созданных другими экземплярами
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", "5"))
+EXPORT_PART_BYTES = int(os.getenv("EXPORT_PART_BYTES", str(45 * 1024 * 1024)))  # Telegram принимает от бота файлы до 50 МБ
+CALLBACK_SECRET = os.getenv("CALLBACK_SECRET", "")  # ключ подписи кнопок с id заказов; пусто — выводится из API_TOKEN
+# принимать кнопки старого формата ("buy:12"); кнопки с id заказов (paid, admin_confirm/decline) без подписи не принимаются никогда
+CALLBACK_LEGACY = os.getenv("CALLBACK_LEGACY", "true").lower() in ("1", "true", "yes")
 
 ADMINS = [int(x) for x in ADMINS.split(",") if x.strip().isdigit()]
+ADMIN_IDS = frozenset(ADMINS)
+# кто может подтверждать/отклонять заказы: админы и чат менеджера
+ORDER_MANAGER_IDS = ADMIN_IDS | ({int(MANAGER_CHAT_ID)} if MANAGER_CHAT_ID.isdigit() else set())
+YOOKASSA_NOTIFY_NETWORKS = [ipaddress.ip_network(x.strip()) for x in YOOKASSA_NOTIFY_IPS.split(",") if x.strip()]
 
 if not API_TOKEN:
     raise RuntimeError("API_TOKEN required in env")
 
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher(bot, storage=MemoryStorage())
+# ========== Metrics ==========
+metrics = Registry()
+HANDLER_SECONDS = metrics.histogram("bot_handler_seconds", "Update handler latency", ("kind", "handler"))
+UPDATES_TOTAL = metrics.counter("bot_updates_total", "Updates by kind and whether a handler took them", ("kind", "handled"))
+DB_SECONDS = metrics.histogram("bot_db_seconds", "SQLite call latency, executor queueing included", ("op", "statement"))
+YOOKASSA_SECONDS = metrics.histogram("bot_yookassa_seconds", "YooKassa API attempt latency", ("endpoint", "outcome"))
+THROTTLED_TOTAL = metrics.counter("bot_throttled_total", "Callbacks rejected by the per-user throttle", ("action",))
+BUY_DEDUP_TOTAL = metrics.counter("bot_buy_dedup_total", "buy: clicks answered with an existing open order")
+TELEGRAM_SECONDS = metrics.histogram("bot_telegram_seconds", "Telegram Bot API call latency", ("method", "outcome"))
+metrics.gauge("bot_payment_queue_depth", "Orders waiting in the payment scheduler", lambda: payment_scheduler.queue_depth)
+metrics.gauge("bot_payment_cycle_seconds", "Duration of the last payment check cycle", lambda: payment_scheduler.last_cycle_duration)
+metrics.gauge("bot_admin_notify_queue", "Queued admin notifications", lambda: admin_notifier.queue_size)
+metrics.gauge("bot_outbox_pending", "Undelivered outbox events", lambda: outbox.pending)
+metrics.gauge("bot_orders_archived", "Orders moved to orders_archive since start", lambda: order_archiver.archived_total)
+metrics.gauge("bot_update_queue_pending", "Updates waiting in the update scheduler", lambda: update_scheduler.pending)
+metrics.gauge("bot_update_worker_backlog", "Updates queued behind the chat each worker is running",
+              lambda: update_scheduler.worker_backlog(), ("worker",))
+metrics.counter("bot_updates_dropped_total", "Page-flip callbacks shed by the update scheduler", ("reason",),
+                fn=lambda: {(reason,): n for reason, n in update_scheduler.dropped.items()})
+metrics.gauge("bot_jobs_lease_held", "1 while this instance runs the singleton background jobs", lambda: int(jobs_lease.held))
+
+@functools.lru_cache(maxsize=512)
+def sql_label(sql: str) -> str:
+    """'SELECT ... FROM orders o ...' -> 'SELECT orders' (bounded label cardinality)"""
+    words = sql.split(None, 1)
+    verb = words[0].upper() if words else ""
+    m = re.search(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+(\w+)", sql, re.IGNORECASE)
+    return f"{verb} {m.group(1)}" if m else verb
+
+DB_FN_OPS = ("transaction", "scan")  # Database passes the function's name, not SQL, for these
+
+def observe_db(op: str, sql: str, seconds: float):
+    DB_SECONDS.observe(seconds, op, sql if op in DB_FN_OPS else sql_label(sql) if sql else "")
+
+def observe_yookassa(endpoint: str, outcome: str, seconds: float):
+    YOOKASSA_SECONDS.observe(seconds, endpoint, outcome)
+
+class InstrumentedBot(Bot):
+    async def get_updates(self, *args, **kwargs):
+        # backpressure: while the update scheduler is full, updates stay queued on Telegram's side
+        await update_scheduler.wait_capacity()
+        return await super().get_updates(*args, **kwargs)
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception as e:
+            outcome = e.__class__.__name__
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, method, outcome)
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Times the handler picked for each message / callback / inline query, labelled by its function name."""
+
+    async def _start(self, data: dict, name: str = None):
+        handler = current_handler.get(None)
+        data["_metrics_handler"] = name or getattr(handler, "__name__", "unknown")
+        data["_metrics_started"] = time.perf_counter()
+
+    def _finish(self, kind: str, data: dict):
+        started = data.get("_metrics_started")
+        if started is None:
+            UPDATES_TOTAL.inc(kind, "no")
+            return
+        UPDATES_TOTAL.inc(kind, "yes")
+        HANDLER_SECONDS.observe(time.perf_counter() - started, kind, data["_metrics_handler"])
+
+    async def on_process_message(self, message, data):
+        await self._start(data)
+
+    async def on_post_process_message(self, message, results, data):
+        self._finish("message", data)
+
+    async def on_process_callback_query(self, callback_query, data):
+        # every callback goes through callbacks.dispatch; label by the handler it routes to
+        await self._start(data, callbacks.handler_name(callback_query.data))
+
+    async def on_post_process_callback_query(self, callback_query, results, data):
+        self._finish("callback_query", data)
+
+    async def on_process_inline_query(self, inline_query, data):
+        await self._start(data)
+
+    async def on_post_process_inline_query(self, inline_query, results, data):
+        self._finish("inline_query", data)
+
+metrics_runner = None
+
+async def metrics_handler(request: web.Request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server():
+    global metrics_runner
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    metrics_runner = web.AppRunner(app)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    log.info("Metrics on http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+
+bot = InstrumentedBot(token=API_TOKEN,
+                      server=TelegramAPIServer.from_base(TELEGRAM_API_BASE) if TELEGRAM_API_BASE else TELEGRAM_PRODUCTION)
+db = Database(DB_PATH, readers=DB_READERS)
+db.observer = observe_db
+dp = ScheduledDispatcher(bot, storage=SQLiteStorage(db, ttl=FSM_TTL, flush_interval=FSM_FLUSH_INTERVAL, max_cached=FSM_MAX_CACHED,
+                                                    shared=FSM_SHARED))
+dp.middleware.setup(HandlerTimingMiddleware())
+
+# ========== Callback data ==========
+# one handler for all inline buttons; payloads are typed, versioned and, where they carry order ids, signed
+callbacks = CallbackRouter(CALLBACK_SECRET.encode() if CALLBACK_SECRET else hashlib.sha256(b"callbacks:" + API_TOKEN.encode()).digest(),
+                           accept_legacy=CALLBACK_LEGACY)
+CB_GIFT = callbacks.schema("gift", "g", ("gift_id", int), droppable=True, legacy="gift")
+CB_PAGE = callbacks.schema("page", "p", ("position", int), droppable=True, legacy="page")
+CB_GRID = callbacks.schema("grid", "r", ("gift_id", int), droppable=True, legacy="grid")
+CB_FOUND = callbacks.schema("found", "f", ("gift_id", int))  # a /search result: opens the gift below the list
+CB_BUY = callbacks.schema("buy", "b", ("gift_id", int), legacy="buy")
+CB_PAID = callbacks.schema("paid", "d", ("order_id", int), signed=True)
+CB_CONFIRM = callbacks.schema("admin_confirm", "c", ("order_id", int), signed=True, allowed=ORDER_MANAGER_IDS)
+CB_DECLINE = callbacks.schema("admin_decline", "x", ("order_id", int), signed=True, allowed=ORDER_MANAGER_IDS)
+ORDER_FILTER_FIELDS = (("before_id", int), ("status", str), ("date_from", date), ("date_to", date))
+CB_MY_ORDERS = callbacks.schema("my_orders", "m", *ORDER_FILTER_FIELDS, droppable=True, legacy="mo")
+CB_LIST_ORDERS = callbacks.schema("list_orders", "l", *ORDER_FILTER_FIELDS, droppable=True, legacy="lo", allowed=ADMIN_IDS)
+dp.register_callback_query_handler(callbacks.dispatch)
+
+def is_page_flip(update: types.Update) -> bool:
+    """Paging callbacks are safe to drop: a newer click or the current page makes them moot."""
+    cq = update.callback_query
+    if cq is None:
+        return False
+    schema = callbacks.route(cq.data)
+    return schema is not None and schema.droppable
+
+async def answer_dropped(update: types.Update):
+    """A shed page flip still gets its callback answered, or the button spins until Telegram gives up."""
+    if update.callback_query is not None:
+        await bot.answer_callback_query(update.callback_query.id)
+
+update_scheduler = UpdateScheduler(dp, workers=UPDATE_WORKERS, max_pending=UPDATE_MAX_PENDING, droppable=is_page_flip,
+                                   on_drop=answer_dropped)
+dp.scheduler = update_scheduler
+yookassa = YooKassaClient(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY, api_base=YOOKASSA_API_BASE, timeout=YOOKASSA_TIMEOUT)
+yookassa.observer = observe_yookassa
 
 # ========== DB helpers ==========
-def db_connect():
-    return sqlite3.connect(DB_PATH)
+GIFTS_FTS_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS gifts_fts USING fts5(
+    name, description, content='gifts', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS gifts_fts_ai AFTER INSERT ON gifts BEGIN
+    INSERT INTO gifts_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+END;
+CREATE TRIGGER IF NOT EXISTS gifts_fts_ad AFTER DELETE ON gifts BEGIN
+    INSERT INTO gifts_fts(gifts_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+END;
+CREATE TRIGGER IF NOT EXISTS gifts_fts_au AFTER UPDATE OF name, description ON gifts BEGIN
+    INSERT INTO gifts_fts(gifts_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+    INSERT INTO gifts_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+END;
+INSERT INTO gifts_fts(gifts_fts) VALUES ('rebuild');
+"""
+
+def migrate_gifts_fts(conn):
+    """External-content FTS5 index over gifts, kept in sync by triggers (so /addgift and any other
+    INSERT/UPDATE/DELETE on gifts update it in the same transaction)."""
+    try:
+        conn.execute("SAVEPOINT gifts_fts")
+        for stmt in split_sql(GIFTS_FTS_SQL):
+            conn.execute(stmt)
+        conn.execute("RELEASE gifts_fts")
+    except sqlite3.OperationalError as e:
+        # SQLite built without FTS5: search_gifts() falls back to scanning the catalog snapshot
+        conn.execute("ROLLBACK TO gifts_fts")
+        conn.execute("RELEASE gifts_fts")
+        log.warning("Gift search index not created: %s", e)
+
+# Sales rollups: one row per (order creation day, gift) with counts of orders created, paid (currently paid or
+# further along), delivered and declined, and delivered revenue. Bucketing by creation day makes them a pure
+# function of the orders' current state, so the incremental deltas and a rebuild always agree.
+ROLLUP_PAID_STATUSES = ("paid_pending_confirmation", "confirmed", "delivered", "error")
+ROLLUP_UPSERT = (
+    "INSERT INTO sales_rollup (day, gift_id, created, paid, delivered, declined, revenue) VALUES (?, ?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT(day, gift_id) DO UPDATE SET created = created + excluded.created, paid = paid + excluded.paid, "
+    "delivered = delivered + excluded.delivered, declined = declined + excluded.declined, revenue = revenue + excluded.revenue")
+
+def rollup_delta(old: str, new: str, amount) -> tuple:
+    """(paid, delivered, declined, revenue) change when an order moves from old to new status (old None: created)."""
+    delivered = (new == "delivered") - (old == "delivered")
+    return ((new in ROLLUP_PAID_STATUSES) - (old in ROLLUP_PAID_STATUSES), delivered,
+            (new == "declined") - (old == "declined"), delivered * (amount or 0))
+
+def rollup_add(conn, created_at: str, gift_id: int, created: int, paid: int, delivered: int, declined: int, revenue: int):
+    if created or paid or delivered or declined or revenue:
+        conn.execute(ROLLUP_UPSERT, ((created_at or "")[:10], gift_id or 0, created, paid, delivered, declined, revenue))
 
-def init_db():
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.executescript("""
+def rebuild_rollups(conn) -> int:
+    """Recomputes sales_rollup from both order tables in the caller's write transaction. Rows are streamed off
+    the cursor and summed per (day, gift) in Python: no GROUP BY sorter over the whole history."""
+    totals = {}
+    for created_at, gift_id, status, amount in conn.execute(
+            "SELECT created_at, gift_id, status, amount FROM orders UNION ALL "
+            "SELECT created_at, gift_id, status, amount FROM orders_archive"):
+        key = ((created_at or "")[:10], gift_id or 0)
+        t = totals.get(key)
+        if t is None:
+            t = totals[key] = [0, 0, 0, 0, 0]
+        t[0] += 1
+        for i, d in enumerate(rollup_delta(None, status, amount), 1):
+            t[i] += d
+    conn.execute("DELETE FROM sales_rollup")
+    conn.executemany("INSERT INTO sales_rollup (day, gift_id, created, paid, delivered, declined, revenue) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?)", ((*key, *t) for key, t in totals.items()))
+    return len(totals)
+
+def migrate_sales_rollup(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS sales_rollup (
+        day TEXT NOT NULL,
+        gift_id INTEGER NOT NULL,
+        created INTEGER NOT NULL DEFAULT 0,
+        paid INTEGER NOT NULL DEFAULT 0,
+        delivered INTEGER NOT NULL DEFAULT 0,
+        declined INTEGER NOT NULL DEFAULT 0,
+        revenue INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, gift_id)
+    ) WITHOUT ROWID
+    """)
+    rebuild_rollups(conn)
+
+# (version, name, sql) — только добавлять в конец, применённые миграции не менять
+MIGRATIONS = [
+    (1, "base tables", """
     CREATE TABLE IF NOT EXISTS users (
         chat_id INTEGER PRIMARY KEY,
         first_name TEXT,
@@ -69,142 +388,333 @@ def init_db():
         created_at TEXT,
         updated_at TEXT
     );
-    """)
-    conn.commit()
-    conn.close()
-
-def db_exec(sql, params=(), fetch=False):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute(sql, params)
-    if fetch:
-        rows = cur.fetchall()
-        conn.commit()
-        conn.close()
-        return rows
-    conn.commit()
-    conn.close()
-    return None
+    """),
+    (2, "order indexes", """
+    CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status, id);
+    CREATE INDEX IF NOT EXISTS idx_orders_chat ON orders(chat_id, id);
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_local_invoice ON orders(local_invoice);
+    CREATE INDEX IF NOT EXISTS idx_orders_payment ON orders(payment_id);
+    """),
+    (3, "broadcast jobs", """
+    ALTER TABLE users ADD COLUMN active INTEGER NOT NULL DEFAULT 1;
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_chat_id INTEGER,
+        text TEXT,
+        status TEXT,
+        cursor INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT,
+        updated_at TEXT
+    );
+    """),
+    (4, "fsm states", """
+    CREATE TABLE IF NOT EXISTS fsm_states (
+        chat TEXT NOT NULL,
+        user TEXT NOT NULL,
+        state TEXT,
+        data TEXT,
+        bucket TEXT,
+        updated_at REAL,
+        PRIMARY KEY (chat, user)
+    );
+    CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at);
+    """),
+    (5, "order payment url", """
+    ALTER TABLE orders ADD COLUMN payment_url TEXT;
+    """),
+    (6, "outbox", """
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        order_id INTEGER,
+        payload TEXT NOT NULL DEFAULT '{}',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_at REAL NOT NULL,
+        created_at TEXT NOT NULL,
+        done_at TEXT,
+        last_error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(next_at) WHERE done_at IS NULL;
+    """),
+    (7, "order archive", """
+    CREATE TABLE IF NOT EXISTS orders_archive (
+        id INTEGER PRIMARY KEY,
+        chat_id INTEGER,
+        gift_id INTEGER,
+        status TEXT,
+        amount INTEGER,
+        local_invoice TEXT,
+        payment_id TEXT,
+        created_at TEXT,
+        updated_at TEXT,
+        payment_url TEXT,
+        archived_at TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_orders_archive_status ON orders_archive(status, id);
+    CREATE INDEX IF NOT EXISTS idx_orders_archive_chat ON orders_archive(chat_id, id);
+    CREATE INDEX IF NOT EXISTS idx_orders_archive_payment ON orders_archive(payment_id);
+    """),
+    (8, "gift search index", migrate_gifts_fts),
+    (9, "sync state", """
+    CREATE TABLE IF NOT EXISTS sync_state (
+        key TEXT PRIMARY KEY,
+        value TEXT,
+        updated_at TEXT
+    );
+    """),
+    (10, "job leases and catalog version", """
+    CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL,
+        heartbeat_at REAL NOT NULL
+    );
+    CREATE TRIGGER IF NOT EXISTS gifts_version_ai AFTER INSERT ON gifts BEGIN
+        INSERT INTO sync_state (key, value, updated_at) VALUES ('catalog_version', '1', strftime('%Y-%m-%dT%H:%M:%f', 'now'))
+        ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1, updated_at = excluded.updated_at;
+    END;
+    CREATE TRIGGER IF NOT EXISTS gifts_version_au AFTER UPDATE ON gifts BEGIN
+        INSERT INTO sync_state (key, value, updated_at) VALUES ('catalog_version', '1', strftime('%Y-%m-%dT%H:%M:%f', 'now'))
+        ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1, updated_at = excluded.updated_at;
+    END;
+    CREATE TRIGGER IF NOT EXISTS gifts_version_ad AFTER DELETE ON gifts BEGIN
+        INSERT INTO sync_state (key, value, updated_at) VALUES ('catalog_version', '1', strftime('%Y-%m-%dT%H:%M:%f', 'now'))
+        ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1, updated_at = excluded.updated_at;
+    END;
+    """),
+    (11, "sales rollups", migrate_sales_rollup),
+]
+
+
+async def init_db():
+    global gifts_fts_available
+    await db.migrate(MIGRATIONS)
+    await db.execute("PRAGMA optimize")
+    gifts_fts_available = await db.fetchone("SELECT 1 FROM sqlite_master WHERE name = 'gifts_fts'") is not None
 
 # ========== Bootstrap sample gifts ==========
-def ensure_sample_gifts():
-    rows = db_exec("SELECT id FROM gifts LIMIT 1", fetch=True)
-    if not rows:
-        now = datetime.utcnow().isoformat()
-        db_exec("INSERT INTO gifts (name, price, description, image_file_id, created_at) VALUES (?, ?, ?, ?, ?)",
-                ("NFT Котик", 500, "Милый NFT котик — цифровой подарок", None, now))
-        db_exec("INSERT INTO gifts (name, price, description, image_file_id, created_at) VALUES (?, ?, ?, ?, ?)",
-                ("NFT Машина", 1200, "Коллекционная машина", None, now))
+async def ensure_sample_gifts():
+    def _insert(conn, now):
+        # check and insert under one write lock: instances starting together add the samples once
+        if conn.execute("SELECT id FROM gifts LIMIT 1").fetchone():
+            return False
+        conn.executemany("INSERT INTO gifts (name, price, description, image_file_id, created_at) VALUES (?, ?, ?, ?, ?)",
+                         [("NFT Котик", 500, "Милый NFT котик — цифровой подарок", None, now),
+                          ("NFT Машина", 1200, "Коллекционная машина", None, now)])
+        return True
+
+    if await db.fetchone("SELECT id FROM gifts LIMIT 1"):
+        return
+    if await db.transaction(_insert, datetime.utcnow().isoformat()):
+        catalog.invalidate()
         log.info("Sample gifts inserted")
 
 # ========== YooKassa helpers ==========
-YOOKASSA_API_BASE = "https://api.yookassa.ru/v3"
-
-def create_yookassa_payment(local_invoice_id: str, amount_rub: int, description: str):
-    """Returns (payment_id, confirmation_url, error_message)"""
-    if not (YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY):
+async def create_yookassa_payment(local_invoice_id: str, amount_rub: int, description: str):
+    """Returns (payment_id, confirmation_url, error_message). Circuit open -> error, caller falls back to demo link"""
+    if not yookassa.configured:
         return None, None, "YOOKASSA not configured"
-    url = f"{YOOKASSA_API_BASE}/payments"
-    headers = {"Idempotence-Key": local_invoice_id, "Content-Type": "application/json"}
-    body = {
-        "amount": {"value": f"{amount_rub:.2f}", "currency": "RUB"},
-        "payment_method_data": {"type": "bank_card"},
-        "confirmation": {"type": "redirect", "return_url": RETURN_URL or "https://t.me/"},
-        "description": description
-    }
     try:
-        resp = requests.post(url, json=body, headers=headers, auth=(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY), timeout=10)
-        if resp.status_code not in (200, 201):
-            log.warning("YooKassa create payment failed: %s %s", resp.status_code, resp.text[:300])
-            return None, None, f"YooKassa error {resp.status_code}"
-        data = resp.json()
-        payment_id = data.get("id")
-        confirmation = data.get("confirmation") or {}
-        confirmation_url = confirmation.get("confirmation_url")
-        return payment_id, confirmation_url, None
-    except Exception as e:
-        log.exception("create_yookassa_payment failed")
+        data = await yookassa.create_payment(local_invoice_id, amount_rub, description, RETURN_URL or "https://t.me/")
+    except YooKassaError as e:
+        log.warning("create_yookassa_payment failed: %s", e)
         return None, None, str(e)
+    payment_id = data.get("id")
+    confirmation = data.get("confirmation") or {}
+    confirmation_url = confirmation.get("confirmation_url")
+    return payment_id, confirmation_url, None
 
-def get_yookassa_payment(payment_id: str):
-    if not (YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY):
+async def get_yookassa_payment(payment_id: str):
+    if not yookassa.configured:
         return None
-    url = f"{YOOKASSA_API_BASE}/payments/{payment_id}"
     try:
-        resp = requests.get(url, auth=(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY), timeout=10)
-        if resp.status_code != 200:
-            log.warning("YooKassa get payment %s -> %s", payment_id, resp.status_code)
-            return None
-        return resp.json()
-    except Exception as e:
-        log.exception("get_yookassa_payment failed")
+        return await yookassa.get_payment(payment_id)
+    except YooKassaError as e:
+        log.warning("get_yookassa_payment %s failed: %s", payment_id, e)
         return None
 
 # ========== Orders / gifts helpers ==========
-def create_order(chat_id: int, gift_id: int, amount: int):
+async def create_order(chat_id: int, gift_id: int, amount: int):
     local_invoice = f"inv_{int(time.time())}_{uuid.uuid4().hex[:8]}"
     now = datetime.utcnow().isoformat()
-    db_exec("INSERT INTO orders (chat_id, gift_id, status, amount, local_invoice, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (chat_id, gift_id, "pending", amount, local_invoice, now, now))
-    row = db_exec("SELECT id FROM orders WHERE local_invoice = ?", (local_invoice,), fetch=True)
-    return row[0][0], local_invoice
 
-def set_order_payment(order_id: int, payment_id: str):
-    db_exec("UPDATE orders SET payment_id = ?, status = ?, updated_at = ? WHERE id = ?",
-            (payment_id, "payment_created", datetime.utcnow().isoformat(), order_id))
+    def _insert(conn):
+        cur = conn.execute("INSERT INTO orders (chat_id, gift_id, status, amount, local_invoice, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (chat_id, gift_id, "pending", amount, local_invoice, now, now))
+        rollup_add(conn, now, gift_id, 1, *rollup_delta(None, "pending", amount))
+        return cur.lastrowid
+    return await db.transaction(_insert), local_invoice
 
-def set_order_status(order_id: int, status: str):
-    db_exec("UPDATE orders SET status = ?, updated_at = ? WHERE id = ?",
-            (status, datetime.utcnow().isoformat(), order_id))
+async def set_order_payment(order_id: int, payment_id: str, payment_url: str = None):
+    await db.execute("UPDATE orders SET payment_id = ?, payment_url = ?, status = ?, updated_at = ? WHERE id = ? AND status = 'pending'",
+                     (payment_id, payment_url, "payment_created", datetime.utcnow().isoformat(), order_id))
 
-def get_order(order_id: int):
-    rows = db_exec("SELECT id, chat_id, gift_id, status, amount, local_invoice, payment_id FROM orders WHERE id = ?", (order_id,), fetch=True)
-    return rows[0] if rows else None
+async def find_open_order(chat_id: int, gift_id: int):
+    """Recent unpaid order for the same gift: (id, amount, payment_url, local_invoice) or None. payment_url is
+    None for demo orders (no YooKassa, or creating the payment failed) and orders still pending."""
+    since = (datetime.utcnow() - timedelta(seconds=BUY_DEDUP_WINDOW)).isoformat()
+    return await db.fetchone(
+        "SELECT id, amount, payment_url, local_invoice FROM orders WHERE chat_id = ? AND gift_id = ? "
+        "AND status IN ('pending', 'payment_created') AND created_at >= ? ORDER BY id DESC LIMIT 1",
+        (chat_id, gift_id, since))
 
-def get_pending_orders():
-    return db_exec("SELECT id, payment_id, local_invoice FROM orders WHERE status IN ('payment_created','pending')", fetch=True)
+def demo_payment_link(local_invoice: str) -> str:
+    return f"https://example.com/pay?invoice={local_invoice}"
 
-def get_gifts_count():
-    rows = db_exec("SELECT COUNT(*) FROM gifts", fetch=True)
-    return rows[0][0] if rows else 0
+# target status -> statuses it may be entered from
+ORDER_TRANSITIONS = {
+    "payment_created": ("pending",),
+    "paid_pending_confirmation": ("pending", "payment_created"),
+    "confirmed": ("pending", "payment_created", "paid_pending_confirmation", "expired", "error"),
+    "declined": ("pending", "payment_created", "paid_pending_confirmation", "expired"),
+    "expired": ("pending", "payment_created"),
+    "delivered": ("confirmed",),
+    "error": ("confirmed",),
+}
 
-def get_gift_by_index(index: int):
-    rows = db_exec("SELECT id, name, price, description, image_file_id FROM gifts ORDER BY id LIMIT 1 OFFSET ?", (index,), fetch=True)
-    return rows[0] if rows else None
+def _outbox_rows(order_id: int, chat_id: int, events, now: float):
+    created = datetime.utcnow().isoformat()
+    for kind, payload in events:
+        payload = dict(payload)
+        if "text" in payload:
+            payload["text"] = payload["text"].replace("{order_id}", str(order_id)).replace("{chat_id}", str(chat_id))
+        payload.setdefault("chat_id", chat_id)
+        yield kind, order_id, json.dumps(payload, ensure_ascii=False), now, created
 
-def get_gift_by_id(gid: int):
-    rows = db_exec("SELECT id, name, price, description, image_file_id FROM gifts WHERE id = ?", (gid,), fetch=True)
-    return rows[0] if rows else None
+def apply_transition(conn, order_id: int, status: str, events=()) -> bool:
+    """CAS status change plus its outbox rows and sales rollup delta, on a connection that is already inside
+    a (write) transaction, so the status read here cannot change before the UPDATE."""
+    row = conn.execute("SELECT status, chat_id, gift_id, amount, created_at FROM orders WHERE id = ?", (order_id,)).fetchone()
+    if row is None or row[0] not in ORDER_TRANSITIONS[status]:
+        return False
+    old, chat_id, gift_id, amount, created_at = row
+    cur = conn.execute("UPDATE orders SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+                       (status, datetime.utcnow().isoformat(), order_id, old))
+    if cur.rowcount != 1:
+        return False
+    rollup_add(conn, created_at, gift_id, 0, *rollup_delta(old, status, amount))
+    if events:
+        conn.executemany("INSERT INTO outbox (kind, order_id, payload, next_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                         _outbox_rows(order_id, chat_id, events, time.time()))
+    return True
+
+async def transition_order(order_id: int, status: str, events=(), done_event: int = None) -> bool:
+    """
+    Compare-and-set status change. Only the caller that wins the UPDATE gets True, and its `events`
+    ((kind, payload) pairs, see OutboxDispatcher) are written to the outbox in the same transaction,
+    so side effects happen once per transition and survive a crash. "{order_id}" / "{chat_id}" in a
+    payload's text are filled in. `done_event` closes the outbox row that triggered this transition.
+    """
+    def _transition(conn):
+        if done_event is not None:
+            conn.execute("UPDATE outbox SET done_at = ? WHERE id = ?", (datetime.utcnow().isoformat(), done_event))
+        return apply_transition(conn, order_id, status, events)
+
+    changed = await db.transaction(_transition)
+    if changed and events:
+        outbox.wake()
+    return changed
+
+async def confirm_order(order_id: int) -> bool:
+    return await transition_order(order_id, "confirmed", [("deliver", {})])
+
+async def get_order(order_id: int):
+    row = await db.fetchone("SELECT id, chat_id, gift_id, status, amount, local_invoice, payment_id FROM orders WHERE id = ?", (order_id,))
+    if row is None:
+        row = await db.fetchone("SELECT id, chat_id, gift_id, status, amount, local_invoice, payment_id FROM orders_archive WHERE id = ?", (order_id,))
+    return row
+
+ORDER_STATUSES = ("pending", "payment_created", "paid_pending_confirmation", "confirmed",
+                  "delivered", "declined", "expired", "error")
+TERMINAL_STATUSES = ("delivered", "declined", "expired", "error")
+# active orders and the archive of old finished ones; history views read both
+ORDER_TABLES = ("orders", "orders_archive")
+
+def parse_order_filters(args: str):
+    """"[status] [YYYY-MM-DD [YYYY-MM-DD]]" -> (status, date_from, date_to); raises ValueError on junk"""
+    status = date_from = date_to = None
+    for tok in (args or "").split():
+        if tok in ORDER_STATUSES and status is None:
+            status = tok
+            continue
+        d = datetime.strptime(tok.replace("-", ""), "%Y%m%d").date()
+        if date_from is None:
+            date_from = d
+        elif date_to is None:
+            date_to = d
+        else:
+            raise ValueError(tok)
+    return status, date_from, date_to
+
+async def get_orders_page(chat_id: int = None, status: str = None, date_from=None, date_to=None,
+                          before_id: int = None, limit: int = 20):
+    """One JOIN query per order table, keyset-paginated by id (newest first) and merged.
+    Returns (rows, has_more); rows are (id, chat_id, amount, status, created_at, gift_name)."""
+    where, params = [], []
+    if chat_id is not None:
+        where.append("o.chat_id = ?")
+        params.append(chat_id)
+    if status:
+        where.append("o.status = ?")
+        params.append(status)
+    if date_from:
+        where.append("o.created_at >= ?")
+        params.append(date_from.isoformat())
+    if date_to:
+        where.append("o.created_at < ?")
+        params.append((date_to + timedelta(days=1)).isoformat())
+    if before_id:
+        where.append("o.id < ?")
+        params.append(before_id)
+    if status and status not in TERMINAL_STATUSES:
+        tables = ORDER_TABLES[:1]
+    else:
+        tables = ORDER_TABLES
+    sql = ("SELECT o.id, o.chat_id, o.amount, o.status, o.created_at, g.name FROM {} o "
+           "LEFT JOIN gifts g ON g.id = o.gift_id "
+           + ("WHERE " + " AND ".join(where) + " " if where else "")
+           + "ORDER BY o.id DESC LIMIT ?")
+    parts = await asyncio.gather(*(db.fetchall(sql.format(table), (*params, limit + 1)) for table in tables))
+    rows = sorted((r for part in parts for r in part), key=lambda r: r[0], reverse=True)
+    return rows[:limit], len(rows) > limit
+
+async def get_order_id_by_payment(payment_id: str):
+    row = await db.fetchone("SELECT id FROM orders WHERE payment_id = ?", (payment_id,))
+    return row[0] if row else None
+
+async def get_pending_orders():
+    return await db.fetchall("SELECT id, payment_id, local_invoice, created_at FROM orders WHERE status IN ('payment_created','pending')")
+
+async def get_gift_by_id(gid: int):
+    snap = await catalog.get()
+    return snap.by_id(gid)
 
 def save_user(message: types.Message):
-    db_exec("INSERT OR REPLACE INTO users (chat_id, first_name, last_name, username, created_at) VALUES (?, ?, ?, ?, ?)",
-            (message.from_user.id, message.from_user.first_name or "", message.from_user.last_name or "", message.from_user.username or "", datetime.utcnow().isoformat()))
+    user_registry.touch(message.from_user)
 
-def notify_admins_text(text: str, buttons: list = None):
-    """Send text to ADMINS with optional inline buttons (list of (text,url))"""
-    kb = None
-    if buttons:
-        kb = types.InlineKeyboardMarkup()
-        for t,u in buttons:
-            kb.add(types.InlineKeyboardButton(t, url=u))
-    for adm in ADMINS:
-        try:
-            bot.send_message(adm, text, reply_markup=kb, disable_web_page_preview=True)
-        except Exception as e:
-            log.warning("Notify admin failed %s: %s", adm, e)
+def notify_admins_text(text: str, buttons: list = None, kind: str = None):
+    """Queue text for ADMINS with optional inline buttons (list of (text,url)); never blocks the handler"""
+    admin_notifier.submit(text, buttons, kind)
 
-def notify_admins_order_created(order_id: int):
-    o = get_order(order_id)
+async def notify_admins_order_created(order_id: int):
+    o = await get_order(order_id)
     if not o:
         return
     oid, chat_id, gift_id, status, amount, local_invoice, payment_id = o
-    gift = get_gift_by_id(gift_id)
+    gift = await get_gift_by_id(gift_id)
     gname = gift[1] if gift else "—"
     # buyer info
-    user_rows = db_exec("SELECT username, first_name FROM users WHERE chat_id = ?", (chat_id,), fetch=True)
-    if user_rows:
-        username = user_rows[0][0]
-        first = user_rows[0][1]
+    pending = user_registry.pending_profile(chat_id)  # not flushed yet
+    if pending:
+        user_row = (pending[2], pending[0])
+    else:
+        user_row = await db.fetchone("SELECT username, first_name FROM users WHERE chat_id = ?", (chat_id,))
+    if user_row:
+        username = user_row[0]
+        first = user_row[1]
     else:
         username = None
         first = ""
@@ -215,7 +725,384 @@ def notify_admins_order_created(order_id: int):
         contact_url = f"tg://user?id={chat_id}"
     text = f"Новый заказ #{oid}\nПодарок: {gname}\nСумма: {amount}₽\nПокупатель: {first} (id: {chat_id})"
     buttons = [("Написать покупателю", contact_url)]
-    notify_admins_text(text, buttons)
+    notify_admins_text(text, buttons, kind="order")
+
+# ========== Rate limiting ==========
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        if time.monotonic() < self.paused_until:
+            return False
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1):
+        while not self.try_acquire(tokens):
+            wait = max(self.paused_until - time.monotonic(), (tokens - self.tokens) / self.rate)
+            await asyncio.sleep(max(wait, 0.001))
+
+    def pause(self, seconds: float):
+        """Stops handing out tokens for `seconds` (Telegram RetryAfter)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+class BuyThrottleMiddleware(BaseMiddleware):
+    """Per-user token bucket in front of buy: callbacks; clicks over the limit are answered and dropped
+    before any handler, DB or YooKassa work."""
+
+    def __init__(self, rate: float, burst: float, max_users: int = 10000):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.buckets = OrderedDict()  # user id -> TokenBucket, LRU
+
+    def _bucket(self, user_id: int) -> TokenBucket:
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = TokenBucket(self.rate, self.burst)
+            if len(self.buckets) > self.max_users:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(user_id)
+        return bucket
+
+    async def on_pre_process_callback_query(self, callback_q: types.CallbackQuery, data: dict):
+        if callbacks.route(callback_q.data) is not CB_BUY:
+            return
+        if not self._bucket(callback_q.from_user.id).try_acquire():
+            THROTTLED_TOTAL.inc("buy")
+            await callback_q.answer("Слишком часто. Подождите несколько секунд.")
+            raise CancelHandler()
+
+dp.middleware.setup(BuyThrottleMiddleware(BUY_RATE, BUY_BURST))
+
+# ========== Admin notifications ==========
+DIGEST_LABELS = {
+    "order": "Новые заказы",
+    "paid": "Оплаты",
+    "screenshot": "Скрины оплаты",
+    "delivered": "Доставки",
+}
+
+class AdminNotifier:
+    """Queue + worker for admin notifications. Up to `threshold` events per `window` seconds go out one by
+    one; past that, events are buffered and sent as one digest per admin when the window closes."""
+
+    def __init__(self, admins, window: float, threshold: int, rate: float, maxsize: int = 1000):
+        self.admins = list(admins)
+        self.window = window
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.buckets = {adm: TokenBucket(rate, capacity=3) for adm in self.admins}
+        self._queue = None
+        self._task = None
+        self._window_start = 0.0
+        self._window_count = 0
+        self._digest = {}  # kind -> [first lines]
+        self.dropped = 0
+
+    def _ensure_queue(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.maxsize)
+        return self._queue
+
+    @property
+    def queue_size(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def submit(self, text: str, buttons: list = None, kind: str = None):
+        if not self.admins:
+            return
+        try:
+            self._ensure_queue().put_nowait((kind, text, buttons))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            log.warning("Admin notification queue full, dropped: %s", text[:80])
+
+    def start(self):
+        self._ensure_queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self._flush_digest()
+
+    async def _send(self, adm: int, text: str, kb=None):
+        for _ in range(3):
+            await self.buckets[adm].acquire()  # after a RetryAfter, waits out e.timeout first
+            try:
+                await bot.send_message(adm, text, reply_markup=kb, disable_web_page_preview=True)
+                return
+            except RetryAfter as e:
+                log.warning("Notify admin %s RetryAfter %ss", adm, e.timeout)
+                self.buckets[adm].pause(e.timeout)
+            except TelegramAPIError as e:
+                log.warning("Notify admin failed %s: %s", adm, e)
+                return
+        self.dropped += 1
+        log.warning("Admin notification to %s dropped after repeated RetryAfter: %s", adm, text[:80])
+
+    async def _broadcast(self, text: str, kb=None):
+        await asyncio.gather(*(self._send(adm, text, kb) for adm in self.admins))
+
+    async def _flush_digest(self):
+        if not self._digest:
+            return
+        digest, self._digest = self._digest, {}
+        parts = [f"Сводка за последние {self.window:g} с:"]
+        for kind, lines in digest.items():
+            parts.append(f"\n{DIGEST_LABELS.get(kind, 'События')}: {len(lines)}")
+            parts.extend(f"• {line}" for line in lines[:5])
+            if len(lines) > 5:
+                parts.append(f"… и ещё {len(lines) - 5}")
+        await self._broadcast("\n".join(parts)[:4000])
+
+    async def _run(self):
+        queue = self._queue
+        while True:
+            timeout = None
+            if self._digest:
+                timeout = max(0.0, self._window_start + self.window - time.monotonic())
+            try:
+                kind, text, buttons = await asyncio.wait_for(queue.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                kind = None
+                text = None
+            now = time.monotonic()
+            if now - self._window_start >= self.window:
+                await self._flush_digest()
+                self._window_start = now
+                self._window_count = 0
+            if text is None:
+                continue
+            self._window_count += 1
+            if self._window_count <= self.threshold:
+                kb = None
+                if buttons:
+                    kb = types.InlineKeyboardMarkup()
+                    for t, u in buttons:
+                        kb.add(types.InlineKeyboardButton(t, url=u))
+                await self._broadcast(text, kb)
+            else:
+                self._digest.setdefault(kind, []).append(text.split("\n", 1)[0])
+
+admin_notifier = AdminNotifier(ADMINS, ADMIN_DIGEST_WINDOW, ADMIN_DIGEST_THRESHOLD, ADMIN_NOTIFY_RATE)
+
+# ========== User registry ==========
+class UserRegistry:
+    """LRU of chat_id -> profile hash. Unchanged users cost a dict lookup; new or changed profiles are
+    buffered and written by flush() as one batched upsert that keeps the original created_at."""
+
+    def __init__(self, max_size: int, flush_interval: float):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._known = OrderedDict()
+        self._pending = {}  # chat_id -> (first_name, last_name, username, seen_at)
+        self._task = None
+
+    def touch(self, user: types.User):
+        profile = (user.first_name or "", user.last_name or "", user.username or "")
+        h = hash(profile)
+        if self._known.get(user.id) == h:
+            self._known.move_to_end(user.id)
+            return
+        self._known[user.id] = h
+        self._known.move_to_end(user.id)
+        if len(self._known) > self.max_size:
+            self._known.popitem(last=False)
+        self._pending[user.id] = (*profile, datetime.utcnow().isoformat())
+
+    def forget(self, chat_id: int):
+        """Next message from chat_id is written again (e.g. to flip users.active back on)."""
+        self._known.pop(chat_id, None)
+
+    def pending_profile(self, chat_id: int):
+        return self._pending.get(chat_id)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        rows = [(cid, first, last, username, seen) for cid, (first, last, username, seen) in pending.items()]
+        try:
+            await db.executemany(
+                "INSERT INTO users (chat_id, first_name, last_name, username, created_at, active) VALUES (?, ?, ?, ?, ?, 1) "
+                "ON CONFLICT(chat_id) DO UPDATE SET first_name = excluded.first_name, last_name = excluded.last_name, "
+                "username = excluded.username, active = 1", rows)
+        except Exception:
+            for cid, profile in pending.items():
+                self._pending.setdefault(cid, profile)
+            raise
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("User registry flush failed")
+
+    def start(self):
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+user_registry = UserRegistry(USER_CACHE_SIZE, USER_FLUSH_INTERVAL)
+
+# ========== Catalog cache ==========
+class CatalogSnapshot:
+    """Immutable view of the gifts table: rows ordered by id plus an id -> position index."""
+    __slots__ = ("version", "gifts", "ids", "pos", "pages", "grids")
+
+    def __init__(self, version: int, gifts):
+        self.version = version
+        self.gifts = tuple(gifts)
+        self.ids = [g[0] for g in self.gifts]
+        self.pos = {gid: i for i, gid in enumerate(self.ids)}
+        self.pages = {}  # index -> rendered (caption, kb, image_file_id); dies with the snapshot
+        self.grids = {}  # (page size, page number) -> rendered grid page
+
+    def __len__(self):
+        return len(self.gifts)
+
+    def by_id(self, gid: int):
+        i = self.pos.get(gid)
+        return self.gifts[i] if i is not None else None
+
+    def position(self, gid: int) -> int:
+        """Position of gid, or of the nearest following gift if it was removed (cursor semantics)"""
+        i = self.pos.get(gid)
+        if i is None:
+            i = min(bisect.bisect_left(self.ids, gid), len(self.ids) - 1)
+        return max(i, 0)
+
+class Catalog:
+    def __init__(self):
+        self._snapshot = None
+        self._version = 0
+        self._lock = None
+
+    async def get(self) -> CatalogSnapshot:
+        snap = self._snapshot
+        if snap is not None:
+            return snap
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._snapshot is None:
+                version = self._version
+                rows = await db.fetchall("SELECT id, name, price, description, image_file_id FROM gifts ORDER BY id")
+                snap = CatalogSnapshot(version, rows)
+                if version == self._version:  # not invalidated while loading
+                    self._snapshot = snap
+                return snap
+            return self._snapshot
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def invalidate(self):
+        self._version += 1
+        self._snapshot = None
+
+catalog = Catalog()
+
+async def catalog_sync():
+    """Triggers on gifts bump sync_state 'catalog_version' on every change, whichever instance made it;
+    dropping the snapshot when it moves keeps every instance's catalog and search cache current."""
+    seen = await load_sync_state("catalog_version")
+    while True:
+        await asyncio.sleep(CATALOG_SYNC_INTERVAL)
+        try:
+            version = await load_sync_state("catalog_version")
+        except Exception:
+            log.exception("Catalog version check failed")
+            continue
+        if version != seen:
+            seen = version
+            catalog.invalidate()
+
+# ========== Gift search ==========
+SEARCH_LIMIT = 50  # answerInlineQuery takes at most 50 results
+SEARCH_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+gifts_fts_available = False
+
+def fts_query(text: str) -> str:
+    """'кот рыж' -> '"кот"* AND "рыж"*': every word as a prefix, no FTS5 operators from user input"""
+    return " AND ".join(f'"{tok}"*' for tok in SEARCH_TOKEN_RE.findall(text.casefold()))
+
+class SearchCache:
+    """TTL cache of search results keyed by (catalog version, normalized query): inline queries arrive per
+    keystroke, so the same short prefixes repeat a lot; adding a gift bumps the version."""
+
+    def __init__(self, ttl: float, max_size: int = 2048):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None or item[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key, value):
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+        if len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+search_cache = SearchCache(SEARCH_CACHE_TTL)
+
+async def search_gifts(text: str, limit: int = SEARCH_LIMIT):
+    """Gift rows (id, name, price, description, image_file_id) best match first; empty query -> catalog head."""
+    normalized = " ".join(SEARCH_TOKEN_RE.findall(text.casefold()))
+    key = (catalog.version, normalized, limit)
+    rows = search_cache.get(key)
+    if rows is not None:
+        return rows
+    snap = await catalog.get()
+    if not normalized:
+        rows = snap.gifts[:limit]
+    elif gifts_fts_available:
+        # name matches weigh 10x description matches; rows come from the snapshot, not the table
+        hits = await db.fetchall("SELECT rowid FROM gifts_fts WHERE gifts_fts MATCH ? ORDER BY bm25(gifts_fts, 10.0, 1.0) LIMIT ?",
+                                 (fts_query(normalized), limit))
+        rows = tuple(g for g in (snap.by_id(r[0]) for r in hits) if g)
+    else:
+        words = normalized.split()
+        found = [g for g in snap.gifts if all(w in f"{g[1]} {g[3]}".casefold() for w in words)]
+        found.sort(key=lambda g: not all(w in (g[1] or "").casefold() for w in words))
+        rows = tuple(found[:limit])
+    search_cache.put(key, rows)
+    return rows
 
 # ========== FSMs ==========
 class UploadStates(StatesGroup):
@@ -235,58 +1122,133 @@ async def cmd_start(message: types.Message):
     kb.add("🛒 Купить подарок", "💼 Мои заказы")
     kb.row("💰 Продать свой подарок", "📜 Помощь")
     kb.add("⭐ Поделиться")
-    if message.from_user.id in ADMINS:
+    if message.from_user.id in ADMIN_IDS:
         kb.add("🛠️ Админ")
     await message.answer("Привет! Я GiftsFelix — магазин цифровых подарков. Выберите действие:", reply_markup=kb)
+    args = message.get_args()
+    if args.startswith("gift_") and args[5:].isdigit():
+        # deep link from an inline search result
+        snap = await catalog.get()
+        if snap.by_id(int(args[5:])):
+            await show_gift_page(message.chat.id, int(args[5:]))
 
 @dp.message_handler(lambda m: m.text == "📜 Помощь" or m.text == "/help")
 async def cmd_help(message: types.Message):
     text = (
         "📜 Команды и помощь\n\n"
         "🛒 Купить подарок — открыть каталог и купить\n"
+        "/grid — каталог страницами по несколько подарков\n"
         "💰 Продать свой подарок — инструкции, как отправить подарок менеджеру\n"
-        "💼 Мои заказы — список ваших заказов\n\n"
+        "💼 Мои заказы — список ваших заказов\n"
+        "/search <запрос> — найти подарок; в любом чате: @бот <запрос>\n\n"
         "Админ: /addgift — добавить подарок (пошагово)\n"
-        "/listorders — просмотреть заказы\n"
+        "/listorders [статус] [с] [по] — просмотреть заказы\n"
+        "/export [csv|json] [статус] [с] [по] — все заказы файлом .gz\n"
         "/confirm <order_id> — подтвердить и выслать подарок\n"
         "/decline <order_id> — отменить заказ\n"
+        "/watcher — очередь проверки оплат\n"
+        "/stats — время ответа обработчиков, БД и внешних API\n"
+        "/dashboard — продажи по дням и топ подарков; /rebuildrollups — пересчитать сводки\n"
     )
     await message.answer(text)
 
 # Catalog browsing with pagination
-@dp.message_handler(lambda m: m.text == "🛒 Купить подарок" or m.text == "/buy")
+@dp.message_handler(lambda m: m.text in ("🛒 Купить подарок", "/buy", "/grid"))
 async def cmd_buy(message: types.Message):
     save_user(message)
-    count = get_gifts_count()
-    if count == 0:
+    snap = await catalog.get()
+    if not snap:
         await message.answer("Пока нет доступных подарков.")
         return
-    await show_gift_page(message.chat.id, 0)
+    if CATALOG_VIEW == "grid" or message.text == "/grid":
+        await show_grid_page(message.chat.id, snap.ids[0])
+    else:
+        await show_gift_page(message.chat.id, snap.ids[0])
 
-async def show_gift_page(chat_id: int, index: int):
-    count = get_gifts_count()
-    if count == 0:
-        await bot.send_message(chat_id, "Пока нет подарков.")
-        return
-    if index < 0:
-        index = 0
-    if index >= count:
-        index = count - 1
-    g = get_gift_by_index(index)
-    if not g:
-        await bot.send_message(chat_id, "Ошибка при получении подарка.")
-        return
-    gid, name, price, descr, image_file_id = g
+def render_gift_page(snap: CatalogSnapshot, index: int):
+    page = snap.pages.get(index)
+    if page is not None:
+        return page
+    count = len(snap)
+    gid, name, price, descr, image_file_id = snap.gifts[index]
     caption = f"*{name}*\n{descr}\n\nЦена: {price}₽\n\n({index+1}/{count})"
     kb = types.InlineKeyboardMarkup()
-    kb.add(types.InlineKeyboardButton("Купить", callback_data=f"buy:{gid}"))
+    kb.add(types.InlineKeyboardButton("Купить", callback_data=callbacks.encode(CB_BUY, gid)))
     nav = []
     if index > 0:
-        nav.append(types.InlineKeyboardButton("⬅️ Назад", callback_data=f"page:{index-1}"))
+        nav.append(types.InlineKeyboardButton("⬅️ Назад", callback_data=callbacks.encode(CB_GIFT, snap.ids[index-1])))
     if index < count-1:
-        nav.append(types.InlineKeyboardButton("Вперед ➡️", callback_data=f"page:{index+1}"))
+        nav.append(types.InlineKeyboardButton("Вперед ➡️", callback_data=callbacks.encode(CB_GIFT, snap.ids[index+1])))
     if nav:
         kb.row(*nav)
+    kb.add(types.InlineKeyboardButton("▦ Все подарки страницей", callback_data=callbacks.encode(CB_GRID, gid)))
+    page = snap.pages[index] = (caption, kb, image_file_id)
+    return page
+
+def render_grid_page(snap: CatalogSnapshot, page_no: int, size: int = CATALOG_GRID_SIZE):
+    """A page of `size` gifts: (photos [(file_id, caption)], text, kb). Photos go out as one album, the numbered
+    list with one row of buy buttons per 5 gifts goes in a single message under it."""
+    key = (size, page_no)
+    page = snap.grids.get(key)
+    if page is not None:
+        return page
+    pages = (len(snap) + size - 1) // size
+    start = page_no * size
+    photos, lines = [], []
+    kb = types.InlineKeyboardMarkup(row_width=5)
+    buttons = []
+    for n, (gid, name, price, descr, image_file_id) in enumerate(snap.gifts[start:start + size], start + 1):
+        lines.append(f"{n}. *{name}* — {price}₽")
+        if image_file_id:
+            photos.append((image_file_id, f"{n}. {name} — {price}₽"))
+        buttons.append(types.InlineKeyboardButton(f"🛒 {n}", callback_data=callbacks.encode(CB_BUY, gid)))
+    kb.add(*buttons)
+    nav = []
+    if page_no > 0:
+        nav.append(types.InlineKeyboardButton("⬅️", callback_data=callbacks.encode(CB_GRID, snap.ids[start - size])))
+    nav.append(types.InlineKeyboardButton("🔍 По одному", callback_data=callbacks.encode(CB_GIFT, snap.ids[start])))
+    if page_no < pages - 1:
+        nav.append(types.InlineKeyboardButton("➡️", callback_data=callbacks.encode(CB_GRID, snap.ids[start + size])))
+    kb.row(*nav)
+    text = "\n".join(lines) + f"\n\nСтраница {page_no + 1}/{pages}. Нажмите 🛒 с номером подарка, чтобы купить."
+    page = snap.grids[key] = (tuple(photos), text, kb)
+    return page
+
+async def edit_gift_page(message: types.Message, caption: str, kb, image_file_id) -> bool:
+    """Edits a catalog message in place. False when the message can't take this page (photo <-> text)."""
+    try:
+        if image_file_id and message.photo:
+            media = types.InputMediaPhoto(image_file_id, caption=caption, parse_mode="Markdown")
+            await bot.edit_message_media(media, message.chat.id, message.message_id, reply_markup=kb)
+            return True
+        if not image_file_id and message.text:
+            await bot.edit_message_text(caption, message.chat.id, message.message_id, parse_mode="Markdown", reply_markup=kb)
+            return True
+    except MessageNotModified:
+        return True
+    except TelegramAPIError as e:
+        log.warning("edit catalog message failed: %s", e)
+        return False
+    # photo and text messages can't be converted into each other: replace the message
+    try:
+        await bot.delete_message(message.chat.id, message.message_id)
+    except TelegramAPIError as e:
+        log.warning("delete catalog message failed: %s", e)
+    return False
+
+async def show_gift_page(chat_id: int, gift_id: int, message: types.Message = None):
+    snap = await catalog.get()
+    count = len(snap)
+    if count == 0:
+        await bot.send_message(chat_id, "Пока нет подарков.")
+        return
+    # pages are addressed by gift id, so a cursor stays valid when gifts are added
+    index = snap.position(gift_id)
+    caption, kb, image_file_id = render_gift_page(snap, index)
+    if index < count-1:
+        render_gift_page(snap, index+1)  # prefetch: the next "Вперед" is served from cache
+    if message is not None and await edit_gift_page(message, caption, kb, image_file_id):
+        return
     # send photo if exists else text
     if image_file_id:
         try:
@@ -297,32 +1259,85 @@ async def show_gift_page(chat_id: int, index: int):
     else:
         await bot.send_message(chat_id, caption, parse_mode="Markdown", reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("page:"))
-async def cb_page(callback_q: types.CallbackQuery):
-    index = int(callback_q.data.split(":",1)[1])
-    await show_gift_page(callback_q.from_user.id, index)
+async def show_grid_page(chat_id: int, gift_id: int):
+    """One send_media_group for the page's photos plus one message with the list and buy buttons (a lone photo
+    carries the list itself), instead of a message per gift."""
+    snap = await catalog.get()
+    if not snap:
+        await bot.send_message(chat_id, "Пока нет подарков.")
+        return
+    page_no = snap.position(gift_id) // CATALOG_GRID_SIZE
+    photos, text, kb = render_grid_page(snap, page_no)
+    if (page_no + 1) * CATALOG_GRID_SIZE < len(snap):
+        render_grid_page(snap, page_no + 1)  # prefetch, like show_gift_page
+    try:
+        if len(photos) == 1:
+            await bot.send_photo(chat_id, photos[0][0], caption=text, parse_mode="Markdown", reply_markup=kb)
+            return
+        if photos:
+            media = types.MediaGroup()
+            for file_id, caption in photos:
+                media.attach_photo(file_id, caption=caption)
+            await bot.send_media_group(chat_id, media)
+    except TelegramAPIError as e:
+        log.warning("catalog album failed: %s", e)
+    await bot.send_message(chat_id, text, parse_mode="Markdown", reply_markup=kb)
+
+@callbacks.handler(CB_GRID)
+async def cb_grid(callback_q: types.CallbackQuery, gift_id: int):
+    await show_grid_page(callback_q.from_user.id, gift_id)
+    await bot.answer_callback_query(callback_q.id)
+
+@callbacks.handler(CB_GIFT)
+async def cb_page(callback_q: types.CallbackQuery, gift_id: int):
+    await show_gift_page(callback_q.from_user.id, gift_id, message=callback_q.message)
     await bot.answer_callback_query(callback_q.id)
 
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("buy:"))
-async def cb_buy(callback_q: types.CallbackQuery):
+@callbacks.handler(CB_PAGE)
+async def cb_page_position(callback_q: types.CallbackQuery, position: int):
+    # buttons sent before gift-id cursors carried a position
+    snap = await catalog.get()
+    if not snap:
+        await bot.answer_callback_query(callback_q.id, "Пока нет подарков.")
+        return
+    await cb_page(callback_q, snap.ids[max(0, min(position, len(snap) - 1))])
+
+@callbacks.handler(CB_BUY)
+async def cb_buy(callback_q: types.CallbackQuery, gid: int):
     chat_id = callback_q.from_user.id
-    gid = int(callback_q.data.split(":",1)[1])
-    gift = get_gift_by_id(gid)
+    gift = await get_gift_by_id(gid)
     if not gift:
         await bot.answer_callback_query(callback_q.id, "Подарок не найден.")
         return
     _, name, price, descr, img = gift
-    order_id, local_invoice = create_order(chat_id, gid, price)
+    existing = await find_open_order(chat_id, gid)
+    if existing:
+        # double click / redelivered callback: same order, same link, no new payment or admin notice
+        order_id, amount, confirmation_url, local_invoice = existing
+        BUY_DEDUP_TOTAL.inc()
+        kb = types.InlineKeyboardMarkup()
+        text = f"У вас уже есть неоплаченный заказ #{order_id} на «{name}» ({amount}₽). "
+        if confirmation_url:
+            kb.add(types.InlineKeyboardButton("Оплатить (ЮKassa)", url=confirmation_url))
+            text += "Ссылка для оплаты прежняя."
+        else:
+            text += f"Ссылка для оплаты (демо):\n{demo_payment_link(local_invoice)}"
+        kb.add(types.InlineKeyboardButton("Я оплатил — отправить скрин менеджеру", callback_data=callbacks.encode(CB_PAID, order_id)))
+        await bot.send_message(chat_id, text, reply_markup=kb)
+        await bot.answer_callback_query(callback_q.id, "Заказ уже создан, ссылка в чате.")
+        return
+    order_id, local_invoice = await create_order(chat_id, gid, price)
     # create YooKassa payment
-    payment_id, confirmation_url, err = create_yookassa_payment(local_invoice, price, f"Order #{order_id} - {name}")
+    payment_id, confirmation_url, err = await create_yookassa_payment(local_invoice, price, f"Order #{order_id} - {name}")
     if err:
         # fallback demo link
-        demo_link = f"https://example.com/pay?invoice={local_invoice}"
-        set_order_payment(order_id, payment_id or "")
+        demo_link = demo_payment_link(local_invoice)
+        await set_order_payment(order_id, payment_id or "")
+        payment_scheduler.add(order_id, payment_id, local_invoice)
         # notify admins
-        notify_admins_order_created(order_id)
+        await notify_admins_order_created(order_id)
         kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("Я оплатил — отправить скрин менеджеру", callback_data=f"paid:{order_id}"))
+        kb.add(types.InlineKeyboardButton("Я оплатил — отправить скрин менеджеру", callback_data=callbacks.encode(CB_PAID, order_id)))
         await bot.send_message(chat_id,
             f"Создан заказ #{order_id} на сумму {price}₽.\n\nСсылка для оплаты (демо):\n{demo_link}\n\n"
             f"*Чтобы получить подарок*: отправьте подтверждение оплаты (чек/скрин) менеджеру @{MANAGER_USERNAME} и нажмите кнопку «Я оплатил» — мы переслём скрин менеджеру для проверки.",
@@ -331,11 +1346,12 @@ async def cb_buy(callback_q: types.CallbackQuery):
         await bot.answer_callback_query(callback_q.id, "Заказ создан (демо). Ссылка в чате.")
         return
     # save payment_id
-    set_order_payment(order_id, payment_id)
-    notify_admins_order_created(order_id)
+    await set_order_payment(order_id, payment_id, confirmation_url)
+    payment_scheduler.add(order_id, payment_id, local_invoice)
+    await notify_admins_order_created(order_id)
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("Оплатить (ЮKassa)", url=confirmation_url))
-    kb.add(types.InlineKeyboardButton("Я оплатил — отправить скрин менеджеру", callback_data=f"paid:{order_id}"))
+    kb.add(types.InlineKeyboardButton("Я оплатил — отправить скрин менеджеру", callback_data=callbacks.encode(CB_PAID, order_id)))
     await bot.send_message(chat_id,
         f"Создан заказ #{order_id} на сумму {price}₽.\n\nПерейдите по кнопке для оплаты через ЮKassa.\n\n"
         f"*Чтобы получить подарок*: отправьте подтверждение оплаты (чек/скрин) менеджеру @{MANAGER_USERNAME} и нажмите «Я оплатил».",
@@ -344,13 +1360,14 @@ async def cb_buy(callback_q: types.CallbackQuery):
     await bot.answer_callback_query(callback_q.id, "Ссылка для оплаты отправлена в чат.")
 
 # Paid -> ask user to upload screenshot
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("paid:"))
-async def cb_paid(callback_q: types.CallbackQuery):
-    order_id = int(callback_q.data.split(":",1)[1])
-    await bot.send_message(callback_q.from_user.id, "Пожалуйста, пришлите скриншот/чек оплаты (фото или файл). Я автоматически перешлю его менеджеру для проверки.")
+@callbacks.handler(CB_PAID)
+async def cb_paid(callback_q: types.CallbackQuery, order_id: int):
+    # data, then state, then the prompt: the photo may reach another instance, which must already
+    # see the state with its order_id when the user can first answer
     state = dp.current_state(user=callback_q.from_user.id)
-    await state.set_state(UploadStates.waiting_for_screenshot.state)
     await state.update_data(order_id=order_id)
+    await state.set_state(UploadStates.waiting_for_screenshot.state)
+    await bot.send_message(callback_q.from_user.id, "Пожалуйста, пришлите скриншот/чек оплаты (фото или файл). Я автоматически перешлю его менеджеру для проверки.")
     await bot.answer_callback_query(callback_q.id)
 
 # Receive screenshot, forward to manager and notify admins
@@ -366,15 +1383,15 @@ async def receive_screenshot(message: types.Message, state: FSMContext):
             await bot.forward_message(manager_id, message.chat.id, message.message_id)
             # send inline confirm/decline for manager
             kb = types.InlineKeyboardMarkup()
-            kb.add(types.InlineKeyboardButton("✅ Подтвердить и выслать подарок", callback_data=f"admin_confirm:{order_id}"))
-            kb.add(types.InlineKeyboardButton("❌ Отклонить", callback_data=f"admin_decline:{order_id}"))
-            order = get_order(order_id)
+            kb.add(types.InlineKeyboardButton("✅ Подтвердить и выслать подарок", callback_data=callbacks.encode(CB_CONFIRM, order_id)))
+            kb.add(types.InlineKeyboardButton("❌ Отклонить", callback_data=callbacks.encode(CB_DECLINE, order_id)))
+            order = await get_order(order_id)
             if order:
                 chat_id = order[1]
                 await bot.send_message(manager_id, f"Заявка #{order_id} — проверка платежа. Покупатель id: {chat_id}", reply_markup=kb)
             await message.answer("Скрин отправлен менеджеру. Ожидайте подтверждения.")
             # notify admins too
-            notify_admins_text(f"Пользователь {message.from_user.id} отправил скрин для заказа #{order_id}.")
+            notify_admins_text(f"Пользователь {message.from_user.id} отправил скрин для заказа #{order_id}.", kind="screenshot")
             return
         except Exception as e:
             log.exception("Forward to manager failed: %s", e)
@@ -383,63 +1400,93 @@ async def receive_screenshot(message: types.Message, state: FSMContext):
         await message.answer(f"Пожалуйста, отправьте этот скрин в Telegram менеджеру: @{MANAGER_USERNAME}. После подтверждения менеджер пришлёт подарок.")
     else:
         await message.answer("Менеджер не настроен. Пожалуйста, свяжитесь с поддержкой вручную.")
-    notify_admins_text(f"Пользователь {message.from_user.id} отправил скрин для заказа #{order_id} (менеджер не настроен авто-forward).")
+    notify_admins_text(f"Пользователь {message.from_user.id} отправил скрин для заказа #{order_id} (менеджер не настроен авто-forward).", kind="screenshot")
 
 # Manager inline confirm/decline
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("admin_confirm:"))
-async def cb_admin_confirm(callback_q: types.CallbackQuery):
-    order_id = int(callback_q.data.split(":",1)[1])
-    user = callback_q.from_user
-    allowed = False
-    if MANAGER_CHAT_ID and str(MANAGER_CHAT_ID).isdigit() and user.id == int(MANAGER_CHAT_ID):
-        allowed = True
-    if user.id in ADMINS:
-        allowed = True
-    if not allowed:
-        await bot.answer_callback_query(callback_q.id, "Нет прав для этого действия.")
-        return
-    set_order_status(order_id, "confirmed")
-    await deliver_order(order_id)
-    await bot.answer_callback_query(callback_q.id, f"Заказ #{order_id} подтверждён и отправлен.")
-
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("admin_decline:"))
-async def cb_admin_decline(callback_q: types.CallbackQuery):
-    order_id = int(callback_q.data.split(":",1)[1])
-    user = callback_q.from_user
-    allowed = False
-    if MANAGER_CHAT_ID and str(MANAGER_CHAT_ID).isdigit() and user.id == int(MANAGER_CHAT_ID):
-        allowed = True
-    if user.id in ADMINS:
-        allowed = True
-    if not allowed:
-        await bot.answer_callback_query(callback_q.id, "Нет прав для этого действия.")
-        return
-    set_order_status(order_id, "declined")
-    await bot.answer_callback_query(callback_q.id, f"Заказ #{order_id} отклонён.")
-
-# Delivery: send gift to user (simple text or photo)
-async def deliver_order(order_id: int):
-    o = get_order(order_id)
-    if not o:
+# only ORDER_MANAGER_IDS get here (CB_CONFIRM.allowed)
+@callbacks.handler(CB_CONFIRM)
+async def cb_admin_confirm(callback_q: types.CallbackQuery, order_id: int):
+    if await confirm_order(order_id):
+        await bot.answer_callback_query(callback_q.id, f"Заказ #{order_id} подтверждён, подарок отправляется.")
+    else:
+        await bot.answer_callback_query(callback_q.id, await order_status_note(order_id))
+
+# only ORDER_MANAGER_IDS get here (CB_DECLINE.allowed)
+@callbacks.handler(CB_DECLINE)
+async def cb_admin_decline(callback_q: types.CallbackQuery, order_id: int):
+    if await transition_order(order_id, "declined"):
+        await bot.answer_callback_query(callback_q.id, f"Заказ #{order_id} отклонён.")
+    else:
+        await bot.answer_callback_query(callback_q.id, await order_status_note(order_id))
+
+async def order_status_note(order_id: int) -> str:
+    o = await get_order(order_id)
+    return f"Заказ #{order_id} не найден." if not o else f"Заказ #{order_id} уже в статусе {o[3]}."
+
+# Delivery: send gift to user (simple text or photo); runs from the outbox after "confirmed" is committed
+async def deliver_order(event_id: int, order_id: int):
+    o = await get_order(order_id)
+    if not o or o[3] != "confirmed":
+        await db.execute("UPDATE outbox SET done_at = ? WHERE id = ?", (datetime.utcnow().isoformat(), event_id))
         return
     oid, chat_id, gift_id, status, amount, local_invoice, payment_id = o
-    gift = get_gift_by_id(gift_id)
+    gift = await get_gift_by_id(gift_id)
     if not gift:
-        await bot.send_message(chat_id, "Ошибка: подарок не найден.")
-        set_order_status(order_id, "error")
+        await transition_order(order_id, "error", [("user", {"text": "Ошибка: подарок не найден."})], done_event=event_id)
         return
     _, name, price, descr, image_file_id = gift
     text = f"🎁 Ваш подарок *{name}* отправлен!\n\n{descr}\n\nСпасибо за покупку!"
     if image_file_id:
         try:
             await bot.send_photo(chat_id, image_file_id, caption=text, parse_mode="Markdown")
-        except:
+        except TelegramAPIError:
             await bot.send_message(chat_id, text, parse_mode="Markdown")
     else:
         await bot.send_message(chat_id, text, parse_mode="Markdown")
-    set_order_status(order_id, "delivered")
-    # notify admins that delivery done
-    notify_admins_text(f"Заказ #{order_id} доставлен пользователю {chat_id}.")
+    await transition_order(order_id, "delivered",
+                           [("admin", {"text": "Заказ #{order_id} доставлен пользователю {chat_id}.", "kind": "delivered"})],
+                           done_event=event_id)
+
+# Search: /search in the chat and inline mode (@bot котик) anywhere
+@dp.message_handler(commands=["search"])
+async def cmd_search(message: types.Message):
+    save_user(message)
+    query = message.get_args()
+    if not query:
+        await message.answer("Использование: /search <название или описание>")
+        return
+    rows = await search_gifts(query, limit=10)
+    if not rows:
+        await message.answer("Ничего не нашлось.")
+        return
+    kb = types.InlineKeyboardMarkup()
+    for gid, name, price, _, _ in rows:
+        kb.add(types.InlineKeyboardButton(f"{name} — {price}₽", callback_data=callbacks.encode(CB_FOUND, gid)))
+    await message.answer(f"Найдено: {len(rows)}", reply_markup=kb)
+
+@callbacks.handler(CB_FOUND)
+async def cb_found(callback_q: types.CallbackQuery, gift_id: int):
+    # a new message, not an edit: the result list stays in the chat for the next pick
+    await show_gift_page(callback_q.from_user.id, gift_id)
+    await bot.answer_callback_query(callback_q.id)
+
+@dp.inline_handler()
+async def inline_search(inline_query: types.InlineQuery):
+    rows = await search_gifts(inline_query.query)
+    bot_username = (await bot.me).username
+    results = []
+    for gid, name, price, descr, image_file_id in rows:
+        kb = types.InlineKeyboardMarkup()
+        kb.add(types.InlineKeyboardButton("Купить", url=f"https://t.me/{bot_username}?start=gift_{gid}"))
+        text = f"🎁 {name} — {price}₽\n\n{descr or ''}"
+        if image_file_id:
+            results.append(types.InlineQueryResultCachedPhoto(id=str(gid), photo_file_id=image_file_id, title=name,
+                                                              description=f"{price}₽", caption=text, reply_markup=kb))
+        else:
+            results.append(types.InlineQueryResultArticle(id=str(gid), title=f"{name} — {price}₽", description=(descr or "")[:100],
+                                                          input_message_content=types.InputTextMessageContent(text),
+                                                          reply_markup=kb))
+    await bot.answer_inline_query(inline_query.id, results, cache_time=INLINE_CACHE_TIME)
 
 # Sell flow: user sees manager link and instructions
 @dp.message_handler(lambda m: m.text == "💰 Продать свой подарок" or m.text == "/sell")
@@ -457,25 +1504,48 @@ async def cmd_sell(message: types.Message):
     await message.answer(text, reply_markup=kb)
 
 # My orders
-@dp.message_handler(lambda m: m.text == "💼 Мои заказы" or m.text == "/orders")
+MY_ORDERS_PAGE = 20
+LIST_ORDERS_PAGE = 50
+
+def orders_page_markup(schema, rows, has_more: bool, status, date_from, date_to):
+    if not has_more:
+        return None
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("Старые заказы ➡️",
+                                      callback_data=callbacks.encode(schema, rows[-1][0], status, date_from, date_to)))
+    return kb
+
+async def render_my_orders(chat_id: int, status=None, date_from=None, date_to=None, before_id=None):
+    rows, has_more = await get_orders_page(chat_id=chat_id, status=status, date_from=date_from, date_to=date_to,
+                                           before_id=before_id, limit=MY_ORDERS_PAGE)
+    out = [f"#{oid} {gname or '—'} — {amt}₽ — {st}" for oid, _, amt, st, _, gname in rows]
+    return "\n".join(out), orders_page_markup(CB_MY_ORDERS, rows, has_more, status, date_from, date_to)
+
+@dp.message_handler(lambda m: m.text and (m.text == "💼 Мои заказы" or m.text.split()[0] == "/orders"))
 async def cmd_my_orders(message: types.Message):
     save_user(message)
-    rows = db_exec("SELECT id, gift_id, amount, status, created_at FROM orders WHERE chat_id = ? ORDER BY id DESC", (message.from_user.id,), fetch=True)
-    if not rows:
+    try:
+        status, date_from, date_to = parse_order_filters(message.get_args())
+    except ValueError:
+        await message.answer("Использование: /orders [статус] [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД]")
+        return
+    text, kb = await render_my_orders(message.from_user.id, status, date_from, date_to)
+    if not text:
         await message.answer("У вас пока нет заказов.")
         return
-    out = []
-    for r in rows:
-        oid, gid, amt, status, created_at = r
-        g = get_gift_by_id(gid)
-        gname = g[1] if g else "—"
-        out.append(f"#{oid} {gname} — {amt}₽ — {status}")
-    await message.answer("\n".join(out))
+    await message.answer(text, reply_markup=kb)
+
+@callbacks.handler(CB_MY_ORDERS)
+async def cb_my_orders(callback_q: types.CallbackQuery, before_id: int, status, date_from, date_to):
+    text, kb = await render_my_orders(callback_q.from_user.id, status, date_from, date_to, before_id)
+    if text:
+        await bot.edit_message_text(text, callback_q.message.chat.id, callback_q.message.message_id, reply_markup=kb)
+    await bot.answer_callback_query(callback_q.id)
 
 # ========== Admin flows: addgift (FSM) and order management ==========
 @dp.message_handler(commands=["addgift"])
 async def cmd_addgift(message: types.Message):
-    if message.from_user.id not in ADMINS:
+    if message.from_user.id not in ADMIN_IDS:
         return
     await message.answer("Добавление подарка. Пришлите фотографию подарка или напишите /skip, чтобы добавить без фото.")
     state = dp.current_state(user=message.from_user.id)
@@ -518,76 +1588,184 @@ async def addgift_description(message: types.Message, state: FSMContext):
     image_file_id = data.get("image_file_id")
     descr = message.text.strip()
     now = datetime.utcnow().isoformat()
-    db_exec("INSERT INTO gifts (name, price, description, image_file_id, created_at) VALUES (?, ?, ?, ?, ?)",
-            (name, price, descr, image_file_id, now))
+    await db.execute("INSERT INTO gifts (name, price, description, image_file_id, created_at) VALUES (?, ?, ?, ?, ?)",
+                     (name, price, descr, image_file_id, now))
+    catalog.invalidate()
     await message.answer(f"Подарок '{name}' добавлен в каталог.")
     await state.finish()
 
 # listorders / confirm / decline / broadcast
+async def render_listorders(status=None, date_from=None, date_to=None, before_id=None):
+    rows, has_more = await get_orders_page(status=status, date_from=date_from, date_to=date_to,
+                                           before_id=before_id, limit=LIST_ORDERS_PAGE)
+    lines = [f"#{oid} {gname or '—'} {amount}₽ — {st} — user:{chat_id}" for oid, chat_id, amount, st, _, gname in rows]
+    return "\n".join(lines), orders_page_markup(CB_LIST_ORDERS, rows, has_more, status, date_from, date_to)
+
 @dp.message_handler(commands=["listorders"])
 async def cmd_listorders(message: types.Message):
-    if message.from_user.id not in ADMINS:
+    if message.from_user.id not in ADMIN_IDS:
         return
-    rows = db_exec("SELECT id, chat_id, gift_id, amount, status FROM orders ORDER BY id DESC LIMIT 50", fetch=True)
-    if not rows:
+    try:
+        status, date_from, date_to = parse_order_filters(message.get_args())
+    except ValueError:
+        await message.reply("Использование: /listorders [статус] [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД]")
+        return
+    text, kb = await render_listorders(status, date_from, date_to)
+    if not text:
         await message.reply("Нет заказов.")
         return
-    lines = []
-    for r in rows:
-        oid, chat_id, gift_id, amount, status = r
-        g = get_gift_by_id(gift_id)
-        gname = g[1] if g else "—"
-        lines.append(f"#{oid} {gname} {amount}₽ — {status} — user:{chat_id}")
-    await message.reply("\n".join(lines))
+    await message.reply(text, reply_markup=kb)
+
+@callbacks.handler(CB_LIST_ORDERS)
+async def cb_listorders(callback_q: types.CallbackQuery, before_id: int, status, date_from, date_to):
+    text, kb = await render_listorders(status, date_from, date_to, before_id)
+    if text:
+        await bot.edit_message_text(text, callback_q.message.chat.id, callback_q.message.message_id, reply_markup=kb)
+    await bot.answer_callback_query(callback_q.id)
 
 @dp.message_handler(commands=["confirm"])
 async def cmd_confirm(message: types.Message):
-    if message.from_user.id not in ADMINS and not (MANAGER_CHAT_ID and str(MANAGER_CHAT_ID).isdigit() and message.from_user.id == int(MANAGER_CHAT_ID)):
+    if message.from_user.id not in ORDER_MANAGER_IDS:
         return
     args = message.get_args()
     if not args or not args.isdigit():
         await message.reply("Использование: /confirm <order_id>")
         return
     oid = int(args)
-    set_order_status(oid, "confirmed")
-    await deliver_order(oid)
-    await message.reply(f"Заказ {oid} подтверждён и доставлен.")
+    if await confirm_order(oid):
+        await message.reply(f"Заказ {oid} подтверждён, подарок отправляется.")
+    else:
+        await message.reply(await order_status_note(oid))
 
 @dp.message_handler(commands=["decline"])
 async def cmd_decline(message: types.Message):
-    if message.from_user.id not in ADMINS and not (MANAGER_CHAT_ID and str(MANAGER_CHAT_ID).isdigit() and message.from_user.id == int(MANAGER_CHAT_ID)):
+    if message.from_user.id not in ORDER_MANAGER_IDS:
         return
     args = message.get_args()
     if not args or not args.isdigit():
         await message.reply("Использование: /decline <order_id>")
         return
     oid = int(args)
-    set_order_status(oid, "declined")
-    await message.reply(f"Заказ {oid} отклонён.")
+    if await transition_order(oid, "declined"):
+        await message.reply(f"Заказ {oid} отклонён.")
+    else:
+        await message.reply(await order_status_note(oid))
+
+@dp.message_handler(commands=["watcher"])
+async def cmd_watcher(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    if not jobs_lease.held:
+        holder = await jobs_lease.holder()
+        await message.reply(f"Проверка оплат работает на другом экземпляре: {holder[0] if holder else '—'}; "
+                            "её счётчики — в /metrics того экземпляра.")
+        return
+    st = payment_scheduler.stats()
+    await message.reply(
+        f"Ожидают оплаты: {st['queue_depth']}\n"
+        f"Последний цикл: {st['last_cycle_checks']} проверок за {st['last_cycle_duration']:.3f}с\n"
+        f"Всего проверок: {st['checks_total']}, истекло: {st['expired_total']}\n"
+        + (f"Сверка списком: {payment_reconciler.passes_total} проходов, {payment_reconciler.pages_total} страниц, "
+           f"найдено {payment_reconciler.changed_total}; последний — {payment_reconciler.last_pass_pages} стр. "
+           f"за {payment_reconciler.last_pass_duration:.3f}с" if PAYMENT_LIST_RECONCILE else "Сверка: по одному запросу на заказ")
+    )
+
+def format_hist_top(hist, title: str, limit: int = 6) -> list:
+    rows = sorted(hist.series, key=lambda labels: hist.total(*labels), reverse=True)[:limit]
+    out = [title]
+    for labels in rows:
+        out.append(f"  {' '.join(map(str, labels))}: n={hist.count(*labels)} "
+                   f"p50={hist.quantile(0.5, *labels) * 1000:.0f}мс p99={hist.quantile(0.99, *labels) * 1000:.0f}мс")
+    if not rows:
+        out.append("  —")
+    return out
+
+@dp.message_handler(commands=["stats"])
+async def cmd_stats(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    lines = []
+    lines += format_hist_top(HANDLER_SECONDS, "Обработчики:", limit=10)
+    lines += format_hist_top(DB_SECONDS, "БД (по суммарному времени):")
+    lines += format_hist_top(YOOKASSA_SECONDS, "ЮKassa:")
+    lines += format_hist_top(TELEGRAM_SECONDS, "Telegram API:")
+    st = payment_scheduler.stats()
+    lines.append(f"Очередь оплат: {st['queue_depth']}, последний цикл {st['last_cycle_duration'] * 1000:.0f}мс")
+    us = update_scheduler.stats()
+    lines.append(f"Апдейты: в очереди {us['pending']}, обрабатывается {us['running']}/{len(us['workers'])}, "
+                 f"сброшено {us['dropped']['superseded']} устаревших + {us['dropped']['overload']} при перегрузке")
+    holder = await jobs_lease.holder()
+    lines.append(f"Экземпляр {INSTANCE_ID} ({RUN_MODE}); фоновые задачи: "
+                 + ("здесь" if jobs_lease.held else f"на {holder[0]}" if holder else "никто не взял"))
+    await message.reply("\n".join(lines)[:4000])
+
+def format_rollup(title: str, created: int, paid: int, delivered: int, declined: int, revenue: int) -> str:
+    conversion = f", конверсия {delivered * 100 // created}%" if created else ""
+    return f"{title}: заказов {created}, оплачено {paid}, доставлено {delivered}, отклонено {declined}, выручка {revenue}₽{conversion}"
+
+async def top_gifts(since: str, limit: int = 5):
+    return await db.fetchall("SELECT gift_id, SUM(delivered), SUM(revenue), SUM(created) FROM sales_rollup WHERE day >= ? "
+                             "GROUP BY gift_id ORDER BY SUM(revenue) DESC, SUM(created) DESC LIMIT ?", (since, limit))
+
+@dp.message_handler(commands=["dashboard"])
+async def cmd_dashboard(message: types.Message):
+    """Reads only sales_rollup: at most 30 days x catalog size rows, however long the order history is."""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    today = datetime.utcnow().date()
+
+    def days_ago(n: int) -> str:
+        return (today - timedelta(days=n)).isoformat()
+
+    days, top_today, top_week, snap = await asyncio.gather(
+        db.fetchall("SELECT day, SUM(created), SUM(paid), SUM(delivered), SUM(declined), SUM(revenue) FROM sales_rollup "
+                    "WHERE day >= ? GROUP BY day ORDER BY day DESC", (days_ago(29),)),
+        top_gifts(days_ago(0)), top_gifts(days_ago(6)), catalog.get())
+
+    def total(since: str):
+        return [sum(r[i] for r in days if r[0] >= since) for i in range(1, 6)]
+
+    lines = ["📊 Продажи (по дню создания заказа, UTC)",
+             format_rollup("Сегодня", *total(days_ago(0))),
+             format_rollup("7 дней", *total(days_ago(6))),
+             format_rollup("30 дней", *total(days_ago(29))),
+             "По дням (заказов / оплачено / доставлено, выручка):"]
+    lines += [f"  {r[0]}: {r[1]} / {r[2]} / {r[3]}, {r[5]}₽" for r in days[:7]] or ["  —"]
+    for title, rows in (("Топ подарков сегодня:", top_today), ("Топ за 7 дней:", top_week)):
+        lines.append(title)
+        lines += [f"  {n}. {(snap.by_id(gid) or (gid, f'#{gid}'))[1]} — доставлено {delivered}, {revenue}₽, заказов {created}"
+                  for n, (gid, delivered, revenue, created) in enumerate(rows, 1)] or ["  —"]
+    await message.reply("\n".join(lines)[:4000])
+
+@dp.message_handler(commands=["rebuildrollups"])
+async def cmd_rebuild_rollups(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    started = time.monotonic()
+    # one write transaction: status changes wait for it instead of racing the recount
+    groups = await db.transaction(rebuild_rollups)
+    await message.reply(f"Сводки пересчитаны: {groups} строк (день × подарок) за {time.monotonic() - started:.1f}с.")
 
 @dp.message_handler(commands=["broadcast"])
 async def cmd_broadcast(message: types.Message):
-    if message.from_user.id not in ADMINS:
+    if message.from_user.id not in ADMIN_IDS:
         return
     text = message.get_args()
     if not text:
         await message.reply("Использование: /broadcast Текст")
         return
-    users = db_exec("SELECT chat_id FROM users", fetch=True)
-    sent = 0
-    for u in users:
-        try:
-            await bot.send_message(u[0], text)
-            sent += 1
-            await asyncio.sleep(0.03)
-        except Exception as e:
-            log.warning("Broadcast failed to %s: %s", u[0], e)
-    await message.reply(f"Отправлено {sent} сообщений.")
+    now = datetime.utcnow().isoformat()
+    res = await db.execute("INSERT INTO broadcasts (admin_chat_id, text, status, created_at, updated_at) VALUES (?, ?, 'running', ?, ?)",
+                           (message.from_user.id, text, now, now))
+    if jobs_lease.held:
+        start_broadcast_task(res.lastrowid)
+    # otherwise broadcast_runner() on the instance holding the jobs lease picks it up
+    await message.reply(f"Рассылка #{res.lastrowid} запущена. Пришлю прогресс и итог.")
 
 # share / promo simple
 @dp.message_handler(lambda m: m.text == "⭐ Поделиться" or m.text == "/share")
 async def cmd_share(message: types.Message):
-    rows = db_exec("SELECT id, name, price FROM gifts LIMIT 3", fetch=True)
+    rows = (await catalog.get()).gifts[:3]
     text = "Я купил подарок в GiftsFelix! Посмотри: "
     for r in rows:
         text += f"\n{r[1]} — {r[2]}₽"
@@ -596,51 +1774,879 @@ async def cmd_share(message: types.Message):
     await message.answer("Поделиться можно этим текстом (перешли друзьям):")
     await message.answer(share_text)
 
+# ========== Broadcast jobs ==========
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+broadcast_tasks = {}
+
+async def broadcast_send(chat_id: int, text: str) -> str:
+    """Returns 'sent', 'blocked' (user is gone for good) or 'failed'."""
+    for _ in range(3):
+        await broadcast_bucket.acquire()
+        try:
+            await bot.send_message(chat_id, text)
+            return "sent"
+        except RetryAfter as e:
+            # flood control applies to the whole bot: stall every sender, then retry this one
+            log.warning("Broadcast RetryAfter %ss", e.timeout)
+            broadcast_bucket.pause(e.timeout)
+        except (Unauthorized, ChatNotFound):
+            return "blocked"
+        except TelegramAPIError as e:
+            log.warning("Broadcast failed to %s: %s", chat_id, e)
+            return "failed"
+        except (asyncio.TimeoutError, ClientError) as e:
+            # may have been delivered: not retried, and the batch goes on so the job position still advances
+            log.warning("Broadcast to %s failed: %r", chat_id, e)
+            return "failed"
+    return "failed"
+
+async def report_broadcast(job_id: int, admin_id: int, progress_msg, sent: int, failed: int, blocked: int, done: bool = False):
+    head = f"Рассылка #{job_id} завершена." if done else f"Рассылка #{job_id} идёт…"
+    text = f"{head}\nОтправлено: {sent}\nОшибок: {failed}\nЗаблокировали бота: {blocked}"
+    try:
+        if progress_msg is not None and not done:
+            await bot.edit_message_text(text, admin_id, progress_msg.message_id)
+            return progress_msg
+        return await bot.send_message(admin_id, text)
+    except MessageNotModified:
+        return progress_msg
+    except TelegramAPIError as e:
+        log.warning("Broadcast report failed: %s", e)
+        return progress_msg
+
+async def run_broadcast(job_id: int):
+    row = await db.fetchone("SELECT admin_chat_id, text, cursor, sent, failed, blocked FROM broadcasts WHERE id = ?", (job_id,))
+    if not row:
+        return
+    admin_id, text, cursor, sent, failed, blocked = row
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    progress_msg = await report_broadcast(job_id, admin_id, None, sent, failed, blocked)
+    last_report = time.monotonic()
+
+    async def send(chat_id):
+        async with sem:
+            return chat_id, await broadcast_send(chat_id, text)
+
+    try:
+        while True:
+            batch = await db.fetchall("SELECT chat_id FROM users WHERE active = 1 AND chat_id > ? ORDER BY chat_id LIMIT ?",
+                                      (cursor, BROADCAST_BATCH))
+            if not batch:
+                break
+            results = await asyncio.gather(*(send(r[0]) for r in batch))
+            gone = [(cid,) for cid, res in results if res == "blocked"]
+            sent += sum(1 for _, res in results if res == "sent")
+            failed += sum(1 for _, res in results if res == "failed")
+            blocked += len(gone)
+            cursor = batch[-1][0]
+
+            def save_batch(conn):
+                conn.executemany("UPDATE users SET active = 0 WHERE chat_id = ?", gone)
+                conn.execute("UPDATE broadcasts SET cursor = ?, sent = ?, failed = ?, blocked = ?, updated_at = ? WHERE id = ?",
+                             (cursor, sent, failed, blocked, datetime.utcnow().isoformat(), job_id))
+            # the cursor only moves once a whole batch is out: after a crash at most one batch is re-sent
+            await db.transaction(save_batch)
+            for (cid,) in gone:
+                user_registry.forget(cid)
+            if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                progress_msg = await report_broadcast(job_id, admin_id, progress_msg, sent, failed, blocked)
+                last_report = time.monotonic()
+        await db.execute("UPDATE broadcasts SET status = 'done', updated_at = ? WHERE id = ?", (datetime.utcnow().isoformat(), job_id))
+        await report_broadcast(job_id, admin_id, progress_msg, sent, failed, blocked, done=True)
+    finally:
+        broadcast_tasks.pop(job_id, None)
+
+def start_broadcast_task(job_id: int):
+    broadcast_tasks[job_id] = asyncio.create_task(run_broadcast(job_id))
+
+async def resume_broadcasts():
+    for (job_id,) in await db.fetchall("SELECT id FROM broadcasts WHERE status = 'running'"):
+        if job_id not in broadcast_tasks:
+            log.info("Resuming broadcast #%s", job_id)
+            start_broadcast_task(job_id)
+
+async def broadcast_runner():
+    """Runs every 'running' broadcast here, including ones queued by /broadcast on other instances."""
+    try:
+        while True:
+            try:
+                await resume_broadcasts()
+            except Exception:
+                log.exception("Broadcast resume failed")
+            await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+    finally:
+        # lease lost or shutdown: the cursor is saved per batch, the next holder resumes from it
+        for task in list(broadcast_tasks.values()):
+            task.cancel()
+
+# ========== Order export ==========
+EXPORT_COLUMNS = ("order_id", "created_at", "updated_at", "status", "amount", "chat_id", "username", "first_name",
+                  "gift_id", "gift_name", "payment_id", "local_invoice", "archived")
+export_task = None
+
+def iter_export_rows(conn, status=None, date_from=None, date_to=None):
+    """Orders matching the filters, archive first, each table in id order, one row at a time straight off
+    the SQLite cursor: nothing is sorted or buffered, so memory does not depend on the table size."""
+    where, params = [], []
+    if status:
+        where.append("o.status = ?")
+        params.append(status)
+    if date_from:
+        where.append("o.created_at >= ?")
+        params.append(date_from.isoformat())
+    if date_to:
+        where.append("o.created_at < ?")
+        params.append((date_to + timedelta(days=1)).isoformat())
+    tables = ORDER_TABLES[:1] if status and status not in TERMINAL_STATUSES else ORDER_TABLES[::-1]
+    for table in tables:
+        cur = conn.execute(
+            "SELECT o.id, o.created_at, o.updated_at, o.status, o.amount, o.chat_id, u.username, u.first_name, "
+            f"o.gift_id, g.name, o.payment_id, o.local_invoice, {int(table != 'orders')} FROM {table} o "
+            "LEFT JOIN gifts g ON g.id = o.gift_id LEFT JOIN users u ON u.chat_id = o.chat_id "
+            + ("WHERE " + " AND ".join(where) + " " if where else "") + "ORDER BY o.id", params)
+        yield from cur
+
+def csv_lines(rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(row)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n"
+
+# format -> (file extension, rows -> lines, header line)
+EXPORT_FORMATS = {
+    "csv": (".csv", csv_lines, next(csv_lines([EXPORT_COLUMNS]))),
+    "json": (".ndjson", ndjson_lines, ""),
+}
+
+def write_gzip_parts(lines, directory: str, stem: str, ext: str, header: str = "", part_bytes: int = EXPORT_PART_BYTES):
+    """Streams lines into stem-001.ext.gz, stem-002.ext.gz, ..., starting a new part (with the header) once the
+    compressed size passes part_bytes. Returns (paths, line count)."""
+    paths, count, raw, out = [], 0, None, None
+    for line in lines:
+        if out is None:
+            paths.append(os.path.join(directory, f"{stem}-{len(paths) + 1:03d}{ext}.gz"))
+            raw = open(paths[-1], "wb")
+            out = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6)
+            out.write(header.encode("utf-8"))
+        out.write(line.encode("utf-8"))
+        count += 1
+        if count % 1000 == 0 and raw.tell() >= part_bytes:
+            out.close()
+            raw.close()
+            out = None
+    if out is not None:
+        out.close()
+        raw.close()
+    elif not paths:
+        paths.append(os.path.join(directory, f"{stem}-001{ext}.gz"))
+        with gzip.open(paths[-1], "wb") as empty:
+            empty.write(header.encode("utf-8"))
+    return paths, count
+
+def write_export(conn, directory: str, stem: str, fmt: str, status, date_from, date_to):
+    """rows -> lines -> gzip parts; runs in a db.scan() thread, one snapshot of both order tables."""
+    ext, to_lines, header = EXPORT_FORMATS[fmt]
+    return write_gzip_parts(to_lines(iter_export_rows(conn, status, date_from, date_to)), directory, stem, ext, header)
+
+async def run_export(chat_id: int, fmt: str, status, date_from, date_to):
+    directory = tempfile.mkdtemp(prefix="giftsexport")
+    stem = "_".join(["orders"] + [str(x) for x in (status, date_from, date_to) if x])
+    try:
+        started = time.monotonic()
+        paths, count = await db.scan(write_export, directory, stem, fmt, status, date_from, date_to)
+        log.info("Exported %s orders into %s file(s) in %.1fs", count, len(paths), time.monotonic() - started)
+        for n, path in enumerate(paths, 1):
+            with open(path, "rb") as f:
+                await bot.send_document(chat_id, types.InputFile(f, filename=os.path.basename(path)),
+                                        caption=f"Заказов: {count}" + (f", часть {n}/{len(paths)}" if len(paths) > 1 else ""))
+    except Exception as e:
+        log.exception("Order export failed")
+        await bot.send_message(chat_id, f"Экспорт не удался: {e}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+@dp.message_handler(commands=["export"])
+async def cmd_export(message: types.Message):
+    global export_task
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = message.get_args().split()
+    fmt = args.pop(0).lower() if args and args[0].lower() in EXPORT_FORMATS else "csv"
+    try:
+        status, date_from, date_to = parse_order_filters(" ".join(args))
+    except ValueError:
+        await message.reply("Использование: /export [csv|json] [статус] [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД]")
+        return
+    if export_task is not None and not export_task.done():
+        await message.reply("Предыдущий экспорт ещё готовится.")
+        return
+    # in the background: a long export must not hold up this chat's next updates
+    export_task = asyncio.create_task(run_export(message.chat.id, fmt, status, date_from, date_to))
+    await message.reply("Готовлю выгрузку, пришлю файлом.")
+
+# ========== Outbox ==========
+class OutboxDispatcher:
+    """
+    Delivers side effects written by transition_order(): polls due outbox rows in id order, runs a
+    batch concurrently and closes the finished rows in one transaction. Failures are retried with
+    exponential backoff up to `max_attempts`; users who blocked the bot are not retried.
+
+    kinds: "user" (text to payload chat_id), "admin" (admin_notifier, payload kind for digests),
+    "deliver" (gift delivery; closes its own row together with the confirmed -> delivered transition).
+    A crash between a send and closing its row repeats that send on restart, never loses it.
+    """
+
+    def __init__(self, batch: int = 50, interval: float = 5.0, max_attempts: int = 8, retention: float = 7 * 86400):
+        self.batch = batch
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.pending = 0
+        self.sent_total = 0
+        self.failed_total = 0
+        self._wakeup = None
+        self._task = None
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            task, self._task = self._task, None
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _handle(self, event_id: int, kind: str, order_id: int, payload: dict):
+        if kind == "user":
+            await bot.send_message(payload["chat_id"], payload["text"], parse_mode=payload.get("parse_mode"))
+        elif kind == "admin":
+            notify_admins_text(payload["text"], kind=payload.get("kind"))
+        elif kind == "deliver":
+            await deliver_order(event_id, order_id)
+            return False  # closed inside the delivery transition
+        else:
+            log.error("Unknown outbox event kind %r (#%s)", kind, event_id)
+        return True
+
+    async def _process(self, row):
+        event_id, kind, order_id, payload, attempts = row
+        try:
+            return ("done" if await self._handle(event_id, kind, order_id, json.loads(payload)) else None), row, None
+        except RetryAfter as e:
+            return "retry", row, (e, e.timeout)
+        except (Unauthorized, ChatNotFound) as e:
+            return "failed", row, (e, None)  # blocked bot / no such chat: retrying will not help
+        except Exception as e:
+            log.exception("Outbox event #%s (%s, order #%s) failed", event_id, kind, order_id)
+            return "retry", row, (e, None)
+
+    async def dispatch_due(self) -> int:
+        rows = await db.fetchall("SELECT id, kind, order_id, payload, attempts FROM outbox "
+                                 "WHERE done_at IS NULL AND next_at <= ? ORDER BY id LIMIT ?", (time.time(), self.batch))
+        if not rows:
+            return 0
+        results = await asyncio.gather(*(self._process(row) for row in rows))
+        now_iso, now = datetime.utcnow().isoformat(), time.time()
+        done, dead, retry, undeliverable = [], [], [], []
+        for outcome, row, err in results:
+            if outcome == "done":
+                done.append((now_iso, row[0]))
+                self.sent_total += 1
+            elif outcome is not None:
+                e, delay = err
+                attempts = row[4] + 1
+                if outcome == "failed" or attempts >= self.max_attempts:
+                    log.warning("Outbox event #%s (%s, order #%s) dropped after %s attempts: %r", row[0], row[1], row[2], attempts, e)
+                    dead.append((now_iso, attempts, repr(e)[:500], row[0]))
+                    self.failed_total += 1
+                    if row[1] == "deliver":
+                        undeliverable.append((row[2], repr(e)[:200]))
+                else:
+                    retry.append((attempts, now + (delay or min(300, 2 ** attempts)), repr(e)[:500], row[0]))
+
+        def _close(conn):
+            conn.executemany("UPDATE outbox SET done_at = ? WHERE id = ?", done)
+            conn.executemany("UPDATE outbox SET done_at = ?, attempts = ?, last_error = ? WHERE id = ?", dead)
+            conn.executemany("UPDATE outbox SET attempts = ?, next_at = ?, last_error = ? WHERE id = ?", retry)
+        if done or dead or retry:
+            await db.transaction(_close)
+        for order_id, error in undeliverable:
+            await transition_order(order_id, "error", [("admin", {"text": f"⚠️ Не удалось доставить заказ #{{order_id}}: {error}"})])
+        return len(rows)
+
+    async def _run(self):
+        last_sweep = 0.0
+        while True:
+            self._wakeup.clear()
+            try:
+                while await self.dispatch_due() == self.batch:
+                    pass
+                row = await db.fetchone("SELECT COUNT(*), MIN(next_at) FROM outbox WHERE done_at IS NULL")
+                self.pending = row[0]
+                if time.monotonic() - last_sweep > 3600:
+                    last_sweep = time.monotonic()
+                    cutoff = (datetime.utcnow() - timedelta(seconds=self.retention)).isoformat()
+                    await db.execute("DELETE FROM outbox WHERE done_at IS NOT NULL AND done_at < ?", (cutoff,))
+                delay = self.interval if row[1] is None else min(self.interval, max(0.0, row[1] - time.time()))
+            except Exception:
+                log.exception("Outbox dispatch failed")
+                delay = self.interval
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+outbox = OutboxDispatcher(batch=OUTBOX_BATCH, interval=OUTBOX_INTERVAL, max_attempts=OUTBOX_MAX_ATTEMPTS)
+
+# ========== Order archive ==========
+class OrderArchiver:
+    """Moves finished orders not touched for `age` seconds from orders to orders_archive, `batch` rows per
+    transaction with a pause in between, so the write lock is only ever held briefly and the hot table
+    stays small."""
+
+    def __init__(self, age: float, batch: int = 200, interval: float = 3600, pause: float = 0.05):
+        self.age = age
+        self.batch = batch
+        self.interval = interval
+        self.pause = pause
+        self.archived_total = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            task, self._task = self._task, None
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def _move_batch(self, conn, cutoff: str, now: str) -> int:
+        ids = [r[0] for r in conn.execute(
+            f"SELECT id FROM orders WHERE status IN ({','.join('?' * len(TERMINAL_STATUSES))}) AND updated_at < ? "
+            "ORDER BY id LIMIT ?", (*TERMINAL_STATUSES, cutoff, self.batch))]
+        if not ids:
+            return 0
+        marks = ",".join("?" * len(ids))
+        conn.execute(
+            "INSERT OR REPLACE INTO orders_archive (id, chat_id, gift_id, status, amount, local_invoice, payment_id, "
+            "created_at, updated_at, payment_url, archived_at) "
+            "SELECT id, chat_id, gift_id, status, amount, local_invoice, payment_id, created_at, updated_at, payment_url, ? "
+            f"FROM orders WHERE id IN ({marks})", (now, *ids))
+        conn.execute(f"DELETE FROM orders WHERE id IN ({marks})", ids)
+        return len(ids)
+
+    async def run_once(self) -> int:
+        cutoff = (datetime.utcnow() - timedelta(seconds=self.age)).isoformat()
+        moved = 0
+        while True:
+            n = await db.transaction(self._move_batch, cutoff, datetime.utcnow().isoformat())
+            moved += n
+            if n < self.batch:
+                break
+            await asyncio.sleep(self.pause)  # let queued writers in between batches
+        self.archived_total += moved
+        if moved:
+            log.info("Archived %s finished orders", moved)
+        return moved
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                log.exception("Order archiving failed")
+            await asyncio.sleep(self.interval)
+
+order_archiver = OrderArchiver(ORDER_ARCHIVE_AFTER_DAYS * 86400, batch=ORDER_ARCHIVE_BATCH, interval=ORDER_ARCHIVE_INTERVAL)
+
 # ========== payment watcher (detect paid via YooKassa or simulate in TEST_MODE) ==========
-async def payment_watcher():
-    log.info("Payment watcher started. TEST_MODE=%s", TEST_MODE)
-    while True:
-        pending = get_pending_orders()
-        for row in pending:
-            order_id, payment_id, local_invoice = row
+def yookassa_payment_is_paid(info: dict) -> bool:
+    status = str(info.get("status", "")).lower()
+    return bool(info.get("paid", False)) or status in ("succeeded", "paid", "waiting_for_capture")
+
+def paid_events(test: bool = False):
+    if test:
+        return [("user", {"text": f"Оплата получена (тест). Чтобы получить подарок — отправьте чек менеджеру @{MANAGER_USERNAME} и нажмите «Я оплатил»."}),
+                ("admin", {"text": "Оплата (тест) для заказа #{order_id}. Покупатель: {chat_id}", "kind": "paid"})]
+    return [("user", {"text": f"Оплата подтверждена. Чтобы получить подарок — отправьте чек менеджеру @{MANAGER_USERNAME} и нажмите «Я оплатил»."}),
+            ("admin", {"text": "Оплата подтверждена для заказа #{order_id}. Покупатель: {chat_id}", "kind": "paid"})]
+
+async def mark_order_paid(order_id: int, test: bool = False) -> bool:
+    """pending/payment_created -> paid_pending_confirmation. Only the caller that wins the transition queues the
+    messages, so a webhook and the poller seeing the same payment produce one of each."""
+    return await transition_order(order_id, "paid_pending_confirmation", paid_events(test))
+
+class PendingPayment:
+    __slots__ = ("order_id", "payment_id", "local_invoice", "created_ts", "next_at", "attempt")
+
+    def __init__(self, order_id, payment_id, local_invoice, created_ts):
+        self.order_id = order_id
+        self.payment_id = payment_id
+        self.local_invoice = local_invoice
+        self.created_ts = created_ts
+        self.next_at = 0.0
+        self.attempt = 0
+
+class PaymentScheduler:
+    """Min-heap of pending orders keyed on the next check time. Fresh orders are checked every
+    base_interval, then back off exponentially up to max_interval; orders older than ttl become 'expired'.
+    Due checks run concurrently, bounded by a semaphore. Every `reload_interval` the open orders are re-read
+    from the table, which picks up orders created by other instances sharing the database."""
+
+    def __init__(self, base_interval: float, max_interval: float, ttl: float, concurrency: int, per_order: bool = True,
+                 reload_interval: float = 0):
+        self.base_interval = base_interval
+        self.reload_interval = reload_interval
+        self.per_order = per_order  # False: PaymentReconciler finds payments, the heap only times expiry
+        self.max_interval = max_interval
+        self.ttl = ttl
+        self.concurrency = concurrency
+        self._heap = []  # (next_at, order_id); stale items are skipped on pop
+        self._entries = {}
+        self._sem = None
+        self._wakeup = None
+        self.last_cycle_duration = 0.0
+        self.last_cycle_checks = 0
+        self.checks_total = 0
+        self.expired_total = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "last_cycle_duration": self.last_cycle_duration,
+            "last_cycle_checks": self.last_cycle_checks,
+            "checks_total": self.checks_total,
+            "expired_total": self.expired_total,
+        }
+
+    def add(self, order_id: int, payment_id: str, local_invoice: str, created_ts: float = None) -> bool:
+        if self._wakeup is None:
+            # not running here (not started yet, or another instance holds the jobs lease): load() finds it
+            return False
+        entry = self._entries.get(order_id)
+        if entry is not None:
+            # loaded at startup before cb_buy got its payment id
+            entry.payment_id = entry.payment_id or payment_id
+            return False
+        entry = PendingPayment(order_id, payment_id, local_invoice, created_ts or time.time())
+        self._entries[order_id] = entry
+        self._schedule(entry, self.base_interval)
+        self._wakeup.set()
+        return True
+
+    def reset(self):
+        """Forget everything; run() reloads from the table when this instance gets the jobs lease again."""
+        self._heap.clear()
+        self._entries.clear()
+        self._wakeup = None
+
+    def _schedule(self, entry: PendingPayment, delay: float):
+        entry.next_at = time.time() + delay
+        heapq.heappush(self._heap, (entry.next_at, entry.order_id))
+
+    def _drop(self, entry: PendingPayment):
+        self._entries.pop(entry.order_id, None)
+
+    def resolve(self, order_ids):
+        """Forget orders settled elsewhere; their heap items are skipped on pop."""
+        for order_id in order_ids:
+            self._entries.pop(order_id, None)
+
+    def open_by_payment(self) -> dict:
+        """payment_id -> PendingPayment for every order still waiting."""
+        return {e.payment_id: e for e in self._entries.values() if e.payment_id}
+
+    async def load(self):
+        added = 0
+        for order_id, payment_id, local_invoice, created_at in await get_pending_orders():
+            try:
+                created_ts = datetime.fromisoformat(created_at).replace(tzinfo=timezone.utc).timestamp()
+            except (TypeError, ValueError):
+                created_ts = time.time()
+            added += self.add(order_id, payment_id, local_invoice, created_ts)
+        if added:
+            log.info("Payment scheduler loaded %s pending orders (queue %s)", added, self.queue_depth)
+
+    def _pop_due(self):
+        now = time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            next_at, order_id = heapq.heappop(self._heap)
+            entry = self._entries.get(order_id)
+            if entry is not None and entry.next_at == next_at:
+                due.append(entry)
+        return due
+
+    async def _is_paid(self, entry: PendingPayment) -> bool:
+        if not self.per_order:
+            return False
+        if TEST_MODE:
             # TEST mode simulate paying after 15s
-            if TEST_MODE:
+            try:
+                ts = int(entry.local_invoice.split("_")[1])
+            except (AttributeError, IndexError, ValueError):
+                ts = int(time.time())
+            return time.time() - ts > 15
+        if not entry.payment_id:
+            return False
+        info = await get_yookassa_payment(entry.payment_id)
+        return bool(info) and yookassa_payment_is_paid(info)
+
+    async def _check(self, entry: PendingPayment):
+        async with self._sem:
+            self.checks_total += 1
+            try:
+                row = await db.fetchone("SELECT status FROM orders WHERE id = ?", (entry.order_id,))
+                if not row or row[0] not in ("payment_created", "pending"):
+                    self._drop(entry)
+                    return
+                if await self._is_paid(entry):
+                    await mark_order_paid(entry.order_id, test=TEST_MODE)
+                    self._drop(entry)
+                    return
+                if time.time() - entry.created_ts > self.ttl:
+                    if await expire_order(entry.order_id):
+                        self.expired_total += 1
+                    self._drop(entry)
+                    return
+            except Exception:
+                log.exception("Payment check failed for order #%s", entry.order_id)
+            entry.attempt += 1
+            if not self.per_order:
+                # nothing to poll: come back when the order is due to expire
+                self._schedule(entry, max(self.base_interval, entry.created_ts + self.ttl - time.time()))
+                return
+            self._schedule(entry, min(self.max_interval, self.base_interval * (2 ** entry.attempt)))
+
+    async def start(self):
+        """Loads the open orders; run() does it itself if not called first."""
+        self._sem = asyncio.Semaphore(self.concurrency)
+        self._wakeup = asyncio.Event()
+        await self.load()
+
+    async def run(self):
+        if self._wakeup is None:
+            await self.start()
+        loaded_at = time.monotonic()
+        while True:
+            if self.reload_interval and time.monotonic() - loaded_at >= self.reload_interval:
+                loaded_at = time.monotonic()
                 try:
-                    ts = int(local_invoice.split("_")[1])
-                except:
-                    ts = int(time.time())
-                if time.time() - ts > 15:
-                    # set to paid_pending_confirmation
-                    set_order_status(order_id, "paid_pending_confirmation")
-                    o = get_order(order_id)
-                    if o:
-                        chat_id = o[1]
-                        await bot.send_message(chat_id, f"Оплата получена (тест). Чтобы получить подарок — отправьте чек менеджеру @{MANAGER_USERNAME} и нажмите «Я оплатил».")
-                        notify_admins_text(f"Оплата (тест) для заказа #{order_id}. Покупатель: {chat_id}")
-            else:
-                # real flow: check YooKassa
-                if not payment_id:
-                    continue
-                info = get_yookassa_payment(payment_id)
-                if not info:
+                    await self.load()
+                except Exception:
+                    log.exception("Payment scheduler reload failed")
+            due = self._pop_due()
+            if due:
+                started = time.monotonic()
+                await asyncio.gather(*(self._check(e) for e in due))
+                self.last_cycle_duration = time.monotonic() - started
+                self.last_cycle_checks = len(due)
+                log.debug("Payment cycle: %s checks in %.3fs, queue %s", len(due), self.last_cycle_duration, self.queue_depth)
+            delay = self._heap[0][0] - time.time() if self._heap else self.max_interval
+            if self.reload_interval:
+                delay = min(delay, loaded_at + self.reload_interval - time.monotonic())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, min(delay, self.max_interval)))
+            except asyncio.TimeoutError:
+                pass
+
+async def expire_order(order_id: int) -> bool:
+    if await transition_order(order_id, "expired"):
+        log.info("Order #%s expired unpaid", order_id)
+        return True
+    return False
+
+async def load_sync_state(key: str):
+    row = await db.fetchone("SELECT value FROM sync_state WHERE key = ?", (key,))
+    return json.loads(row[0]) if row and row[0] else None
+
+def save_sync_state(conn, key: str, value):
+    conn.execute("INSERT INTO sync_state (key, value, updated_at) VALUES (?, ?, ?) "
+                 "ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                 (key, json.dumps(value) if value is not None else None, datetime.utcnow().isoformat()))
+
+class PaymentReconciler:
+    """
+    Bulk replacement for per-order polling. Each pass pages through GET /payments once per final status,
+    filtered to created_at >= the oldest open order, and matches items to open orders through the
+    scheduler's payment_id dict. So the HTTP cost is one call per 100 settled payments, not one call
+    per open order. Each page's status changes are applied in one transaction together with the
+    page cursor in sync_state, so an interrupted pass resumes after the last applied page.
+    """
+    STATE_KEY = "yookassa_reconcile"
+    STATUSES = ("succeeded", "waiting_for_capture", "canceled")
+
+    def __init__(self, scheduler: PaymentScheduler, interval: float, page_size: int = 100):
+        self.scheduler = scheduler
+        self.interval = interval
+        self.page_size = page_size
+        self.passes_total = 0
+        self.pages_total = 0
+        self.changed_total = 0
+        self.last_pass_duration = 0.0
+        self.last_pass_pages = 0
+
+    def _apply_page(self, conn, changes, state):
+        changed = [order_id for order_id, status, events in changes if apply_transition(conn, order_id, status, events)]
+        save_sync_state(conn, self.STATE_KEY, state)
+        return changed
+
+    async def run_once(self) -> int:
+        started = time.monotonic()
+        state = await load_sync_state(self.STATE_KEY)
+        open_orders = self.scheduler.open_by_payment()
+        if not state:
+            if not open_orders:
+                return 0
+            oldest = min(e.created_ts for e in open_orders.values()) - 300  # clock skew between us and YooKassa
+            since = datetime.fromtimestamp(oldest, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            state = {"since": since, "status": self.STATUSES[0], "cursor": None}
+        pages = changed_count = 0
+        while state is not None:
+            page = await yookassa.list_payments(state["status"], state["since"], state["cursor"], self.page_size)
+            pages += 1
+            changes = []
+            for item in page.get("items") or ():
+                entry = open_orders.get(item.get("id"))
+                if entry is None:
                     continue
-                paid_flag = info.get("paid", False)
-                status = str(info.get("status", "")).lower()
-                if paid_flag or status in ("succeeded", "paid", "waiting_for_capture"):
-                    set_order_status(order_id, "paid_pending_confirmation")
-                    o = get_order(order_id)
-                    if o:
-                        chat_id = o[1]
-                        await bot.send_message(chat_id, f"Оплата подтверждена. Чтобы получить подарок — отправьте чек менеджеру @{MANAGER_USERNAME} и нажмите «Я оплатил».")
-                        notify_admins_text(f"Оплата подтверждена для заказа #{order_id}. Покупатель: {chat_id}")
-        await asyncio.sleep(6)
+                if yookassa_payment_is_paid(item):
+                    changes.append((entry.order_id, "paid_pending_confirmation", paid_events()))
+                elif item.get("status") == "canceled":
+                    changes.append((entry.order_id, "expired", ()))
+            if page.get("next_cursor"):
+                state = dict(state, cursor=page["next_cursor"])
+            else:
+                i = self.STATUSES.index(state["status"]) + 1
+                state = dict(state, status=self.STATUSES[i], cursor=None) if i < len(self.STATUSES) else None
+            if changes or state is None or pages % 10 == 0:
+                changed = await db.transaction(self._apply_page, changes, state)
+                self.scheduler.resolve(order_id for order_id, _, _ in changes)
+                changed_count += len(changed)
+                if changed:
+                    outbox.wake()
+                    log.info("Reconciled orders %s from the YooKassa payments list", changed)
+        self.passes_total += 1
+        self.pages_total += pages
+        self.changed_total += changed_count
+        self.last_pass_pages = pages
+        self.last_pass_duration = time.monotonic() - started
+        return changed_count
+
+    async def run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                log.exception("Payment reconciliation failed")
+            await asyncio.sleep(self.interval)
+
+# with HTTP notifications on, polling is only a slow reconciliation for lost notifications
+PAYMENT_CHECK_INTERVAL = PAYMENT_RECONCILE_INTERVAL if (YOOKASSA_NOTIFY_PORT and not TEST_MODE) else PAYMENT_POLL_INTERVAL
+PAYMENT_LIST_RECONCILE = not TEST_MODE and PAYMENT_RECONCILE_MODE == "list"
+payment_scheduler = PaymentScheduler(PAYMENT_CHECK_INTERVAL, PAYMENT_POLL_MAX_INTERVAL, PAYMENT_ORDER_TTL,
+                                     PAYMENT_CHECK_CONCURRENCY, per_order=not PAYMENT_LIST_RECONCILE,
+                                     reload_interval=PAYMENT_RELOAD_INTERVAL)
+payment_reconciler = PaymentReconciler(payment_scheduler, PAYMENT_CHECK_INTERVAL)
+
+async def payment_watcher():
+    log.info("Payment watcher started. TEST_MODE=%s interval=%ss mode=%s", TEST_MODE, payment_scheduler.base_interval,
+             "list" if PAYMENT_LIST_RECONCILE else "per_order")
+    reconciler = None
+    try:
+        # the first reconciliation pass matches against the open orders: they must be loaded by then,
+        # or the payments made while we were down go by unmatched and the saved cursor moves past them
+        await payment_scheduler.start()
+        if PAYMENT_LIST_RECONCILE and yookassa.configured:
+            reconciler = asyncio.create_task(payment_reconciler.run())
+        await payment_scheduler.run()
+    finally:
+        if reconciler:
+            reconciler.cancel()
+            await asyncio.gather(reconciler, return_exceptions=True)
+        payment_scheduler.reset()
+
+# ========== YooKassa HTTP notifications ==========
+YOOKASSA_PAID_EVENTS = ("payment.succeeded", "payment.waiting_for_capture")
+notify_runner = None
+
+def notification_source(request: web.Request) -> str:
+    """Sender address. The client writes the left part of X-Forwarded-For itself; only the hops our own
+    YOOKASSA_NOTIFY_PROXY_HOPS proxies appended on the right can be believed."""
+    if not YOOKASSA_NOTIFY_PROXY_HOPS:
+        return request.remote or ""
+    hops = [h.strip() for h in request.headers.get("X-Forwarded-For", "").split(",") if h.strip()]
+    if len(hops) < YOOKASSA_NOTIFY_PROXY_HOPS:
+        return ""  # did not come through our proxies
+    return hops[-YOOKASSA_NOTIFY_PROXY_HOPS]
+
+def notification_source_trusted(request: web.Request) -> bool:
+    remote = notification_source(request)
+    try:
+        addr = ipaddress.ip_address(remote)
+    except ValueError:
+        return False
+    return any(addr in net for net in YOOKASSA_NOTIFY_NETWORKS)
+
+async def yookassa_notification(request: web.Request):
+    try:
+        payload = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    if not isinstance(payload, dict) or not isinstance(payload.get("object") or {}, dict):
+        return web.Response(status=400)
+    event = payload.get("event")
+    obj = payload.get("object") or {}
+    payment_id = obj.get("id")
+    if event not in YOOKASSA_PAID_EVENTS or not payment_id:
+        return web.Response(status=200)
+    if not yookassa.configured:
+        # nothing to check the payment against: only the allowlisted YooKassa addresses are believed
+        if not notification_source_trusted(request):
+            log.warning("Rejected YooKassa notification from %s", notification_source(request) or request.remote)
+            return web.Response(status=403)
+    else:
+        # the notification is only a hint, whoever sent it: trust what the API itself says about the payment
+        try:
+            obj = await yookassa.get_payment(payment_id)
+        except YooKassaError as e:
+            if e.status == 404:
+                log.warning("Forged YooKassa notification for %s from %s", payment_id, request.remote)
+                return web.Response(status=403)
+            return web.Response(status=503)  # YooKassa will redeliver
+        if not yookassa_payment_is_paid(obj):
+            return web.Response(status=200)
+    order_id = await get_order_id_by_payment(payment_id)
+    if order_id is None:
+        log.warning("YooKassa notification for unknown payment %s", payment_id)
+        return web.Response(status=200)
+    if await mark_order_paid(order_id):
+        log.info("Order #%s paid (notification %s)", order_id, event)
+    return web.Response(status=200)
+
+async def start_notification_server():
+    global notify_runner
+    app = web.Application()
+    app.router.add_post(YOOKASSA_NOTIFY_PATH, yookassa_notification)
+    notify_runner = web.AppRunner(app)
+    await notify_runner.setup()
+    await web.TCPSite(notify_runner, YOOKASSA_NOTIFY_HOST, YOOKASSA_NOTIFY_PORT).start()
+    log.info("YooKassa notifications on %s:%s%s", YOOKASSA_NOTIFY_HOST, YOOKASSA_NOTIFY_PORT, YOOKASSA_NOTIFY_PATH)
+
+# ========== Singleton jobs ==========
+# Instances sharing the database all serve updates; the jobs below must run on exactly one of them,
+# the holder of the "jobs" lease. If it dies, another instance takes over within JOBS_LEASE_TTL.
+singleton_tasks = []
+
+async def start_singleton_jobs():
+    log.info("Instance %s runs the payment watcher, outbox, archiver and broadcasts", INSTANCE_ID)
+    outbox.start()
+    order_archiver.start()
+    singleton_tasks.append(asyncio.create_task(payment_watcher()))
+    singleton_tasks.append(asyncio.create_task(broadcast_runner()))
+
+async def stop_singleton_jobs():
+    # wait for the jobs to unwind before the lease is released: the next holder must not start them
+    # while a cancelled send or archive batch of ours is still finishing
+    tasks = list(singleton_tasks)
+    singleton_tasks.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await outbox.stop()  # undelivered rows stay in the table for the next holder
+    await order_archiver.stop()
+
+jobs_lease = Lease(db, "jobs", INSTANCE_ID, ttl=JOBS_LEASE_TTL, on_acquire=start_singleton_jobs, on_lose=stop_singleton_jobs)
+
+# ========== Telegram webhook ==========
+async def telegram_webhook(request: web.Request):
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    try:
+        update = types.Update(**await request.json())
+    except (ValueError, TypeError):
+        return web.Response(status=400)
+    try:
+        await update_scheduler.submit(update, wait=False)
+    except SchedulerFull:
+        # Telegram keeps the update and redelivers it; waiting here would only time the request out
+        return web.Response(status=503)
+    return web.Response()
+
+async def on_webhook_startup(app: web.Application):
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    await on_startup(dp)
+    if WEBHOOK_URL:
+        # same URL from every instance: the balancer in front of them
+        await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None)
+
+async def on_webhook_shutdown(app: web.Application):
+    await on_shutdown(dp)
+    await (await bot.get_session()).close()
+
+def run_webhook():
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    app.on_startup.append(on_webhook_startup)
+    app.on_shutdown.append(on_webhook_shutdown)
+    log.info("Webhook on %s:%s%s (instance %s)", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, INSTANCE_ID)
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, print=None)
 
 # ========== startup ==========
+catalog_sync_task = None
+
 async def on_startup(_):
-    init_db()
-    ensure_sample_gifts()
-    asyncio.create_task(payment_watcher())
-    log.info("Bot started")
+    global catalog_sync_task
+    await init_db()
+    await ensure_sample_gifts()
+    if YOOKASSA_NOTIFY_PORT:
+        await start_notification_server()
+    admin_notifier.start()
+    if METRICS_PORT:
+        await start_metrics_server()
+    dp.storage.start()
+    user_registry.start()
+    update_scheduler.start()
+    catalog_sync_task = asyncio.create_task(catalog_sync())
+    jobs_lease.start()
+    log.info("Bot started (%s, instance %s)", RUN_MODE, INSTANCE_ID)
+
+async def on_shutdown(_):
+    await update_scheduler.stop()  # no new updates arrive; let queued ones finish
+    await jobs_lease.stop()  # stops the singleton jobs and hands the lease over
+    if catalog_sync_task:
+        catalog_sync_task.cancel()
+    await admin_notifier.stop()
+    await dp.storage.close()  # last write-behind flush while the DB is still open
+    await user_registry.stop()
+    if notify_runner:
+        await notify_runner.cleanup()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    await yookassa.close()
+    db.close()
 
 if __name__ == "__main__":
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
\ No newline at end of file
+    if RUN_MODE == "webhook":
+        run_webhook()
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1,164 @@
+# callback_router.py
+import base64
+import hashlib
+import hmac
+import logging
+from datetime import date, datetime
+
+from aiogram import types
+
+log = logging.getLogger(__name__)
+
+MAX_CALLBACK_DATA = 64  # bytes, Telegram's limit
+B36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def b36(n: int) -> str:
+    if n < 0:
+        return "-" + b36(-n)
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = B36[r] + out
+        if not n:
+            return out
+
+
+def _str(value: str) -> str:
+    if ":" in value:
+        raise ValueError(f"':' in callback field {value!r}")
+    return value
+
+
+# field type -> (encode, decode, decode a pre-router payload); an empty str or date field is None, ints
+# (ids, cursors) are required
+FIELD_TYPES = {
+    int: (b36, lambda s: int(s, 36), int),
+    str: (_str, str, str),
+    date: (lambda d: b36(d.toordinal()), lambda s: date.fromordinal(int(s, 36)),
+           lambda s: datetime.strptime(s, "%Y%m%d").date()),
+}
+
+
+class CallbackDataError(ValueError):
+    pass
+
+
+class CallbackSchema:
+    """One kind of button: a short tag + version, typed fields and the handler that receives them."""
+    __slots__ = ("name", "key", "fields", "signed", "droppable", "legacy", "allowed", "handler")
+
+    def __init__(self, name: str, key: str, fields, signed: bool, droppable: bool, legacy: str, allowed):
+        self.name = name
+        self.key = key
+        self.fields = tuple(fields)  # ((name, type), ...)
+        self.signed = signed
+        self.droppable = droppable
+        self.legacy = legacy
+        self.allowed = allowed
+        self.handler = None
+
+
+class CallbackRouter:
+    """
+    Callback queries dispatched with one dict lookup: the payload prefix ("<tag><version>", or a
+    pre-router prefix such as "buy") selects the schema, the schema decodes its typed fields and
+    the handler gets them as arguments: handler(callback_query, *values).
+
+    Payloads are "<tag><version>:<field>:..." with ints and dates in base 36. A signed schema adds a
+    truncated HMAC-SHA256 of the rest as the last field, so a client cannot make up order ids.
+    Changing a schema's fields means a new version; keep the old one registered while its buttons
+    are still around in chats. Pre-router payloads ("buy:12") are accepted while `accept_legacy`;
+    signed schemas have none, since an unsigned "paid:<id>" is exactly what signing is there to refuse.
+    """
+
+    def __init__(self, secret: bytes, sig_len: int = 11, accept_legacy: bool = True):
+        self.secret = secret
+        self.sig_len = sig_len
+        self.accept_legacy = accept_legacy
+        self.rejected = 0
+        self._routes = {}  # prefix -> (schema, legacy?)
+
+    def schema(self, name: str, tag: str, *fields, version: int = 1, signed: bool = False,
+               droppable: bool = False, legacy: str = None, allowed=None) -> CallbackSchema:
+        """allowed: user ids that may press it (others get "no rights"); droppable: safe to shed under load."""
+        if signed and legacy:
+            raise ValueError(f"signed callback {name!r} cannot take unsigned {legacy!r} payloads")
+        s = CallbackSchema(name, f"{tag}{version}", fields, signed, droppable, legacy, allowed)
+        for prefix, is_legacy in ((s.key, False), (legacy, True)):
+            if prefix is None:
+                continue
+            if prefix in self._routes:
+                raise ValueError(f"callback prefix {prefix!r} already registered")
+            self._routes[prefix] = (s, is_legacy)
+        return s
+
+    def handler(self, schema: CallbackSchema):
+        def register(fn):
+            schema.handler = fn
+            return fn
+        return register
+
+    def _sign(self, text: str) -> str:
+        digest = hmac.new(self.secret, text.encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).decode()[:self.sig_len]
+
+    def encode(self, schema: CallbackSchema, *values) -> str:
+        parts = [schema.key]
+        for (_, kind), value in zip(schema.fields, values):
+            parts.append("" if value is None else FIELD_TYPES[kind][0](value))
+        data = ":".join(parts)
+        if schema.signed:
+            data += ":" + self._sign(data)
+        if len(data.encode()) > MAX_CALLBACK_DATA:
+            raise ValueError(f"callback data over {MAX_CALLBACK_DATA} bytes: {data!r}")
+        return data
+
+    def route(self, data: str):
+        """Schema for a payload by its prefix alone (no decoding), or None."""
+        hit = self._routes.get((data or "").partition(":")[0])
+        return hit[0] if hit else None
+
+    def decode(self, data: str):
+        """(schema, values); CallbackDataError for unknown, malformed, legacy-when-off or badly signed payloads."""
+        prefix, _, rest = (data or "").partition(":")
+        hit = self._routes.get(prefix)
+        if hit is None:
+            raise CallbackDataError(f"unknown callback {data!r}")
+        schema, is_legacy = hit
+        if is_legacy and not self.accept_legacy:
+            raise CallbackDataError(f"legacy callback {data!r}")
+        raw = rest.split(":") if schema.fields else []
+        if schema.signed:
+            body, _, sig = data.rpartition(":")
+            if not hmac.compare_digest(sig, self._sign(body)):
+                raise CallbackDataError(f"bad signature on {data!r}")
+            raw = raw[:-1]
+        if len(raw) != len(schema.fields):
+            raise CallbackDataError(f"expected {len(schema.fields)} fields in {data!r}")
+        try:
+            values = tuple(None if s == "" and kind is not int else FIELD_TYPES[kind][2 if is_legacy else 1](s)
+                           for (_, kind), s in zip(schema.fields, raw))
+        except ValueError as e:
+            raise CallbackDataError(f"bad field in {data!r}: {e}") from None
+        return schema, values
+
+    def handler_name(self, data: str) -> str:
+        schema = self.route(data)
+        return getattr(schema.handler, "__name__", "unknown") if schema else "unknown"
+
+    async def dispatch(self, callback_q: types.CallbackQuery):
+        try:
+            schema, values = self.decode(callback_q.data)
+        except CallbackDataError as e:
+            self.rejected += 1
+            log.warning("Rejected callback from %s: %s", callback_q.from_user.id, e)
+            await callback_q.answer("Кнопка устарела.")
+            return
+        if schema.allowed is not None and callback_q.from_user.id not in schema.allowed:
+            await callback_q.answer("Нет прав для этого действия.")
+            return
+        if schema.handler is None:
+            await callback_q.answer()
+            return
+        await schema.handler(callback_q, *values)
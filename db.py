@@ -0,0 +1,202 @@
+# db.py
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",  # ~16 MB page cache per connection
+    "PRAGMA mmap_size=67108864",
+)
+
+WriteResult = namedtuple("WriteResult", "lastrowid rowcount rows")
+
+
+def split_sql(script: str):
+    """Splits a script into complete statements (executescript would commit our transaction)."""
+    stmt = ""
+    for line in script.splitlines(keepends=True):
+        stmt += line
+        if sqlite3.complete_statement(stmt):
+            if stmt.strip():
+                yield stmt.strip()
+            stmt = ""
+    if stmt.strip():
+        yield stmt.strip()
+
+
+class Database:
+    """SQLite access layer: one long-lived writer connection plus a small pool of
+    reader connections, each driven from its own executor thread so the event
+    loop never waits on disk I/O."""
+
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self._writer = None
+        self._conns = []
+        self._conns_lock = threading.Lock()
+        self._local = threading.local()
+        self._write_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._read_pool = ThreadPoolExecutor(max_workers=max(1, readers), thread_name_prefix="db-reader")
+        self._scan_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="db-scan")
+        self.observer = None  # callable(op, sql, seconds): timing hook, includes executor queue wait
+
+    # ----- connections (created lazily inside the executor threads) -----
+    def _open(self, readonly: bool = False):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
+        with self._conns_lock:
+            self._conns.append(conn)
+        return conn
+
+    def _writer_conn(self):
+        if self._writer is None:
+            self._writer = self._open()
+        return self._writer
+
+    def _reader_conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._open(readonly=True)
+        return conn
+
+    async def _run(self, pool, fn, op: str = "", sql: str = ""):
+        loop = asyncio.get_running_loop()
+        if self.observer is None:
+            return await loop.run_in_executor(pool, fn)
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(pool, fn)
+        finally:
+            self.observer(op, sql, time.perf_counter() - started)
+
+    # ----- reads -----
+    async def fetchall(self, sql: str, params=()):
+        def _do():
+            return self._reader_conn().execute(sql, params).fetchall()
+        return await self._run(self._read_pool, _do, "fetchall", sql)
+
+    async def fetchone(self, sql: str, params=()):
+        def _do():
+            return self._reader_conn().execute(sql, params).fetchone()
+        return await self._run(self._read_pool, _do, "fetchone", sql)
+
+    async def scan(self, fn, *args):
+        """Runs fn(conn, *args) on a private read-only connection inside one read transaction, in a
+        thread of its own: for long scans that iterate a cursor row by row (exports) instead of
+        fetchall(). fn sees one consistent snapshot, and the reader pool stays free meanwhile."""
+        def _do():
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            try:
+                for pragma in PRAGMAS:
+                    conn.execute(pragma)
+                conn.execute("PRAGMA query_only=ON")
+                conn.execute("BEGIN")
+                try:
+                    return fn(conn, *args)
+                finally:
+                    conn.execute("ROLLBACK")
+            finally:
+                conn.close()
+        return await self._run(self._scan_pool, _do, "scan", getattr(fn, "__name__", ""))
+
+    # ----- writes -----
+    async def execute(self, sql: str, params=()):
+        """Runs a single write statement; RETURNING rows are fetched into .rows"""
+        def _do():
+            cur = self._writer_conn().execute(sql, params)
+            rows = cur.fetchall() if cur.description else []
+            return WriteResult(cur.lastrowid, cur.rowcount, rows)
+        return await self._run(self._write_pool, _do, "execute", sql)
+
+    async def executemany(self, sql: str, seq_of_params):
+        def _do():
+            conn = self._writer_conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = conn.executemany(sql, seq_of_params)
+                conn.execute("COMMIT")
+                return cur.rowcount
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return await self._run(self._write_pool, _do, "executemany", sql)
+
+    async def executescript(self, script: str):
+        def _do():
+            self._writer_conn().executescript(script)
+        return await self._run(self._write_pool, _do, "executescript", script)
+
+    async def transaction(self, fn, *args):
+        """Runs fn(conn, *args) on the writer thread inside BEGIN IMMEDIATE ... COMMIT."""
+        def _do():
+            conn = self._writer_conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn, *args)
+                conn.execute("COMMIT")
+                return result
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return await self._run(self._write_pool, _do, "transaction", getattr(fn, "__name__", ""))
+
+    async def migrate(self, migrations):
+        """Applies ordered (version, name, step) migrations not yet recorded in schema_migrations.
+        step is an SQL script or a callable(conn); each one runs in its own transaction, so instances
+        starting together on one file apply every step once."""
+        def _do():
+            conn = self._writer_conn()
+            conn.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, name TEXT, applied_at TEXT)")
+            applied = {r[0] for r in conn.execute("SELECT version FROM schema_migrations")}
+            done = []
+            for version, name, step in sorted(migrations, key=lambda m: m[0]):
+                if version in applied:
+                    continue
+                conn.execute("BEGIN IMMEDIATE")
+                if conn.execute("SELECT 1 FROM schema_migrations WHERE version = ?", (version,)).fetchone():
+                    # another instance on the same file applied it while we waited for the lock
+                    conn.execute("ROLLBACK")
+                    continue
+                try:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        for stmt in split_sql(step):
+                            conn.execute(stmt)
+                    conn.execute("INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                                 (version, name, datetime.utcnow().isoformat()))
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                log.info("Applied migration %s %s", version, name)
+                done.append(version)
+            return done
+        return await self._run(self._write_pool, _do, "migrate")
+
+    def close(self):
+        self._write_pool.shutdown(wait=True)
+        self._read_pool.shutdown(wait=True)
+        self._scan_pool.shutdown(wait=True)
+        with self._conns_lock:
+            for conn in self._conns:
+                try:
+                    conn.close()
+                except Exception as e:
+                    log.warning("DB close failed: %s", e)
+            self._conns.clear()
+        self._writer = None
@@ -0,0 +1,301 @@
+# fake_telegram.py
+"""Local stand-in for the Telegram Bot API plus a webhook sender, for running several bot instances offline.
+
+    python fake_telegram.py --port 8081 --secret s3cret --users 20 \
+        --webhook http://127.0.0.1:8443/telegram/webhook,http://127.0.0.1:8444/telegram/webhook
+    TELEGRAM_API_BASE=http://127.0.0.1:8081 API_TOKEN=123456:FAKEFAKEFAKEFAKEFAKEFAKEFAKEFAKEFAKE \
+        RUN_MODE=webhook WEBHOOK_PORT=8443 WEBHOOK_SECRET=s3cret DB_PATH=/tmp/shared.db \
+        ADMINS=777000 MANAGER_CHAT_ID=777000 INSTANCE_ID=a python bot.py
+    ... and the same with WEBHOOK_PORT=8444 INSTANCE_ID=b in another terminal
+
+Without --webhook only the API is served (python fake_telegram.py --port 8081).
+
+Once every instance answers, the sender plays each virtual buyer (/start, catalog, page flips, buy:, paid:,
+screenshot, then the manager's admin_confirm once the test-mode payment is noticed) and posts the updates to
+the instances round-robin, like Telegram behind a balancer; a refused or failed delivery is retried on the
+next instance. The report counts the payment and delivery messages each buyer got: exactly one of each
+means the background jobs ran once, and the exit status is 1 unless every buyer finished that way. Kill an
+instance mid-run to watch the other take the jobs lease over; an event that was being sent at the moment of
+the kill may then arrive twice (the outbox is at-least-once).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import re
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+MANAGER_ID = 777000
+
+
+class FakeTelegram:
+    """Every Bot API call sleeps `latency` and returns a plausible result. Used in-process as aiogram's
+    make_request (bench.py) or behind make_app() as an HTTP server. With `record`, outgoing messages
+    are kept per chat as (method, text, reply_markup)."""
+
+    def __init__(self, latency: float = 0.0, record: bool = False):
+        self.latency = latency
+        self.record = record
+        self.calls = 0
+        self.sent = {}
+        self._ids = itertools.count(1)
+
+    async def make_request(self, session, server, token, method, data=None, files=None, **kwargs):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        data = data or {}
+        if self.record and data.get("chat_id") is not None:
+            self.sent.setdefault(str(data["chat_id"]), []).append(
+                (method, data.get("text") or data.get("caption") or "", data.get("reply_markup") or ""))
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "sendMediaGroup":
+            media = json.loads(data.get("media") or "[]")
+            return [{"message_id": next(self._ids), "date": int(time.time()), "chat": {"id": int(data["chat_id"]), "type": "private"},
+                     "photo": [{"file_id": m["media"], "file_unique_id": m["media"], "width": 1, "height": 1}]} for m in media]
+        if method in ("sendMessage", "sendPhoto", "sendDocument", "forwardMessage", "editMessageText", "editMessageMedia"):
+            chat_id = data.get("chat_id")
+            msg = {"message_id": next(self._ids), "date": int(time.time()),
+                   "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else 0, "type": "private"}}
+            if method == "sendPhoto" or method == "editMessageMedia":
+                msg["photo"] = [{"file_id": "F", "file_unique_id": "F", "width": 1, "height": 1}]
+            elif method == "sendDocument":
+                msg["document"] = {"file_id": "D", "file_unique_id": "D"}
+            else:
+                msg["text"] = data.get("text", "")
+            return msg
+        return True
+
+    def messages(self, chat_id) -> list:
+        return self.sent.get(str(chat_id), [])
+
+    async def wait_for(self, chat_id, pred, start: int = 0, timeout: float = 30.0):
+        """First (method, text, reply_markup) sent to chat_id at index >= start that pred() accepts."""
+        deadline = time.monotonic() + timeout
+        while True:
+            for item in self.messages(chat_id)[start:]:
+                if pred(item):
+                    return item
+            if time.monotonic() > deadline:
+                raise asyncio.TimeoutError(f"chat {chat_id}: no matching message in {timeout}s")
+            await asyncio.sleep(0.02)
+
+    async def api(self, request: web.Request):
+        data = dict(request.query)
+        data.update(await request.post())
+        result = await self.make_request(None, None, None, request.match_info["method"], data)
+        return web.json_response({"ok": True, "result": result})
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.api)
+        return app
+
+
+class UpdateFactory:
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}"}
+
+    def message(self, uid, text=None, photo=False):
+        from aiogram import types
+        n = next(self._ids)
+        msg = {"message_id": n, "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "from": self._user(uid)}
+        if photo:
+            msg["photo"] = [{"file_id": f"shot{n}", "file_unique_id": f"shot{n}", "width": 1, "height": 1}]
+        else:
+            msg["text"] = text
+            if text.startswith("/"):
+                msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return types.Update(update_id=n, message=msg)
+
+    def callback(self, uid, data, message_text="catalog"):
+        from aiogram import types
+        n = next(self._ids)
+        return types.Update(update_id=n, callback_query={
+            "id": str(n), "from": self._user(uid), "chat_instance": str(uid), "data": data,
+            "message": {"message_id": n, "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+                        "text": message_text},
+        })
+
+
+class WebhookSender:
+    """Delivers updates to the bot instances round-robin. Like Telegram, anything but 200 (or no answer)
+    is a failed delivery and is retried, here on the next instance."""
+
+    def __init__(self, urls, secret: str = None, retries: int = 30, retry_delay: float = 0.5):
+        self.urls = list(urls)
+        self.secret = secret
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.delivered = {url: 0 for url in self.urls}
+        self.refused = 0
+        self.failed = 0
+        self._rr = itertools.cycle(self.urls)
+        self._session = None
+
+    async def send(self, update):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret} if self.secret else {}
+        body = update.to_python()
+        for _ in range(self.retries):
+            url = next(self._rr)
+            try:
+                async with self._session.post(url, json=body, headers=headers) as resp:
+                    if resp.status == 200:
+                        self.delivered[url] += 1
+                        return
+                    self.refused += 1
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                self.failed += 1
+            await asyncio.sleep(self.retry_delay)
+        raise RuntimeError(f"update {body['update_id']} not delivered after {self.retries} attempts")
+
+    async def wait_ready(self, timeout: float = 120.0):
+        """Until every instance answers at all (any status: nothing is delivered by the probe)."""
+        deadline = time.monotonic() + timeout
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=2)) as session:
+            for url in self.urls:
+                while True:
+                    try:
+                        async with session.get(url):
+                            break
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        if time.monotonic() > deadline:
+                            raise
+                        await asyncio.sleep(0.5)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+ORDER_RE = re.compile(r"#(\d+)")
+
+
+def button(item, label: str):
+    """callback_data of the first inline button in a sent message whose text starts with label, or None."""
+    if not item or not item[2]:
+        return None
+    markup = json.loads(item[2]) if isinstance(item[2], str) else item[2]
+    for row in markup.get("inline_keyboard", ()):
+        for b in row:
+            if b.get("text", "").startswith(label) and b.get("callback_data"):
+                return b["callback_data"]
+    return None
+
+
+def is_payment_notice(item) -> bool:
+    return item[1].startswith("Оплата")
+
+
+def is_delivery(item) -> bool:
+    return "Ваш подарок" in item[1]
+
+
+async def run_buyers(args, fake: FakeTelegram):
+    sender = WebhookSender(args.webhook.split(","), args.secret)
+    updates = UpdateFactory()
+    results = {}
+    print(f"Waiting for {len(sender.urls)} bot instances")
+    await sender.wait_ready()
+
+    async def step(uid, update, pred=lambda item: True, timeout=args.timeout):
+        start = len(fake.messages(uid))
+        await sender.send(update)
+        return await fake.wait_for(uid, pred, start, timeout)
+
+    async def buyer(uid):
+        await step(uid, updates.message(uid, "/start"))
+        # callback data is opaque (typed, some of it signed): press the buttons the bot sent
+        page = await step(uid, updates.message(uid, "🛒 Купить подарок"), lambda item: button(item, "Купить"))
+        for _ in range(args.pages):
+            nxt = button(page, "Вперед")
+            if not nxt:
+                break
+            page = await step(uid, updates.callback(uid, nxt), lambda item: button(item, "Купить"))
+        created = await step(uid, updates.callback(uid, button(page, "Купить")), lambda item: button(item, "Я оплатил"))
+        order_id = int(ORDER_RE.search(created[1]).group(1))
+        await step(uid, updates.callback(uid, button(created, "Я оплатил")), lambda item: "скрин" in item[1])
+        await step(uid, updates.message(uid, photo=True), lambda item: "отправлен менеджеру" in item[1])
+        review = await fake.wait_for(MANAGER_ID, lambda item: item[1].startswith(f"Заявка #{order_id} "), 0, args.timeout)
+        # test mode "pays" every order after 15 s on whichever instance holds the jobs lease
+        await fake.wait_for(uid, is_payment_notice, 0, args.paid_timeout)
+        await sender.send(updates.callback(MANAGER_ID, button(review, "✅")))
+        await fake.wait_for(uid, is_delivery, 0, args.timeout)
+        results[uid] = order_id
+
+    async def guarded(uid):
+        try:
+            await buyer(uid)
+        except Exception as e:
+            print(f"buyer {uid}: {e!r}", file=sys.stderr)
+
+    started = time.monotonic()
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def limited(uid):
+        async with sem:
+            await guarded(uid)
+
+    buyers = [100000 + i for i in range(args.users)]
+    await asyncio.gather(*(limited(uid) for uid in buyers))
+    await asyncio.sleep(args.settle)  # let late duplicates show up
+    await sender.close()
+
+    notices = {uid: sum(1 for item in fake.messages(uid) if is_payment_notice(item)) for uid in results}
+    deliveries = {uid: sum(1 for item in fake.messages(uid) if is_delivery(item)) for uid in results}
+    print(f"{len(results)}/{args.users} buyers finished in {time.monotonic() - started:.1f}s")
+    print("deliveries per instance: " + ", ".join(f"{url} {n}" for url, n in sender.delivered.items())
+          + f"; refused {sender.refused}, failed {sender.failed}")
+    bad = [uid for uid in results if notices[uid] != 1 or deliveries[uid] != 1]
+    print(f"payment notices per buyer: {sorted(set(notices.values()))}, deliveries per buyer: {sorted(set(deliveries.values()))}")
+    for uid in bad:
+        print(f"buyer {uid} order #{results[uid]}: {notices[uid]} payment notices, {deliveries[uid]} deliveries")
+    unfinished = sorted(set(buyers) - set(results))
+    if unfinished or bad:
+        print(f"FAIL: {len(unfinished)} buyers unfinished {unfinished[:20]}, {len(bad)} with wrong message counts")
+        return 1
+    print("OK: every buyer finished with one payment notice and one delivery")
+    return 0
+
+
+async def main(args) -> int:
+    fake = FakeTelegram(args.latency, record=True)
+    runner = web.AppRunner(fake.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    print(f"Fake Bot API on http://{args.host}:{args.port}")
+    try:
+        if not args.webhook:
+            await asyncio.Event().wait()
+        return await run_buyers(args, fake)
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API and webhook sender")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every API call")
+    parser.add_argument("--webhook", default="", help="comma-separated bot webhook URLs; without it only the API is served")
+    parser.add_argument("--secret", default=None, help="X-Telegram-Bot-Api-Secret-Token to send")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--pages", type=int, default=2, help="catalog page flips per buyer")
+    parser.add_argument("--timeout", type=float, default=30.0, help="max wait for each bot reply, s")
+    parser.add_argument("--paid-timeout", type=float, default=90.0, help="max wait for the payment notice, s")
+    parser.add_argument("--settle", type=float, default=5.0, help="wait after the last buyer before counting, s")
+    try:
+        sys.exit(asyncio.run(main(parser.parse_args())))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,147 @@
+# fake_yookassa.py
+"""Local stand-in for the YooKassa v3 API, for offline runs and load tests.
+
+    python fake_yookassa.py --port 8088 --latency 0.05 --succeed-after 15 \
+        --notify-url http://127.0.0.1:8081/yookassa/notify
+    YOOKASSA_API_BASE=http://127.0.0.1:8088/v3 YOOKASSA_SHOP_ID=test YOOKASSA_SECRET_KEY=test python bot.py
+"""
+import argparse
+import asyncio
+import logging
+import random
+import uuid
+from datetime import datetime
+
+import aiohttp
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+
+class FakeYooKassa:
+    def __init__(self, latency: float = 0.0, fail_rate: float = 0.0, succeed_after: float = None,
+                 notify_url: str = None):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.succeed_after = succeed_after
+        self.notify_url = notify_url
+        self.notifications_sent = 0
+        self.payments = {}
+        self.by_idempotence_key = {}
+        self.requests = 0
+
+    async def _delay_or_fail(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.fail_rate and random.random() < self.fail_rate:
+            raise web.HTTPServiceUnavailable(text='{"type": "error", "code": "internal_server_error"}',
+                                             content_type="application/json")
+
+    async def _auto_succeed(self, payment_id: str):
+        await asyncio.sleep(self.succeed_after)
+        if self.payments[payment_id]["status"] == "pending":
+            self.set_status(payment_id, "succeeded")
+
+    async def _notify(self, payment: dict):
+        body = {"type": "notification", "event": f"payment.{payment['status']}", "object": self._public(payment)}
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(self.notify_url, json=body) as resp:
+                    self.notifications_sent += 1
+                    log.info("Notification %s %s -> %s", body["event"], payment["id"], resp.status)
+        except aiohttp.ClientError as e:
+            log.warning("Notification to %s failed: %s", self.notify_url, e)
+
+    def _public(self, payment: dict) -> dict:
+        return {k: v for k, v in payment.items() if not k.startswith("_")}
+
+    async def create_payment(self, request: web.Request):
+        await self._delay_or_fail()
+        key = request.headers.get("Idempotence-Key")
+        if not key:
+            return web.json_response({"type": "error", "code": "invalid_request"}, status=400)
+        if key in self.by_idempotence_key:
+            return web.json_response(self._public(self.payments[self.by_idempotence_key[key]]))
+        body = await request.json()
+        pid = str(uuid.uuid4())
+        payment = {
+            "id": pid,
+            "status": "pending",
+            "paid": False,
+            "amount": body.get("amount"),
+            "description": body.get("description"),
+            "metadata": body.get("metadata") or {},
+            "created_at": datetime.utcnow().isoformat(timespec="milliseconds") + "Z",
+            "confirmation": {"type": "redirect", "confirmation_url": f"https://yoomoney.example/checkout?orderId={pid}"},
+        }
+        self.payments[pid] = payment
+        self.by_idempotence_key[key] = pid
+        if self.succeed_after is not None:
+            asyncio.ensure_future(self._auto_succeed(pid))
+        return web.json_response(self._public(payment))
+
+    async def get_payment(self, request: web.Request):
+        await self._delay_or_fail()
+        payment = self.payments.get(request.match_info["payment_id"])
+        if not payment:
+            return web.json_response({"type": "error", "code": "not_found"}, status=404)
+        return web.json_response(self._public(payment))
+
+    async def list_payments(self, request: web.Request):
+        """GET /v3/payments with status, created_at.gte, limit and an opaque cursor (an offset here)."""
+        await self._delay_or_fail()
+        q = request.query
+        items = sorted(self.payments.values(), key=lambda p: p["created_at"], reverse=True)
+        if q.get("status"):
+            items = [p for p in items if p["status"] == q["status"]]
+        if q.get("created_at.gte"):
+            items = [p for p in items if p["created_at"] >= q["created_at.gte"]]
+        try:
+            limit = max(1, min(100, int(q.get("limit", "10"))))
+            offset = int(q.get("cursor") or 0)
+        except ValueError:
+            return web.json_response({"type": "error", "code": "invalid_request"}, status=400)
+        page = items[offset:offset + limit]
+        body = {"type": "list", "items": [self._public(p) for p in page]}
+        if offset + limit < len(items):
+            body["next_cursor"] = str(offset + limit)
+        return web.json_response(body)
+
+    def set_status(self, payment_id: str, status: str):
+        payment = self.payments[payment_id]
+        payment["status"] = status
+        payment["paid"] = status in ("succeeded", "waiting_for_capture")
+        if self.notify_url:
+            asyncio.ensure_future(self._notify(payment))
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v3/payments", self.create_payment)
+        app.router.add_get("/v3/payments", self.list_payments)
+        app.router.add_get("/v3/payments/{payment_id}", self.get_payment)
+        return app
+
+
+async def start_fake_yookassa(host: str = "127.0.0.1", port: int = 8088, **kwargs):
+    """Starts the fake server on the running loop. Returns (FakeYooKassa, AppRunner)."""
+    fake = FakeYooKassa(**kwargs)
+    runner = web.AppRunner(fake.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return fake, runner
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Fake YooKassa API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8088)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--succeed-after", type=float, default=None, help="payments become succeeded after N seconds")
+    parser.add_argument("--notify-url", default=None, help="bot endpoint for payment.* notifications")
+    args = parser.parse_args()
+    fake = FakeYooKassa(latency=args.latency, fail_rate=args.fail_rate, succeed_after=args.succeed_after,
+                        notify_url=args.notify_url)
+    web.run_app(fake.make_app(), host=args.host, port=args.port)
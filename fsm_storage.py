@@ -0,0 +1,225 @@
+# fsm_storage.py
+import asyncio
+import copy
+import json
+import logging
+import time
+import typing
+from collections import OrderedDict
+
+from aiogram.dispatcher.storage import BaseStorage
+
+log = logging.getLogger(__name__)
+
+EMPTY = (None, {}, {})
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM storage persisted in the fsm_states table (see MIGRATIONS in bot.py).
+
+    Reads are served from a bounded LRU cache (users without a state are cached too, so the
+    per-update state check rarely touches the disk). Writes only mark the cached record dirty;
+    a background task flushes dirty records in one transaction every `flush_interval` seconds.
+    States untouched for `ttl` seconds are dropped from the cache and the table.
+
+    With `shared` (several bot instances on one database, updates of a chat landing on any of them)
+    every read goes to the table and every write is flushed before the handler continues.
+    """
+
+    def __init__(self, db, ttl: float = 86400, flush_interval: float = 1.0, max_cached: int = 10000,
+                 sweep_interval: float = 600, shared: bool = False):
+        self.db = db
+        self.shared = shared
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.max_cached = max_cached
+        self.sweep_interval = sweep_interval
+        self._cache = OrderedDict()  # (chat, user) -> [state, data, bucket, updated_at]
+        self._dirty = set()
+        self._inflight = set()  # taken from _dirty by a flush that has not committed yet
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._closed = False
+
+    def start(self):
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def wait_closed(self):
+        pass
+
+    # ----- cache -----
+    def _key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return str(chat), str(user)
+
+    def _pinned(self, key) -> bool:
+        """The cached record is newer than the table row: it must not be evicted or re-read."""
+        return key in self._dirty or key in self._inflight
+
+    async def _record(self, chat, user):
+        key = self._key(chat, user)
+        rec = self._cache.get(key)
+        if rec is not None and (not self.shared or self._pinned(key)):
+            self._cache.move_to_end(key)
+            return key, rec
+        row = await self.db.fetchone("SELECT state, data, bucket, updated_at FROM fsm_states WHERE chat = ? AND user = ?", key)
+        rec = self._cache.get(key)  # filled while we were waiting on the read
+        if rec is None or (self.shared and not self._pinned(key)):
+            if row and time.time() - row[3] < self.ttl:
+                rec = [row[0], json.loads(row[1] or "{}"), json.loads(row[2] or "{}"), row[3]]
+            else:
+                rec = [None, {}, {}, time.time()]
+            self._cache[key] = rec
+            self._evict()
+        return key, rec
+
+    async def _touch(self, key, rec):
+        rec[3] = time.time()
+        self._dirty.add(key)
+        if self.shared:
+            await self.flush()
+
+    def _evict(self):
+        # only clean records can go: dirty and in-flight ones still have to reach the table
+        if len(self._cache) <= self.max_cached:
+            return
+        # oldest first; a pinned record goes back at the recent end, and once only passed-over records
+        # are left (skipped == len) every one of them is pinned
+        skipped = 0
+        while len(self._cache) > self.max_cached and skipped < len(self._cache):
+            key, rec = self._cache.popitem(last=False)
+            if self._pinned(key):
+                self._cache[key] = rec
+                skipped += 1
+
+    # ----- write-behind -----
+    async def flush(self):
+        if not self._dirty:
+            return
+        async with self._flush_lock:
+            if not self._dirty:  # committed by the flush we waited for
+                return
+            keys, self._dirty = self._dirty, set()
+            self._inflight = keys
+            try:
+                await self._commit(keys)
+            except Exception:
+                self._dirty |= keys  # retry on the next tick
+                raise
+            finally:
+                self._inflight = set()
+
+    async def _commit(self, keys):
+        upserts, deletes = [], []
+        for key in keys:
+            rec = self._cache.get(key)
+            if rec is None:
+                continue  # pinned records stay cached; never guess a delete from a missing one
+            if tuple(rec[:3]) == EMPTY:
+                deletes.append(key)
+            else:
+                upserts.append((key[0], key[1], rec[0], json.dumps(rec[1]), json.dumps(rec[2]), rec[3]))
+
+        def _write(conn):
+            if deletes:
+                conn.executemany("DELETE FROM fsm_states WHERE chat = ? AND user = ?", deletes)
+            if upserts:
+                conn.executemany(
+                    "INSERT INTO fsm_states (chat, user, state, data, bucket, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(chat, user) DO UPDATE SET state = excluded.state, data = excluded.data, "
+                    "bucket = excluded.bucket, updated_at = excluded.updated_at", upserts)
+        await self.db.transaction(_write)
+
+    def sweep_cache(self):
+        cutoff = time.time() - self.ttl
+        for key, rec in list(self._cache.items()):
+            if rec[3] < cutoff and not self._pinned(key):
+                del self._cache[key]
+
+    async def _flush_loop(self):
+        last_sweep = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_sweep >= self.sweep_interval:
+                    last_sweep = time.monotonic()
+                    self.sweep_cache()
+                    await self.db.execute("DELETE FROM fsm_states WHERE updated_at < ?", (time.time() - self.ttl,))
+            except Exception:
+                log.exception("FSM storage flush failed")
+
+    # ----- BaseStorage -----
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        _, rec = await self._record(chat, user)
+        return rec[0] if rec[0] is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        _, rec = await self._record(chat, user)
+        return copy.deepcopy(rec[1])
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key, rec = await self._record(chat, user)
+        rec[0] = self.resolve_state(state)
+        await self._touch(key, rec)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, rec = await self._record(chat, user)
+        rec[1] = copy.deepcopy(data or {})
+        await self._touch(key, rec)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        key, rec = await self._record(chat, user)
+        rec[1].update(data or {}, **kwargs)
+        await self._touch(key, rec)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        _, rec = await self._record(chat, user)
+        return copy.deepcopy(rec[2])
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key, rec = await self._record(chat, user)
+        rec[2] = copy.deepcopy(bucket or {})
+        await self._touch(key, rec)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        key, rec = await self._record(chat, user)
+        rec[2].update(bucket or {}, **kwargs)
+        await self._touch(key, rec)
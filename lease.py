@@ -0,0 +1,98 @@
+# lease.py
+import asyncio
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Lease:
+    """
+    A named lease row in the leases table (see MIGRATIONS in bot.py), shared by every instance that
+    uses the same database. The holder renews it every ttl/3; the others try to take it on the same
+    period and get it once it has expired, i.e. the holder stopped heartbeating (crashed, hung, lost
+    the disk).
+
+    on_acquire() / on_lose() are coroutine functions run when this instance gains or gives up the
+    lease. A holder that cannot renew gives up on its own before the row expires, so with clocks in
+    sync two instances never run the guarded jobs at the same time.
+    """
+
+    def __init__(self, db, name: str, owner: str, ttl: float = 15.0, on_acquire=None, on_lose=None):
+        self.db = db
+        self.name = name
+        self.owner = owner
+        self.ttl = ttl
+        self.on_acquire = on_acquire
+        self.on_lose = on_lose
+        self.held = False
+        self.expires_at = 0.0
+        self.acquired_total = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the guarded jobs and releases the row, so a standby takes over within one period."""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self.held:
+            await self._lose()
+            try:
+                await self.db.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (self.name, self.owner))
+            except Exception:
+                log.exception("Lease %s release failed", self.name)
+
+    async def try_acquire(self) -> bool:
+        """Takes or renews the lease: one UPSERT that only wins if we hold it or it has expired."""
+        now = time.time()
+        res = await self.db.execute(
+            "INSERT INTO leases (name, owner, expires_at, heartbeat_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at, "
+            "heartbeat_at = excluded.heartbeat_at WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+            (self.name, self.owner, now + self.ttl, now, now))
+        if res.rowcount == 1:
+            self.expires_at = now + self.ttl
+            return True
+        return False
+
+    async def holder(self):
+        """(owner, seconds until expiry) of the current row, or None."""
+        row = await self.db.fetchone("SELECT owner, expires_at FROM leases WHERE name = ?", (self.name,))
+        return (row[0], row[1] - time.time()) if row else None
+
+    async def _gain(self):
+        self.held = True
+        self.acquired_total += 1
+        log.info("Lease %s acquired by %s", self.name, self.owner)
+        if self.on_acquire:
+            try:
+                await self.on_acquire()
+            except Exception:
+                log.exception("Lease %s on_acquire failed", self.name)
+
+    async def _lose(self):
+        self.held = False
+        log.warning("Lease %s given up by %s", self.name, self.owner)
+        if self.on_lose:
+            try:
+                await self.on_lose()
+            except Exception:
+                log.exception("Lease %s on_lose failed", self.name)
+
+    async def _run(self):
+        period = self.ttl / 3
+        while True:
+            try:
+                got = await self.try_acquire()
+            except Exception:
+                log.exception("Lease %s heartbeat failed", self.name)
+                # keep running only while the row is sure to outlive the next attempt
+                got = self.held and time.time() + period < self.expires_at
+            if got and not self.held:
+                await self._gain()
+            elif not got and self.held:
+                await self._lose()
+            await asyncio.sleep(period)
@@ -0,0 +1,168 @@
+# metrics.py
+import bisect
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _fmt_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+    return "{" + body + "}"
+
+
+class Counter:
+    """Either inc() explicitly or backed by a callable returning a running total kept elsewhere, read at
+    scrape time. With labelnames, the callable returns {labels tuple: value}."""
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames=(), fn=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self.values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        if self.fn is None:
+            values = self.values
+        else:
+            values = self.fn() if self.labelnames else {(): self.fn()}
+        for labels, value in values.items():
+            yield f"{self.name}{_fmt_labels(self.labelnames, labels)} {value}"
+
+
+class Gauge:
+    """Either set() explicitly or backed by a callable read at scrape time.
+    With labelnames, the callable returns {labels tuple: value}."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn=None, labelnames=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def get(self) -> float:
+        return self.fn() if self.fn else self.value
+
+    def render(self):
+        if not self.labelnames:
+            yield f"{self.name} {self.get()}"
+            return
+        for labels, value in self.get().items():
+            yield f"{self.name}{_fmt_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+    """Fixed-bucket histogram: observe() is a bisect plus two additions."""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}  # labels -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, *labels):
+        s = self.series.get(labels)
+        if s is None:
+            s = self.series[labels] = [0] * (len(self.buckets) + 2)
+        s[bisect.bisect_left(self.buckets, value)] += 1
+        s[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def count(self, *labels) -> int:
+        s = self.series.get(labels)
+        return sum(s[:-1]) if s else 0
+
+    def total(self, *labels) -> float:
+        s = self.series.get(labels)
+        return s[-1] if s else 0.0
+
+    def quantile(self, q: float, *labels) -> float:
+        """Estimate from buckets (linear inside the bucket), like histogram_quantile()."""
+        s = self.series.get(labels)
+        if not s:
+            return 0.0
+        counts = s[:-1]
+        n = sum(counts)
+        if not n:
+            return 0.0
+        rank = q * n
+        seen = 0
+        for i, c in enumerate(counts):
+            if seen + c >= rank and c:
+                lo = self.buckets[i - 1] if i > 0 else 0.0
+                hi = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lo + (hi - lo) * (rank - seen) / c
+            seen += c
+        return self.buckets[-1]
+
+    def render(self):
+        for labels, s in self.series.items():
+            cum = 0
+            for bound, c in zip(self.buckets, s):
+                cum += c
+                yield f"{self.name}_bucket{_fmt_labels(self.labelnames, labels, ('le', bound))} {cum}"
+            cum += s[len(self.buckets)]
+            yield f"{self.name}_bucket{_fmt_labels(self.labelnames, labels, ('le', '+Inf'))} {cum}"
+            yield f"{self.name}_sum{_fmt_labels(self.labelnames, labels)} {s[-1]}"
+            yield f"{self.name}_count{_fmt_labels(self.labelnames, labels)} {cum}"
+
+
+class _Timer:
+    __slots__ = ("hist", "labels", "started")
+
+    def __init__(self, hist, labels):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.started, *self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames=(), fn=None) -> Counter:
+        return self._add(Counter(name, help, labelnames, fn))
+
+    def gauge(self, name: str, help: str, fn=None, labelnames=()) -> Gauge:
+        return self._add(Gauge(name, help, fn, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        """Prometheus text exposition format 0.0.4"""
+        out = []
+        for m in self.metrics:
+            out.append(f"# HELP {m.name} {m.help}")
+            out.append(f"# TYPE {m.name} {m.kind}")
+            out.extend(m.render())
+        return "\n".join(out) + "\n"
@@ -0,0 +1,86 @@
+import asyncio
+import os
+import socket
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_telegram import MANAGER_ID, FakeTelegram, UpdateFactory  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope="session")
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def harness(loop, tmp_path_factory):
+    """bot.py imported once against a fake Telegram (recording) and a local fake YooKassa, migrations
+    applied, no background jobs. Tests share the database: use chat ids of your own."""
+    import aiogram.bot.api as api
+    from aiogram import Bot, Dispatcher
+
+    yk_port = free_port()
+    # bot.py reads its config at import time
+    os.environ.update({
+        "API_TOKEN": "123456:TESTTESTTESTTESTTESTTESTTESTTESTTEST",
+        "DB_PATH": str(tmp_path_factory.mktemp("db") / "test.db"),
+        "TEST_MODE": "false",
+        "YOOKASSA_SHOP_ID": "test",
+        "YOOKASSA_SECRET_KEY": "test",
+        "YOOKASSA_API_BASE": f"http://127.0.0.1:{yk_port}/v3",
+        "YOOKASSA_TIMEOUT": "3",
+        "ADMINS": str(MANAGER_ID),
+        "MANAGER_CHAT_ID": str(MANAGER_ID),
+        "METRICS_PORT": "0",
+    })
+    tg = FakeTelegram(record=True)
+    api.make_request = tg.make_request
+
+    import bot
+    from fake_yookassa import start_fake_yookassa
+
+    yk, yk_runner = loop.run_until_complete(start_fake_yookassa(port=yk_port))
+    Bot.set_current(bot.bot)
+    Dispatcher.set_current(bot.dp)
+    loop.run_until_complete(bot.init_db())
+    loop.run_until_complete(bot.ensure_sample_gifts())
+    yield types.SimpleNamespace(bot=bot, tg=tg, yk=yk, updates=UpdateFactory(), run=loop.run_until_complete)
+    loop.run_until_complete(bot.yookassa.close())
+    loop.run_until_complete(yk_runner.cleanup())
+    bot.db.close()
+
+
+@pytest.fixture
+def yookassa_html(harness, monkeypatch):
+    """YooKassa behind a proxy that answers 200 with an HTML error page; fresh breaker for the test."""
+    from aiohttp import web
+    from yookassa import CircuitBreaker
+
+    async def html(request):
+        return web.Response(text="<html>502 Bad Gateway</html>", content_type="text/html")
+
+    async def start():
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", html)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0, shutdown_timeout=0.1).start()
+        return runner
+
+    runner = harness.run(start())
+    monkeypatch.setattr(harness.bot.yookassa, "api_base", f"http://127.0.0.1:{runner.addresses[0][1]}/v3")
+    monkeypatch.setattr(harness.bot.yookassa, "breaker", CircuitBreaker())
+    yield harness
+    harness.run(runner.cleanup())
@@ -0,0 +1,36 @@
+import time
+
+from aiogram.utils.exceptions import RetryAfter
+
+ADMIN = 350101
+
+
+def test_retry_after_resends_the_notification(harness, monkeypatch):
+    b = harness.bot
+    sent = []
+
+    async def send_message(chat_id, text, **kwargs):
+        if not sent:
+            sent.append(None)
+            raise RetryAfter(0.2)
+        sent.append((chat_id, text, time.monotonic()))
+
+    monkeypatch.setattr(b.bot, "send_message", send_message)
+    notifier = b.AdminNotifier([ADMIN], window=60, threshold=10, rate=100)
+    started = time.monotonic()
+    harness.run(notifier._send(ADMIN, "Новый заказ #1"))
+    assert [s[:2] for s in sent[1:]] == [(ADMIN, "Новый заказ #1")]
+    assert sent[1][2] - started >= 0.2
+    assert notifier.dropped == 0
+
+
+def test_notification_dropped_after_repeated_retry_after(harness, monkeypatch):
+    b = harness.bot
+
+    async def send_message(chat_id, text, **kwargs):
+        raise RetryAfter(0.01)
+
+    monkeypatch.setattr(b.bot, "send_message", send_message)
+    notifier = b.AdminNotifier([ADMIN], window=60, threshold=10, rate=100)
+    harness.run(notifier._send(ADMIN, "Новый заказ #2"))
+    assert notifier.dropped == 1
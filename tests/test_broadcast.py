@@ -0,0 +1,34 @@
+import asyncio
+
+from aiohttp import ClientConnectionError
+
+USERS = (370001, 370002, 370003)
+
+
+def test_network_errors_fail_the_recipient_not_the_batch(harness, monkeypatch):
+    b = harness.bot
+    delivered = []
+
+    async def send_message(chat_id, text, **kwargs):
+        if chat_id == USERS[1]:
+            raise asyncio.TimeoutError()
+        if chat_id == USERS[2]:
+            raise ClientConnectionError("connection reset")
+        delivered.append(chat_id)
+
+    async def report(*args, **kwargs):
+        return None
+
+    monkeypatch.setattr(b.bot, "send_message", send_message)
+    monkeypatch.setattr(b, "report_broadcast", report)
+
+    async def scenario():
+        await b.db.executemany("INSERT OR REPLACE INTO users (chat_id, active) VALUES (?, 1)", [(u,) for u in USERS])
+        res = await b.db.execute("INSERT INTO broadcasts (admin_chat_id, text, status, cursor) VALUES (?, ?, 'running', ?)",
+                                 (USERS[0], "Новинки!", USERS[0] - 1))
+        await b.run_broadcast(res.lastrowid)
+        return await b.db.fetchone("SELECT status, cursor, failed FROM broadcasts WHERE id = ?", (res.lastrowid,))
+
+    status, cursor, failed = harness.run(scenario())
+    assert status == "done" and cursor >= USERS[2] and failed >= 2
+    assert USERS[0] in delivered
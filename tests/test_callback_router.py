@@ -0,0 +1,76 @@
+from datetime import date
+
+import pytest
+
+from callback_router import MAX_CALLBACK_DATA, CallbackDataError, CallbackRouter
+
+
+def make_router(**kwargs):
+    r = CallbackRouter(b"secret", **kwargs)
+    schemas = {
+        "buy": r.schema("buy", "b", ("gift_id", int), legacy="buy"),
+        "paid": r.schema("paid", "d", ("order_id", int), signed=True),
+        "orders": r.schema("orders", "m", ("before_id", int), ("status", str), ("date_from", date), ("date_to", date),
+                           legacy="mo"),
+        "note": r.schema("note", "n", ("text", str)),
+    }
+    return r, schemas
+
+
+def test_round_trip():
+    r, s = make_router()
+    cases = [
+        (s["buy"], (0,)),
+        (s["buy"], (123456789,)),
+        (s["paid"], (987654321,)),
+        (s["orders"], (99999999, "delivered", date(2026, 1, 1), None)),
+        (s["orders"], (1, None, None, date(2026, 12, 31))),
+    ]
+    for schema, values in cases:
+        data = r.encode(schema, *values)
+        assert len(data.encode()) <= MAX_CALLBACK_DATA
+        assert r.decode(data) == (schema, values)
+        assert r.route(data) is schema
+
+
+def test_bad_signature_is_rejected():
+    r, s = make_router()
+    data = r.encode(s["paid"], 42)
+    body, sig = data.rsplit(":", 1)
+    for forged in (body + ":" + ("A" if sig[0] != "A" else "B") + sig[1:], "d1:16", "d1:16:xxxxxxxxxxx",
+                   CallbackRouter(b"other").encode(s["paid"], 42)):
+        with pytest.raises(CallbackDataError):
+            r.decode(forged)
+
+
+def test_signed_schemas_take_no_unsigned_legacy_payloads():
+    r, s = make_router(accept_legacy=True)
+    with pytest.raises(CallbackDataError):
+        r.decode("paid:42")  # no such prefix
+    with pytest.raises(ValueError):
+        r.schema("confirm", "c", ("order_id", int), signed=True, legacy="admin_confirm")
+
+
+def test_legacy_payloads_follow_the_switch():
+    r, s = make_router(accept_legacy=True)
+    assert r.decode("buy:12") == (s["buy"], (12,))
+    assert r.decode("mo:123:paid:20260101:") == (s["orders"], (123, "paid", date(2026, 1, 1), None))
+    r.accept_legacy = False
+    with pytest.raises(CallbackDataError):
+        r.decode("buy:12")
+
+
+def test_64_byte_limit():
+    r, s = make_router()
+    assert len(r.encode(s["note"], "x" * (MAX_CALLBACK_DATA - 3)).encode()) == MAX_CALLBACK_DATA
+    with pytest.raises(ValueError):
+        r.encode(s["note"], "x" * (MAX_CALLBACK_DATA - 2))
+    with pytest.raises(ValueError):
+        r.encode(s["note"], "я" * 31)  # the limit is in bytes, not characters
+
+
+def test_malformed_payloads_are_rejected():
+    r, s = make_router()
+    for data in ("", None, "zz:1", "b1", "b1:1:2", "b1:не-число", "m1:1:x"):
+        with pytest.raises(CallbackDataError):
+            r.decode(data)
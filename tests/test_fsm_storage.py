@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from fsm_storage import SQLiteStorage
+
+
+def cached(dirty=(), n=5, max_cached=2):
+    storage = SQLiteStorage(db=None, max_cached=max_cached)
+    for i in range(n):
+        storage._cache[(i, i)] = [None, {}, {}, 0.0]
+    storage._dirty = {(i, i) for i in dirty}
+    return storage
+
+
+def test_evict_drops_least_recent_clean_records():
+    storage = cached()
+    storage._evict()
+    assert list(storage._cache) == [(3, 3), (4, 4)]
+
+
+def test_evict_keeps_dirty_records():
+    storage = cached(dirty=(0, 2))
+    storage._evict()
+    assert set(storage._cache) == {(0, 0), (2, 2)}
+
+
+def test_evict_stops_when_only_dirty_records_are_left():
+    storage = cached(dirty=(0, 1, 2, 4))
+    storage._evict()
+    assert set(storage._cache) == {(0, 0), (1, 1), (2, 2), (4, 4)}
+
+
+class GatedDB:
+    """fetchone finds nothing; transaction() waits for `gate`, then fails once if `fail` or records the writes."""
+
+    def __init__(self):
+        self.gate = asyncio.Event()
+        self.fail = False
+        self.writes = []
+
+    async def fetchone(self, sql, params=()):
+        return None
+
+    async def transaction(self, fn):
+        await self.gate.wait()
+        if self.fail:
+            self.fail = False
+            raise RuntimeError("disk I/O error")
+        conn = self
+
+        class Conn:
+            def executemany(self, sql, rows):
+                conn.writes.append((sql.split()[0], [tuple(r[:3]) for r in rows]))
+        fn(Conn())
+
+
+def test_failed_flush_keeps_the_state_it_could_not_write(loop):
+    db = GatedDB()
+    storage = SQLiteStorage(db, max_cached=1)
+
+    async def scenario():
+        await storage.set_state(chat=1, user=1, state="Upload:waiting")
+        flushing = asyncio.create_task(storage.flush())
+        await asyncio.sleep(0)
+        await storage.get_state(chat=2, user=2)  # a cache miss past max_cached while the write is in flight
+        assert ("1", "1") in storage._cache
+        db.fail = True
+        db.gate.set()
+        with pytest.raises(RuntimeError):
+            await flushing
+        await storage.flush()
+        return db.writes
+
+    assert loop.run_until_complete(scenario()) == [("INSERT", [("1", "1", "Upload:waiting")])]
@@ -0,0 +1,100 @@
+from aiogram import Dispatcher
+
+
+def process(harness, update):
+    async def scenario():
+        Dispatcher.set_current(harness.bot.dp)
+        await harness.bot.dp.process_update(update)
+    harness.run(scenario())
+
+
+def test_paid_stores_the_upload_state_before_prompting(harness, monkeypatch):
+    b = harness.bot
+    chat = 320001
+    order_id, _ = harness.run(b.create_order(chat, 1, 100))
+    seen = []
+    send_message = b.bot.send_message
+
+    async def spy(chat_id, text, *args, **kwargs):
+        if chat_id == chat:
+            state = await b.dp.storage.get_state(user=chat)
+            data = await b.dp.storage.get_data(user=chat)
+            seen.append((state, data.get("order_id")))
+        return await send_message(chat_id, text, *args, **kwargs)
+
+    monkeypatch.setattr(b.bot, "send_message", spy)
+    process(harness, harness.updates.callback(chat, b.callbacks.encode(b.CB_PAID, order_id)))
+    assert seen == [(b.UploadStates.waiting_for_screenshot.state, order_id)]
+
+
+def click_buy_twice(harness, monkeypatch, chat: int, gift_id: int = 1):
+    """Two buy: clicks; returns (order ids for the chat, admin "new order" notices sent)."""
+    b = harness.bot
+    notices = []
+
+    async def notify(order_id):
+        notices.append(order_id)
+
+    monkeypatch.setattr(b, "notify_admins_order_created", notify)
+    for _ in range(2):
+        process(harness, harness.updates.callback(chat, b.callbacks.encode(b.CB_BUY, gift_id)))
+    rows = harness.run(b.db.fetchall("SELECT id FROM orders WHERE chat_id = ? AND gift_id = ?", (chat, gift_id)))
+    return [r[0] for r in rows], notices
+
+
+def test_double_buy_with_yookassa_reuses_the_order(harness, monkeypatch):
+    orders, notices = click_buy_twice(harness, monkeypatch, 330001)
+    assert len(orders) == 1 and notices == orders
+    assert "Ссылка для оплаты прежняя" in harness.tg.messages(330001)[-1][1]
+
+
+def test_double_buy_in_demo_mode_reuses_the_order(harness, monkeypatch):
+    async def no_yookassa(*args):
+        return None, None, "YOOKASSA not configured"
+
+    monkeypatch.setattr(harness.bot, "create_yookassa_payment", no_yookassa)
+    orders, notices = click_buy_twice(harness, monkeypatch, 330002)
+    assert len(orders) == 1 and notices == orders
+    assert "(демо)" in harness.tg.messages(330002)[-1][1]
+
+
+def test_buy_reuses_an_order_left_pending(harness, monkeypatch):
+    b = harness.bot
+    order_id, _ = harness.run(b.create_order(330003, 1, 101))  # payment never created
+    orders, notices = click_buy_twice(harness, monkeypatch, 330003)
+    assert orders == [order_id] and notices == []
+    assert f"заказ #{order_id}" in harness.tg.messages(330003)[-1][1]
+
+
+def test_opening_a_search_result_keeps_the_result_list(harness):
+    from fake_telegram import button
+    chat = 340001
+    process(harness, harness.updates.message(chat, "/search Котик"))
+    results = harness.tg.messages(chat)[-1]
+    assert results[1].startswith("Найдено")
+    sent = len(harness.tg.messages(chat))
+    process(harness, harness.updates.callback(chat, button(results, "NFT Котик"), message_text=results[1]))
+    methods = [m for m, _, _ in harness.tg.messages(chat)[sent:]]
+    assert "editMessageText" not in methods and "deleteMessage" not in methods
+    assert any(m in ("sendMessage", "sendPhoto") for m in methods)
+
+
+def test_buy_falls_back_to_demo_when_yookassa_returns_html(yookassa_html):
+    b = yookassa_html.bot
+    chat = 330004
+    process(yookassa_html, yookassa_html.updates.callback(chat, b.callbacks.encode(b.CB_BUY, 1)))
+    assert "(демо)" in yookassa_html.tg.messages(chat)[-1][1]
+
+
+def test_dropped_page_flip_is_answered(harness, monkeypatch):
+    b = harness.bot
+    answered = []
+
+    async def answer_callback_query(callback_query_id, *args, **kwargs):
+        answered.append((callback_query_id, args, kwargs))
+
+    monkeypatch.setattr(b.bot, "answer_callback_query", answer_callback_query)
+    update = harness.updates.callback(330005, b.callbacks.encode(b.CB_PAGE, 2))
+    harness.run(b.answer_dropped(update))
+    harness.run(b.answer_dropped(harness.updates.message(330005, "/start")))
+    assert answered == [(update.callback_query.id, (), {})]
@@ -0,0 +1,30 @@
+import asyncio
+
+
+def test_losing_the_lease_waits_for_the_jobs_to_unwind(harness, monkeypatch):
+    b = harness.bot
+    unwound = []
+
+    def job(name):
+        async def run():
+            try:
+                await asyncio.sleep(3600)
+            except asyncio.CancelledError:
+                await asyncio.sleep(0.05)  # e.g. a send or an archive batch finishing
+                unwound.append(name)
+                raise
+        return run
+
+    monkeypatch.setattr(b, "payment_watcher", job("payment_watcher"))
+    monkeypatch.setattr(b, "broadcast_runner", job("broadcast_runner"))
+    monkeypatch.setattr(b.outbox, "_run", job("outbox"))
+    monkeypatch.setattr(b.order_archiver, "_run", job("archiver"))
+
+    async def scenario():
+        await b.start_singleton_jobs()
+        await asyncio.sleep(0)
+        await b.stop_singleton_jobs()
+        return sorted(unwound)
+
+    assert harness.run(scenario()) == ["archiver", "broadcast_runner", "outbox", "payment_watcher"]
+    assert not b.singleton_tasks
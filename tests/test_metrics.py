@@ -0,0 +1,10 @@
+def test_db_labels(harness):
+    b = harness.bot
+
+    def _mark_seen(conn):
+        conn.execute("SELECT 1")
+
+    harness.run(b.db.transaction(_mark_seen))
+    b.observe_db("fetchall", "SELECT o.id FROM orders o JOIN gifts g ON g.id = o.gift_id", 0.001)
+    assert b.DB_SECONDS.count("transaction", "_mark_seen") == 1
+    assert b.DB_SECONDS.count("fetchall", "SELECT orders") >= 1
@@ -0,0 +1,79 @@
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+CHAT = 310001
+
+
+@pytest.fixture
+def proxied(harness, monkeypatch):
+    """One reverse proxy in front of the notification endpoint; the test client plays the proxy."""
+    monkeypatch.setattr(harness.bot, "YOOKASSA_NOTIFY_PROXY_HOPS", 1)
+    return harness
+
+
+def post_notification(harness, payment_id: str, forwarded_for: str):
+    async def scenario():
+        app = web.Application()
+        app.router.add_post("/notify", harness.bot.yookassa_notification)
+        async with TestClient(TestServer(app)) as client:
+            resp = await client.post("/notify", headers={"X-Forwarded-For": forwarded_for},
+                                     json={"event": "payment.succeeded", "object": {"id": payment_id, "status": "succeeded"}})
+            return resp.status
+    return harness.run(scenario())
+
+
+def new_order(harness):
+    async def scenario():
+        b = harness.bot
+        order_id, invoice = await b.create_order(CHAT, 1, 100)
+        payment = await b.yookassa.create_payment(invoice, 100, "test", "https://t.me/x")
+        await b.set_order_payment(order_id, payment["id"], payment["confirmation"]["confirmation_url"])
+        return order_id, payment["id"]
+    return harness.run(scenario())
+
+
+def order_status(harness, order_id: int) -> str:
+    return harness.run(harness.bot.get_order(order_id))[3]
+
+
+def test_spoofed_forwarded_for_is_not_the_source(proxied):
+    from aiohttp.test_utils import make_mocked_request
+    b = proxied.bot
+
+    def source(xff):
+        return b.notification_source_trusted(make_mocked_request("POST", "/notify", headers={"X-Forwarded-For": xff}))
+
+    # the client wrote the YooKassa address itself, our proxy appended the real peer
+    assert not source("185.71.76.1, 203.0.113.9")
+    assert source("203.0.113.9, 185.71.76.1")
+    assert not b.notification_source_trusted(make_mocked_request("POST", "/notify"))
+
+
+def test_forged_notification_does_not_mark_the_order_paid(proxied):
+    order_id, payment_id = new_order(proxied)
+    assert post_notification(proxied, payment_id, "185.71.76.1, 203.0.113.9") == 200
+    assert order_status(proxied, order_id) == "payment_created"
+    assert post_notification(proxied, "no-such-payment", "185.71.76.1, 203.0.113.9") == 403
+
+
+def test_allowlisted_source_is_still_checked_against_the_api(proxied):
+    order_id, payment_id = new_order(proxied)
+    assert post_notification(proxied, payment_id, "185.71.76.1") == 200
+    assert order_status(proxied, order_id) == "payment_created"  # the API still says pending
+    proxied.yk.set_status(payment_id, "succeeded")
+    assert post_notification(proxied, payment_id, "185.71.76.1") == 200
+    assert order_status(proxied, order_id) == "paid_pending_confirmation"
+
+
+def test_unparsable_api_answer_asks_for_redelivery(proxied, yookassa_html):
+    assert post_notification(proxied, "p-html", "185.71.76.1") == 503
+
+
+def test_non_object_notification_is_a_bad_request(proxied):
+    async def scenario():
+        app = web.Application()
+        app.router.add_post("/notify", proxied.bot.yookassa_notification)
+        async with TestClient(TestServer(app)) as client:
+            return [(await client.post("/notify", json=body)).status for body in ([1, 2], {"object": "x"})]
+    assert proxied.run(scenario()) == [400, 400]
@@ -0,0 +1,146 @@
+import asyncio
+import random
+import time
+
+CHAT = 350001
+
+
+def new_orders(harness, n: int, chat: int = CHAT):
+    async def scenario():
+        return [(await harness.bot.create_order(chat, 1 + i % 2, 100 + i))[0] for i in range(n)]
+    return harness.run(scenario())
+
+
+def statuses(harness, order_ids):
+    rows = harness.run(harness.bot.db.fetchall(
+        f"SELECT id, status FROM orders WHERE id IN ({','.join('?' * len(order_ids))})", order_ids))
+    return dict(rows)
+
+
+def outbox_rows(harness, order_ids, open_only=False):
+    sql = f"SELECT id, kind, done_at, attempts FROM outbox WHERE order_id IN ({','.join('?' * len(order_ids))})"
+    if open_only:
+        sql += " AND done_at IS NULL"
+    return harness.run(harness.bot.db.fetchall(sql + " ORDER BY id", order_ids))
+
+
+def close_outbox(harness, order_ids):
+    harness.run(harness.bot.db.execute(
+        f"UPDATE outbox SET done_at = 'test' WHERE done_at IS NULL AND order_id IN ({','.join('?' * len(order_ids))})",
+        order_ids))
+
+
+def test_random_transitions_follow_the_state_machine(harness):
+    b = harness.bot
+    rnd = random.Random(17)
+    orders = new_orders(harness, 12)
+    model = {oid: "pending" for oid in orders}
+    targets = sorted(b.ORDER_TRANSITIONS)
+    wins = 0
+
+    async def scenario():
+        nonlocal wins
+        for _ in range(2000):
+            oid, target = rnd.choice(orders), rnd.choice(targets)
+            expected = model[oid] in b.ORDER_TRANSITIONS[target]
+            got = await b.transition_order(oid, target, [("admin", {"text": "t {order_id}", "kind": "test"})])
+            assert got == expected, (oid, model[oid], target)
+            if got:
+                model[oid] = target
+                wins += 1
+
+    harness.run(scenario())
+    assert statuses(harness, orders) == model
+    # side effects are written by, and only by, winning transitions
+    assert len(outbox_rows(harness, orders)) == wins
+    close_outbox(harness, orders)
+
+
+def test_racing_transitions_have_one_winner(harness):
+    b = harness.bot
+    orders = new_orders(harness, 10)
+
+    async def race(oid):
+        attempts = [b.confirm_order(oid) for _ in range(4)] + [b.transition_order(oid, "declined") for _ in range(4)]
+        return await asyncio.gather(*attempts)
+
+    async def scenario():
+        return await asyncio.gather(*(race(oid) for oid in orders))
+
+    for oid, results in zip(orders, harness.run(scenario())):
+        assert sum(results) == 1, results
+        won_confirm = any(results[:4])
+        assert statuses(harness, [oid])[oid] == ("confirmed" if won_confirm else "declined")
+        assert len(outbox_rows(harness, [oid])) == (1 if won_confirm else 0)
+    close_outbox(harness, orders)
+
+
+def dispatch_until_idle(harness, order_ids):
+    """Runs the outbox until none of these orders' rows is due (rows of other tests may go along)."""
+    async def scenario():
+        for _ in range(50):
+            await harness.bot.outbox.dispatch_due()
+            due = await harness.bot.db.fetchone(
+                f"SELECT COUNT(*) FROM outbox WHERE done_at IS NULL AND next_at <= ? AND order_id IN "
+                f"({','.join('?' * len(order_ids))})", (time.time(), *order_ids))
+            if not due[0]:
+                return
+    harness.run(scenario())
+
+
+def make_due(harness, order_ids):
+    harness.run(harness.bot.db.execute(
+        f"UPDATE outbox SET next_at = 0 WHERE done_at IS NULL AND order_id IN ({','.join('?' * len(order_ids))})",
+        order_ids))
+
+
+def test_failed_send_is_retried_with_backoff(harness, monkeypatch):
+    b = harness.bot
+    chat = CHAT + 1
+    [oid] = new_orders(harness, 1, chat)
+    assert harness.run(b.transition_order(oid, "paid_pending_confirmation", [("user", {"text": "paid #{order_id}"})]))
+    send_message = b.bot.send_message
+    calls = []
+
+    async def flaky(chat_id, text, *args, **kwargs):
+        if chat_id == chat:
+            calls.append(text)
+            if len(calls) == 1:
+                raise ConnectionError("network down")
+        return await send_message(chat_id, text, *args, **kwargs)
+
+    monkeypatch.setattr(b.bot, "send_message", flaky)
+    dispatch_until_idle(harness, [oid])
+    [(_, _, done_at, attempts)] = outbox_rows(harness, [oid])
+    assert done_at is None and attempts == 1  # backed off, not lost
+    make_due(harness, [oid])
+    dispatch_until_idle(harness, [oid])
+    [(_, _, done_at, _)] = outbox_rows(harness, [oid])
+    assert done_at is not None
+    assert calls == [f"paid #{oid}", f"paid #{oid}"]
+
+
+def test_delivery_is_redone_after_a_crash_before_it_was_recorded(harness, monkeypatch):
+    b = harness.bot
+    chat = CHAT + 2
+    [oid] = new_orders(harness, 1, chat)
+    assert harness.run(b.confirm_order(oid))
+    transition_order = b.transition_order
+    crashed = []
+
+    async def crash_once(order_id, status, *args, **kwargs):
+        if status == "delivered" and not crashed:
+            crashed.append(order_id)
+            raise RuntimeError("crash between the send and its commit")
+        return await transition_order(order_id, status, *args, **kwargs)
+
+    monkeypatch.setattr(b, "transition_order", crash_once)
+    dispatch_until_idle(harness, [oid])
+    assert crashed == [oid] and statuses(harness, [oid])[oid] == "confirmed"
+    assert outbox_rows(harness, [oid], open_only=True)  # the deliver row is still open
+    make_due(harness, [oid])
+    dispatch_until_idle(harness, [oid])
+    assert statuses(harness, [oid])[oid] == "delivered"
+    assert not outbox_rows(harness, [oid], open_only=True)
+    gifts = [m for m in harness.tg.messages(chat) if "Ваш подарок" in m[1]]
+    assert len(gifts) == 2  # at least once: the send before the crash is repeated, never lost
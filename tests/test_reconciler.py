@@ -0,0 +1,37 @@
+import asyncio
+
+CHAT = 360001
+
+
+def test_restart_reconciles_payments_made_while_down(harness, monkeypatch):
+    b = harness.bot
+    monkeypatch.setattr(b.payment_reconciler, "interval", 3600)
+    get_pending_orders = b.get_pending_orders
+
+    async def slow_load():
+        await asyncio.sleep(0.3)  # a large orders table
+        return await get_pending_orders()
+
+    monkeypatch.setattr(b, "get_pending_orders", slow_load)
+
+    async def scenario():
+        order_id, invoice = await b.create_order(CHAT, 1, 100)
+        payment = await b.yookassa.create_payment(invoice, 100, "test", "https://t.me/x")
+        await b.set_order_payment(order_id, payment["id"], payment["confirmation"]["confirmation_url"])
+        harness.yk.set_status(payment["id"], "succeeded")  # paid while no instance was running
+        # a pass interrupted before the restart
+        await b.db.transaction(b.save_sync_state, b.PaymentReconciler.STATE_KEY,
+                               {"since": "2000-01-01T00:00:00.000Z", "status": "succeeded", "cursor": None})
+        watcher = asyncio.create_task(b.payment_watcher())
+        try:
+            for _ in range(50):
+                status = (await b.get_order(order_id))[3]
+                if status != "payment_created":
+                    return status
+                await asyncio.sleep(0.1)
+            return status
+        finally:
+            watcher.cancel()
+            await asyncio.gather(watcher, return_exceptions=True)
+
+    assert harness.run(scenario()) == "paid_pending_confirmation"
@@ -0,0 +1,48 @@
+import random
+
+CHAT = 360001
+
+
+def rollup_rows(harness):
+    return harness.run(harness.bot.db.fetchall("SELECT * FROM sales_rollup ORDER BY day, gift_id"))
+
+
+def test_incremental_rollups_equal_a_rebuild(harness):
+    b = harness.bot
+    rnd = random.Random(24)
+    # walks through the lifecycle; every step is a legal transition
+    paths = [
+        [],
+        ["payment_created"],
+        ["payment_created", "expired"],
+        ["paid_pending_confirmation"],
+        ["payment_created", "paid_pending_confirmation", "declined"],
+        ["paid_pending_confirmation", "confirmed", "delivered"],
+        ["confirmed", "error", "confirmed", "delivered"],
+        ["expired", "confirmed", "delivered"],
+        ["declined"],
+    ]
+
+    async def lifecycle(steps_after_archive):
+        orders = []
+        for i in range(60):
+            oid, _ = await b.create_order(CHAT + i % 5, rnd.choice((1, 2)), rnd.randint(50, 500))
+            orders.append((oid, rnd.choice(paths)))
+        for oid, path in orders:
+            for status in path[:rnd.randint(0, len(path))]:
+                assert await b.transition_order(oid, status)
+        # finished orders leave for the archive; the rest keep moving afterwards
+        await b.OrderArchiver(age=0).run_once()
+        for oid, path in orders:
+            for status in path:
+                await b.transition_order(oid, status)  # False for archived or already passed steps
+        for oid, _ in rnd.sample(orders, steps_after_archive):
+            await b.transition_order(oid, "declined")
+
+    harness.run(lifecycle(20))
+    archived = harness.run(b.db.fetchone("SELECT COUNT(*) FROM orders_archive"))[0]
+    assert archived > 0
+    incremental = rollup_rows(harness)
+    assert incremental
+    harness.run(b.db.transaction(b.rebuild_rollups))
+    assert rollup_rows(harness) == incremental
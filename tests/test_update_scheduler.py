@@ -0,0 +1,90 @@
+import asyncio
+
+from aiogram import Bot, Dispatcher
+
+from fake_telegram import UpdateFactory
+from metrics import Registry
+from update_scheduler import UpdateScheduler
+
+
+class RecordingHandler:
+    def __init__(self, delay=0.0, fail=()):
+        self.delay = delay
+        self.fail = set(fail)
+        self.seen = []
+
+    async def notify(self, update):
+        self.seen.append(update.update_id)
+        await asyncio.sleep(self.delay)
+        if update.update_id in self.fail:
+            raise RuntimeError("handler failed")
+
+
+def make_scheduler(handler, **kwargs):
+    dp = Dispatcher(Bot("123456:" + "a" * 35))
+    dp.updates_handler = handler
+    answered = []
+
+    async def on_drop(update):
+        answered.append(update.update_id)
+
+    scheduler = UpdateScheduler(dp, on_drop=on_drop, **kwargs)
+    outcomes = {}
+    scheduler.observer = lambda update, outcome: outcomes.__setitem__(update.update_id, outcome)
+    return scheduler, outcomes, answered
+
+
+def test_every_update_gets_one_outcome_in_chat_order(loop):
+    updates = UpdateFactory()
+    handler = RecordingHandler(delay=0.01, fail={3})  # the /catalog message: ids count from 1
+    scheduler, outcomes, answered = make_scheduler(handler, workers=2,
+                                         droppable=lambda u: u.callback_query is not None)
+
+    async def scenario():
+        scheduler.start()
+        feed = [updates.message(1, "/start"), updates.callback(1, "p1"), updates.message(1, "/catalog"),
+                updates.callback(1, "p2"), updates.callback(1, "p3"), updates.message(2, "/start")]
+        for update in feed:
+            await scheduler.submit(update)
+        await scheduler.stop()
+        return [u.update_id for u in feed]
+
+    ids = loop.run_until_complete(scenario())
+    assert sorted(outcomes) == sorted(ids)
+    # p1 and p2 skipped: a newer page flip from the same chat is queued behind each of them
+    assert [outcomes[i] for i in (ids[1], ids[3], ids[4])] == ["superseded", "superseded", "done"]
+    assert outcomes[ids[2]] == "failed"
+    chat1 = [i for i in handler.seen if i != ids[5]]
+    assert chat1 == sorted(chat1)
+    assert scheduler.dropped["superseded"] == 2
+    assert sorted(answered) == [ids[1], ids[3]]
+
+
+def test_refused_droppable_update_is_observed(loop):
+    updates = UpdateFactory()
+    scheduler, outcomes, answered = make_scheduler(RecordingHandler(delay=0.05), workers=1, max_pending=1,
+                                         droppable=lambda u: u.callback_query is not None)
+
+    async def scenario():
+        scheduler.start()
+        await scheduler.submit(updates.message(1, "/start"))
+        await scheduler.submit(updates.message(2, "/start"))
+        refused = updates.callback(3, "p1")
+        accepted = await scheduler.submit(refused)
+        await scheduler.stop()
+        return refused.update_id, accepted
+
+    update_id, accepted = loop.run_until_complete(scenario())
+    assert not accepted
+    assert outcomes[update_id] == "overload"
+    assert answered == [update_id]
+
+
+def test_dropped_updates_render_as_counter():
+    dropped = {"superseded": 2, "overload": 0}
+    registry = Registry()
+    registry.counter("bot_updates_dropped_total", "shed", ("reason",),
+                     fn=lambda: {(reason,): n for reason, n in dropped.items()})
+    text = registry.render()
+    assert "# TYPE bot_updates_dropped_total counter" in text
+    assert 'bot_updates_dropped_total{reason="superseded"} 2' in text
@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+
+from yookassa import CircuitBreaker, YooKassaClient, YooKassaError
+
+
+async def start_server(handler):
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0, shutdown_timeout=0.1)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}/v3"
+
+
+def half_open_client(api_base: str) -> YooKassaClient:
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()  # open, and with reset_timeout=0 half-open at once
+    assert breaker.state == "half_open"
+    return YooKassaClient("shop", "key", api_base=api_base, retries=0, breaker=breaker)
+
+
+def test_cancelled_half_open_trial_frees_the_slot(loop):
+    async def hang(request):
+        await asyncio.sleep(30)
+        return web.json_response({})
+
+    async def scenario():
+        runner, base = await start_server(hang)
+        client = half_open_client(base)
+        try:
+            trial = asyncio.create_task(client.get_payment("p1"))
+            await asyncio.sleep(0.2)
+            assert client.breaker._trial_in_flight
+            trial.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await trial
+            assert client.breaker.allow()
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    loop.run_until_complete(scenario())
+
+
+def test_unparsable_body_frees_the_slot(loop):
+    async def garbage(request):
+        return web.Response(text="<html>oops</html>")
+
+    async def scenario():
+        runner, base = await start_server(garbage)
+        client = half_open_client(base)
+        try:
+            with pytest.raises(YooKassaError):
+                await client.get_payment("p1")
+            assert client.breaker.allow()
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    loop.run_until_complete(scenario())
+
+
+def test_non_object_json_body_is_a_breaker_failure(loop):
+    async def listing(request):
+        return web.json_response([{"id": "p1"}])
+
+    async def scenario():
+        runner, base = await start_server(listing)
+        client = YooKassaClient("shop", "key", api_base=base, retries=0,
+                                breaker=CircuitBreaker(failure_threshold=1, reset_timeout=60))
+        try:
+            with pytest.raises(YooKassaError):
+                await client.get_payment("p1")
+            assert client.breaker.state == "open"
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    loop.run_until_complete(scenario())
+
+
+def test_half_open_success_closes_the_circuit(loop):
+    async def ok(request):
+        return web.json_response({"id": "p1", "status": "succeeded"})
+
+    async def scenario():
+        runner, base = await start_server(ok)
+        client = half_open_client(base)
+        try:
+            assert (await client.get_payment("p1"))["status"] == "succeeded"
+            assert client.breaker.state == "closed"
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    loop.run_until_complete(scenario())
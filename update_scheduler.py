@@ -0,0 +1,210 @@
+# update_scheduler.py
+import asyncio
+import logging
+import time
+from collections import deque
+
+from aiogram import Bot, Dispatcher, types
+
+log = logging.getLogger(__name__)
+
+
+class SchedulerFull(Exception):
+    """submit(wait=False) found no room for a non-droppable update."""
+
+
+def update_chat_key(update: types.Update):
+    """Updates with the same key run one after another, in arrival order."""
+    for obj in (update.message, update.edited_message, update.channel_post, update.edited_channel_post,
+                update.my_chat_member, update.chat_member, update.chat_join_request):
+        if obj is not None:
+            return obj.chat.id
+    if update.callback_query is not None:
+        cq = update.callback_query
+        return cq.message.chat.id if cq.message else cq.from_user.id
+    for obj in (update.inline_query, update.chosen_inline_result, update.shipping_query, update.pre_checkout_query):
+        if obj is not None:
+            return obj.from_user.id
+    return ("update", update.update_id)
+
+
+class UpdateScheduler:
+    """
+    Runs updates concurrently across chats and strictly in arrival order within a chat.
+
+    Every chat has its own FIFO. A chat with pending updates waits in the ready queue until one of
+    `workers` tasks takes it, runs its oldest update and puts the chat back at the tail if more are
+    pending, so one slow chat occupies one worker and never holds up the others.
+
+    At most `max_pending` updates are buffered. Past that, `droppable` updates (stale page flips)
+    are shed first, a new droppable update is refused, and anything else waits in submit() until
+    there is room (or, with wait=False, is refused with SchedulerFull so a webhook can answer 503). A droppable update is also skipped when a newer droppable one from the same chat
+    is already queued behind it. Every shed or skipped update goes to `on_drop(update)`, a coroutine
+    function run in the background (e.g. to answer the callback query so the button stops spinning).
+    """
+
+    def __init__(self, dispatcher: Dispatcher, workers: int = 32, max_pending: int = 2000, droppable=None,
+                 on_drop=None):
+        self.dp = dispatcher
+        self.workers = workers
+        self.max_pending = max_pending
+        self.droppable = droppable or (lambda update: False)
+        self.on_drop = on_drop
+        self.pending = 0
+        self.processed = 0
+        self.dropped = {"superseded": 0, "overload": 0}
+        self.observer = None  # callable(update, outcome): once per submitted update; "done", "failed", "superseded", "overload"
+        self._chats = {}  # key -> deque of updates; present while the chat is ready or running
+        self._slots = [[None, None] for _ in range(workers)]  # per worker: [chat key, started]
+        self._ready = None
+        self._room = None
+        self._tasks = []
+        self._drop_tasks = set()
+
+    def start(self):
+        self._ready = asyncio.Queue()
+        self._room = asyncio.Event()
+        self._room.set()
+        self._tasks = [asyncio.create_task(self._worker(n)) for n in range(self.workers)]
+
+    async def stop(self, timeout: float = 10.0):
+        """Lets queued and running updates finish (up to `timeout`), then stops the workers."""
+        deadline = time.monotonic() + timeout
+        while (self.pending or self.running) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        await asyncio.gather(*self._drop_tasks, return_exceptions=True)
+
+    @property
+    def running(self) -> int:
+        return sum(1 for key, _ in self._slots if key is not None)
+
+    def worker_backlog(self) -> dict:
+        """{(worker,): updates still queued for the chat that worker is running}"""
+        return {(str(n),): len(self._chats.get(key, ())) if key is not None else 0
+                for n, (key, _) in enumerate(self._slots)}
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "pending": self.pending,
+            "chats": len(self._chats),
+            "running": self.running,
+            "processed": self.processed,
+            "dropped": dict(self.dropped),
+            "workers": [{"chat": key, "busy_s": round(now - started, 3) if started else 0.0,
+                         "backlog": len(self._chats.get(key, ())) if key is not None else 0}
+                        for key, started in self._slots],
+        }
+
+    async def wait_capacity(self):
+        if self._room is not None:
+            await self._room.wait()
+
+    def _added(self):
+        self.pending += 1
+        if self.pending >= self.max_pending:
+            self._room.clear()
+
+    def _removed(self):
+        self.pending -= 1
+        if self.pending < self.max_pending:
+            self._room.set()
+
+    def _observe(self, update: types.Update, outcome: str):
+        if self.observer is not None:
+            self.observer(update, outcome)
+
+    def _drop(self, update: types.Update, reason: str):
+        self.dropped[reason] += 1
+        self._observe(update, reason)
+        if self.on_drop is not None:
+            task = asyncio.create_task(self._run_on_drop(update))
+            self._drop_tasks.add(task)
+            task.add_done_callback(self._drop_tasks.discard)
+
+    async def _run_on_drop(self, update: types.Update):
+        try:
+            await self.on_drop(update)
+        except Exception:
+            log.exception("on_drop failed for update %s", update.update_id)
+
+    def _shed_one(self) -> bool:
+        # chats are kept in first-arrival order, so this finds an old page flip first
+        for q in self._chats.values():
+            for i, update in enumerate(q):
+                if self.droppable(update):
+                    del q[i]
+                    self._removed()
+                    self._drop(update, "overload")
+                    return True
+        return False
+
+    async def submit(self, update: types.Update, wait: bool = True) -> bool:
+        """Queues the update; False if it was shed right away."""
+        if self._ready is None:
+            raise RuntimeError("UpdateScheduler.start() was not called")
+        if self.pending >= self.max_pending and not self._shed_one():
+            if self.droppable(update):
+                self._drop(update, "overload")
+                return False
+            if not wait:
+                raise SchedulerFull()
+            while self.pending >= self.max_pending:
+                await self._room.wait()
+        key = update_chat_key(update)
+        q = self._chats.get(key)
+        if q is None:
+            q = self._chats[key] = deque()
+            self._ready.put_nowait(key)
+        q.append(update)
+        self._added()
+        return True
+
+    async def _worker(self, n: int):
+        # workers start before polling sets these, and handlers rely on Bot.get_current()
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        slot = self._slots[n]
+        while True:
+            key = await self._ready.get()
+            q = self._chats[key]
+            if not q:  # everything was shed
+                del self._chats[key]
+                continue
+            update = q.popleft()
+            self._removed()
+            if self.droppable(update) and any(self.droppable(u) for u in q):
+                self._drop(update, "superseded")
+            else:
+                slot[0], slot[1] = key, time.monotonic()
+                outcome = "failed"
+                try:
+                    # own task per update: FSM and filters cache state in context variables
+                    await asyncio.create_task(self.dp.updates_handler.notify(update))
+                    outcome = "done"
+                except Exception:
+                    log.exception("Update %s failed", update.update_id)
+                finally:
+                    slot[0] = slot[1] = None
+                    self.processed += 1
+                    self._observe(update, outcome)
+            if q:
+                self._ready.put_nowait(key)
+            else:
+                del self._chats[key]
+
+
+class ScheduledDispatcher(Dispatcher):
+    """Hands polled updates to an UpdateScheduler instead of gathering each batch at once."""
+
+    scheduler: UpdateScheduler = None
+
+    async def process_updates(self, updates, fast: bool = True):
+        if self.scheduler is None:
+            return await super().process_updates(updates, fast)
+        for update in updates:
+            await self.scheduler.submit(update)
+        return []
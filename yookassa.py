@@ -0,0 +1,208 @@
+# yookassa.py
+import asyncio
+import logging
+import random
+import time
+
+import aiohttp
+
+log = logging.getLogger(__name__)
+
+DEFAULT_API_BASE = "https://api.yookassa.ru/v3"
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class YooKassaError(Exception):
+    def __init__(self, message: str, status: int = None):
+        super().__init__(message)
+        self.status = status
+
+
+class CircuitOpenError(YooKassaError):
+    pass
+
+
+class CircuitBreaker:
+    """closed -> (N consecutive failures) -> open -> (reset_timeout) -> half-open -> one trial call"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                log.warning("YooKassa circuit opened after %s failures", self.failures)
+            self.opened_at = time.monotonic()
+
+
+class YooKassaClient:
+    """Async YooKassa API client: one keep-alive connection pool, a deadline per call,
+    jittered retries on 429/5xx and a circuit breaker."""
+
+    def __init__(self, shop_id: str, secret_key: str, api_base: str = DEFAULT_API_BASE,
+                 timeout: float = 10.0, attempt_timeout: float = 4.0, retries: int = 3,
+                 backoff_base: float = 0.3, backoff_max: float = 3.0, pool_size: int = 20,
+                 breaker: CircuitBreaker = None):
+        self.shop_id = shop_id
+        self.secret_key = secret_key
+        self.api_base = api_base.rstrip("/")
+        self.timeout = timeout
+        self.attempt_timeout = attempt_timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self.breaker = breaker or CircuitBreaker()
+        self.observer = None  # callable(endpoint, outcome, seconds) per attempt
+        self._session = None
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.shop_id and self.secret_key)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                auth=aiohttp.BasicAuth(self.shop_id, self.secret_key),
+            )
+        return self._session
+
+    def _backoff(self, attempt: int) -> float:
+        # "full jitter": uniform(0, min(cap, base * 2^attempt))
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _observe(self, endpoint: str, outcome, started: float):
+        if self.observer is not None:
+            self.observer(endpoint, str(outcome), time.monotonic() - started)
+
+    async def request(self, method: str, path: str, json: dict = None, params: dict = None,
+                      idempotence_key: str = None, timeout: float = None, endpoint: str = None) -> dict:
+        if not self.configured:
+            raise YooKassaError("YOOKASSA not configured")
+        if not self.breaker.allow():
+            raise CircuitOpenError("YooKassa circuit open")
+        deadline = time.monotonic() + (timeout or self.timeout)
+        headers = {}
+        if idempotence_key:
+            # the same key on every attempt, so a retried POST never creates a second payment
+            headers["Idempotence-Key"] = idempotence_key
+        url = f"{self.api_base}{path}"
+        endpoint = endpoint or f"{method} {path}"
+        last_error = None
+        settled = False  # a breaker outcome was recorded for this call
+        try:
+            for attempt in range(self.retries + 1):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                retry_after = None
+                started = time.monotonic()
+                try:
+                    per_try = aiohttp.ClientTimeout(total=min(self.attempt_timeout, remaining))
+                    async with self._get_session().request(method, url, json=json, params=params,
+                                                           headers=headers, timeout=per_try) as resp:
+                        self._observe(endpoint, resp.status, started)
+                        if resp.status in (200, 201):
+                            try:
+                                data = await resp.json(content_type=None)
+                            except ValueError:  # not JSON, e.g. a proxy's error page
+                                data = None
+                            if not isinstance(data, dict):
+                                self.breaker.record_failure()
+                                settled = True
+                                body = await resp.read()
+                                log.warning("YooKassa %s %s -> %s, unexpected body %r", method, path, resp.status, body[:300])
+                                raise YooKassaError(f"YooKassa unexpected response body ({resp.status})", resp.status)
+                            self.breaker.record_success()
+                            settled = True
+                            return data
+                        text = await resp.text()
+                        last_error = YooKassaError(f"YooKassa error {resp.status}", resp.status)
+                        if resp.status not in RETRY_STATUSES:
+                            # 4xx: our request is wrong, the API itself is healthy
+                            self.breaker.record_success()
+                            settled = True
+                            log.warning("YooKassa %s %s -> %s %s", method, path, resp.status, text[:300])
+                            raise last_error
+                        log.warning("YooKassa %s %s -> %s (attempt %s)", method, path, resp.status, attempt + 1)
+                        if resp.headers.get("Retry-After", "").isdigit():
+                            retry_after = int(resp.headers["Retry-After"])
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    self._observe(endpoint, e.__class__.__name__, started)
+                    log.warning("YooKassa %s %s failed (attempt %s): %r", method, path, attempt + 1, e)
+                    last_error = YooKassaError(str(e) or e.__class__.__name__)
+                if attempt == self.retries:
+                    break
+                delay = retry_after if retry_after is not None else self._backoff(attempt)
+                if time.monotonic() + delay >= deadline:
+                    break
+                await asyncio.sleep(delay)
+            self.breaker.record_failure()
+            settled = True
+            raise last_error or YooKassaError("YooKassa deadline exceeded")
+        finally:
+            if not settled:
+                # cancelled, or any other unexpected error: a half-open trial must
+                # still give its slot back, or allow() refuses every later call
+                self.breaker.record_failure()
+
+    async def create_payment(self, local_invoice: str, amount_rub: int, description: str, return_url: str) -> dict:
+        body = {
+            "amount": {"value": f"{amount_rub:.2f}", "currency": "RUB"},
+            "payment_method_data": {"type": "bank_card"},
+            "confirmation": {"type": "redirect", "return_url": return_url},
+            "description": description,
+            "metadata": {"local_invoice": local_invoice},
+        }
+        return await self.request("POST", "/payments", json=body, idempotence_key=local_invoice,
+                                  endpoint="POST /payments")
+
+    async def get_payment(self, payment_id: str) -> dict:
+        return await self.request("GET", f"/payments/{payment_id}", endpoint="GET /payments/{id}")
+
+    async def list_payments(self, status: str = None, created_at_gte: str = None, cursor: str = None,
+                            limit: int = 100) -> dict:
+        """One page of GET /payments: {"items": [...], "next_cursor": ...}; newest first."""
+        params = {"limit": str(limit)}
+        if status:
+            params["status"] = status
+        if created_at_gte:
+            params["created_at.gte"] = created_at_gte
+        if cursor:
+            params["cursor"] = cursor
+        return await self.request("GET", "/payments", params=params, endpoint="GET /payments")
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None